@@ -0,0 +1,417 @@
+###############################################################################
+# MIT License
+#
+# Copyright (c) 2017,2020 Hajime Nakagami
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+###############################################################################
+# asyncio version of minicql. It shares the protocol codec with minicql.
+
+import asyncio
+import ssl
+import struct
+
+import minicql
+from minicql import (
+    OP_STARTUP, OP_READY, OP_AUTHENTICATE, OP_OPTIONS, OP_SUPPORTED,
+    OP_PREPARE, OP_BATCH, OP_AUTH_RESPONSE, OP_AUTH_SUCCESS, REQUEST_PROTOCOL_VERSION, COMPRESSION_FLAG,
+    TRACING_FLAG, WARNING_FLAG, CUSOM_PAYLOAD_FLAG,
+    Error, OperationalError, ProgrammingError,
+    PreparedStatement, StatementCache, BATCH_UNLOGGED,
+)
+
+
+class Cursor:
+    def __init__(self, connection, page_size=None, prefetch=True, row_factory=None):
+        self.connection = connection
+        self.row_factory = minicql.resolve_row_factory(row_factory or connection.row_factory)
+        self.description = []
+        self._rows = []
+        self._pos = 0
+        self._rowcount = 0
+        self.arraysize = 1
+        self.query = None
+        self.args = ()
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self._paging_state = None
+        self._fetcher = None
+        self._convert_row = minicql.row_converter([])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc, value, traceback):
+        await self.close()
+
+    async def execute(self, query, args=()):
+        if not self.connection or not self.connection.is_connect():
+            raise ProgrammingError("Lost connection")
+
+        self.description = []
+        await self._cancel_fetch()
+        if isinstance(query, str) and args:
+            connection = self.connection
+            stmt = await connection._get_prepared(
+                query, connection._statement_cache.prepare_first(args)
+            )
+            query, args = minicql.bind_args(query, args, stmt)
+        self.query, self.args = query, args
+        self._set_result(*await self.connection._execute(query, args, self.page_size))
+
+    async def executemany(self, query, seq_of_params, batch_type=BATCH_UNLOGGED):
+        if not self.connection or not self.connection.is_connect():
+            raise ProgrammingError("Lost connection")
+
+        if minicql.is_modification(query):
+            self.description = []
+            await self._cancel_fetch()
+            self._rows, self._pos = [], 0
+            self._rowcount = await self.connection.batch(
+                [(query, params) for params in seq_of_params], batch_type
+            )
+            return
+
+        seq_of_params = list(seq_of_params)
+        if isinstance(query, str) and len(seq_of_params) > 1:
+            query = await self.connection._get_prepared(query, force=True) or query
+        rowcount = 0
+        for params in seq_of_params:
+            await self.execute(query, params)
+            rowcount += self._rowcount
+        self._rowcount = rowcount
+
+    def _set_result(self, description, rows, paging_state):
+        self.description, self._rows, self._paging_state = description, rows, paging_state
+        self._pos = 0
+        self._convert_row = self.row_factory(description)
+        self._rowcount = len(self._rows)
+        if self.prefetch and self._paging_state:
+            self._fetcher = asyncio.ensure_future(self.connection._execute(
+                self.query, self.args, self.page_size, self._paging_state
+            ))
+
+    async def _cancel_fetch(self):
+        if self._fetcher:
+            # the read loop releases the stream when the response arrives
+            self._fetcher.cancel()
+            self._fetcher = None
+        self._paging_state = None
+
+    async def _next_page(self):
+        "Load the next page into self._rows. Return False if no more pages."
+        if not self._paging_state:
+            return False
+        rowcount = self._rowcount
+        if self._fetcher:
+            fetcher, self._fetcher = self._fetcher, None
+            self._set_result(*await fetcher)
+        else:
+            self._set_result(*await self.connection._execute(
+                self.query, self.args, self.page_size, self._paging_state
+            ))
+        self._rowcount += rowcount
+        return True
+
+    async def fetchone(self):
+        if not self.connection or not self.connection.is_connect():
+            raise ProgrammingError("Lost connection")
+        while self._pos >= len(self._rows):
+            if not await self._next_page():
+                return None
+        self._pos += 1
+        return self._convert_row(self._rows[self._pos - 1])
+
+    async def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rs = []
+        for i in range(size):
+            r = await self.fetchone()
+            if r is None:
+                break
+            rs.append(r)
+        return rs
+
+    async def fetchall(self):
+        convert_row = self._convert_row
+        rows = [convert_row(self._rows[i]) for i in range(self._pos, len(self._rows))]
+        self._rows, self._pos = [], 0
+        while await self._next_page():
+            rows.extend(map(convert_row, self._rows))
+            self._rows = []
+        return rows
+
+    async def close(self):
+        await self._cancel_fetch()
+        self.connection = None
+
+    @property
+    def rowcount(self):
+        return self._rowcount
+
+    @property
+    def closed(self):
+        return self.connection is None or not self.connection.is_connect()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        r = await self.fetchone()
+        if r is None:
+            raise StopAsyncIteration()
+        return r
+
+
+class Connection:
+    def __init__(
+        self, host, keyspace, port, user, password, use_ssl,
+        page_size=None, prepare_threshold=2, statement_cache_size=256,
+        max_requests=32768, compression=None, compression_threshold=512,
+        batch_max_statements=100, batch_max_bytes=40960, row_factory='tuple',
+    ):
+        self.host = host
+        self.keyspace = keyspace
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self.page_size = page_size
+        self.row_factory = minicql.resolve_row_factory(row_factory)
+        self.batch_max_statements = batch_max_statements
+        self.batch_max_bytes = batch_max_bytes
+        self._statement_cache = StatementCache(statement_cache_size, prepare_threshold)
+        self._max_requests = max_requests
+        self._compression = compression
+        self.compression = None
+        self.compression_threshold = compression_threshold
+        self._compress = self._decompress = None
+        self._reader = self._writer = None
+
+    async def _send_frame(self, opcode, body, stream):
+        flags = 0
+        if isinstance(body, list):
+            # with large values (see minicql.join_buffers)
+            body = b''.join(body) if self._compress else body
+        if self._compress and len(body) > self.compression_threshold:
+            compressed = self._compress(body)
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= COMPRESSION_FLAG
+        self._writer.writelines([struct.pack(
+            ">BBhBL",
+            REQUEST_PROTOCOL_VERSION,
+            flags,
+            stream,
+            opcode,
+            sum(len(b) for b in body) if isinstance(body, list) else len(body),
+        )] + (body if isinstance(body, list) else [body]))
+        await self._writer.drain()
+
+    async def _read_frame(self):
+        header = await self._reader.readexactly(9)
+        stream = int.from_bytes(header[2:4], byteorder='big', signed=True)
+        ln = int.from_bytes(header[-4:], byteorder='big')
+        body = await self._reader.readexactly(ln)
+        if header[1] & COMPRESSION_FLAG:
+            body = self._decompress(body)
+        if header[1] & (TRACING_FLAG | WARNING_FLAG | CUSOM_PAYLOAD_FLAG):
+            _, _, body = minicql.decode_frame_prefix(header[1], body)
+        return stream, header[4], body
+
+    async def _recv_frame(self):
+        stream, opcode, body = await self._read_frame()
+        return minicql.check_frame(opcode, body)
+
+    async def _read_loop(self):
+        "Receive frames and route them to waiters by stream id"
+        try:
+            while True:
+                stream, opcode, body = await self._read_frame()
+                future = self._waiters.pop(stream, None)
+                if future is None or future.cancelled():
+                    if future is not None:
+                        self._release_stream(stream)
+                    continue
+                self._release_stream(stream)
+                try:
+                    future.set_result(minicql.check_frame(opcode, body))
+                except Error as e:
+                    future.set_exception(e)
+        except Exception as e:
+            if isinstance(e, asyncio.IncompleteReadError):
+                e = OperationalError(-1, "Can't recv packets")
+            # the connection is lost, later requests fail at once
+            writer, self._writer = self._writer, None
+            if writer:
+                writer.close()
+            waiters, self._waiters = self._waiters, {}
+            for future in waiters.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def _release_stream(self, stream):
+        self._free_streams.append(stream)
+        self._stream_semaphore.release()
+
+    async def _request(self, opcode, body=b''):
+        await self._stream_semaphore.acquire()
+        if not self._writer:
+            self._stream_semaphore.release()
+            raise OperationalError(-1, "Lost connection")
+        stream = self._free_streams.pop()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[stream] = future
+        try:
+            await self._send_frame(opcode, body, stream)
+        except Exception:
+            del self._waiters[stream]
+            self._release_stream(stream)
+            raise
+        return await future
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context() if self.use_ssl else None
+        )
+
+        await self._send_frame(OP_OPTIONS, b'', 0)
+        opcode, body = await self._recv_frame()
+        assert opcode == OP_SUPPORTED
+        supported_params, _ = minicql.decode_string_multimap(body)
+        startup = {'CQL_VERSION': supported_params['CQL_VERSION'][0]}
+        compression = minicql.choose_compression(supported_params, self._compression)
+        if compression:
+            startup['COMPRESSION'] = compression
+        await self._send_frame(OP_STARTUP, minicql.encode_string_map(startup), 0)
+        if compression:
+            self.compression = compression
+            self._compress, self._decompress = minicql.COMPRESSIONS[compression]
+        opcode, body = await self._recv_frame()
+
+        if opcode == OP_AUTHENTICATE:
+            await self._send_frame(
+                OP_AUTH_RESPONSE, minicql.encode_auth_response(self.user, self.password), 0
+            )
+            opcode, _ = await self._recv_frame()
+            assert opcode == OP_AUTH_SUCCESS
+        else:
+            assert opcode == OP_READY
+
+        self._waiters = {}
+        self._free_streams = list(reversed(range(self._max_requests)))
+        self._stream_semaphore = asyncio.Semaphore(self._max_requests)
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+        if self.keyspace:
+            await self._execute("use " + self.keyspace)
+
+    async def _get_prepared(self, query, force=False):
+        "Return cached PreparedStatement of a 'format' paramstyle query, or None"
+        stmt, need_prepare = self._statement_cache.lookup(query, force)
+        if need_prepare:
+            try:
+                stmt = await self.prepare('?'.join(minicql.query_template(query).parts))
+            except OperationalError:
+                stmt = None
+            self._statement_cache.store(query, stmt)
+        return stmt
+
+    async def prepare(self, query):
+        kind, body = minicql.decode_result(
+            *await self._request(OP_PREPARE, minicql.encode_long_string(query))
+        )
+        return PreparedStatement(query, *minicql.decode_prepared(body))
+
+    async def _execute(self, query, args=(), page_size=None, paging_state=None):
+        opcode, body = minicql.encode_query(query, args, page_size, paging_state)
+        try:
+            response = await self._request(opcode, body)
+        except OperationalError as e:
+            if not (isinstance(query, PreparedStatement) and e.code == 0x2500):  # Unprepared
+                raise
+            stmt = await self.prepare(query.query)
+            query.query_id, query.description = stmt.query_id, stmt.description
+            opcode, body = minicql.encode_query(query, args, page_size, paging_state)
+            response = await self._request(opcode, body)
+        return minicql.decode_query_result(query, *response)
+
+    async def _bind_statement(self, query, args):
+        "Return (query, encoded values) of a batch entry"
+        if isinstance(query, str) and args:
+            query = await self._get_prepared(query, force=True) or minicql.format_query(query, args)
+        if isinstance(query, PreparedStatement):
+            return query, query.bind(args)
+        return query, []
+
+    async def _execute_batch(self, entries, batch_type):
+        try:
+            minicql.decode_result(
+                *await self._request(OP_BATCH, minicql.encode_batch(entries, batch_type))
+            )
+        except OperationalError as e:
+            if e.code != 0x2500:    # Unprepared
+                raise
+            for query in set(q for q, _ in entries if isinstance(q, PreparedStatement)):
+                stmt = await self.prepare(query.query)
+                query.query_id, query.description = stmt.query_id, stmt.description
+            minicql.decode_result(
+                *await self._request(OP_BATCH, minicql.encode_batch(entries, batch_type))
+            )
+
+    async def batch(self, statements, batch_type=BATCH_UNLOGGED):
+        "Execute (query, args) statements by BATCH requests. See minicql.Connection.batch()"
+        entries = [await self._bind_statement(query, args) for query, args in statements]
+        rowcount = 0
+        for i, chunk in enumerate(
+            minicql.chunk_batch(entries, self.batch_max_statements, self.batch_max_bytes)
+        ):
+            try:
+                await self._execute_batch(chunk, batch_type)
+            except OperationalError as e:
+                raise OperationalError(e.code, "batch chunk %d (statements %d-%d) failed: %s" % (
+                    i, rowcount, rowcount + len(chunk) - 1, e.message
+                ))
+            rowcount += len(chunk)
+        return rowcount
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc, value, traceback):
+        await self.close()
+
+    def is_connect(self):
+        return bool(self._writer)
+
+    def cursor(self, page_size=None, prefetch=True, row_factory=None):
+        return Cursor(self, page_size or self.page_size, prefetch, row_factory)
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+            await self._read_task
+
+
+async def connect(host, keyspace=None, port=9042, user=None, password=None, use_ssl=False, **kwargs):
+    conn = Connection(host, keyspace, port, user, password, use_ssl, **kwargs)
+    await conn._connect()
+    return conn
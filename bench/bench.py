@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+###############################################################################
+# MIT License
+#
+# Copyright (c) 2017,2020 Hajime Nakagami
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+###############################################################################
+# Benchmarks of minicql against the fake server (fakecql.py), or a server
+# given by --host and --port which has the tables created by setup().
+#
+#   python bench/bench.py --output result.json
+#   python bench/bench.py --compare result.json
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import minicql   # noqa: E402
+import fakecql   # noqa: E402
+
+COLUMNS = [('id', 'int'), ('s', 'text'), ('d', 'double'), ('t', 'timestamp')]
+
+
+def setup(server, large_rows):
+    server.add_table('small', COLUMNS, 1)
+    server.add_table('large', COLUMNS, large_rows)
+    server.add_table('bulk', COLUMNS, 0)
+
+
+def best(func, repeat):
+    "Return the shortest seconds of func() in repeat runs"
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_connect(args):
+    times = []
+    for i in range(args.connects):
+        start = time.perf_counter()
+        conn = minicql.connect(args.host, port=args.port, protocol_version=args.protocol_version)
+        times.append(time.perf_counter() - start)
+        conn.close()
+    return {
+        'connect_p50': (statistics.median(times) * 1e6, 'us', False),
+        'connect_max': (max(times) * 1e6, 'us', False),
+    }
+
+
+def bench_round_trip(args):
+    conn = minicql.connect(args.host, port=args.port, protocol_version=args.protocol_version)
+    cur = conn.cursor()
+    times = []
+    for i in range(args.queries):
+        start = time.perf_counter()
+        cur.execute("SELECT * FROM small")
+        cur.fetchall()
+        times.append(time.perf_counter() - start)
+    conn.close()
+    times.sort()
+    return {
+        'round_trip_p50': (times[len(times) // 2] * 1e6, 'us', False),
+        'round_trip_p99': (times[len(times) * 99 // 100] * 1e6, 'us', False),
+    }
+
+
+def bench_decode(args):
+    table = fakecql.Table('large', COLUMNS, args.rows)
+    body = fakecql.encode_rows('ks', 'large', table.columns, table.rows)
+    result = {}
+
+    seconds = best(lambda: minicql.decode_rows(body), args.repeat)
+    result['decode_rows'] = (args.rows / seconds, 'rows/s', True)
+    result['decode_rows_bytes'] = (len(body) / seconds / 1e6, 'MB/s', True)
+
+    description, rows, _ = minicql.decode_rows(body)
+    convert_row = minicql.row_converter(description)
+    seconds = best(lambda: [convert_row(row) for row in rows], args.repeat)
+    result['convert_row'] = (args.rows / seconds, 'rows/s', True)
+
+    # Row converts only the cells accessed
+    make_row = minicql.lazy_row_converter(description)
+    seconds = best(lambda: [make_row(rows[i])[0] for i in range(len(rows))], args.repeat)
+    result['lazy_row_one_column'] = (args.rows / seconds, 'rows/s', True)
+    return result
+
+
+def bench_fetch(args):
+    conn = minicql.connect(args.host, port=args.port, protocol_version=args.protocol_version)
+    cur = conn.cursor()
+
+    def fetch():
+        cur.execute("SELECT * FROM large")
+        cur.fetchall()
+    seconds = best(fetch, args.repeat)
+    conn.close()
+    return {'fetch': (args.rows / seconds, 'rows/s', True)}
+
+
+def bench_scan(args):
+    conn = minicql.connect(args.host, port=args.port, protocol_version=args.protocol_version)
+    seconds = best(lambda: sum(1 for row in minicql.scan(
+        conn, 'large', partition_key=['id'], splits=16, workers=8
+    )), args.repeat)
+    conn.close()
+    return {'scan': (args.rows / seconds, 'rows/s', True)}
+
+
+def bench_insert(args):
+    conn = minicql.connect(args.host, port=args.port, protocol_version=args.protocol_version)
+    cur = conn.cursor()
+    rows = [(i, 'row%d' % i, i / 4, i * 1000) for i in range(args.inserts)]
+    seconds = best(lambda: cur.executemany(
+        "INSERT INTO bulk (id, s, d, t) VALUES (%s, %s, %s, %s)", rows
+    ), args.repeat)
+    conn.close()
+    return {'bulk_insert': (args.inserts / seconds, 'rows/s', True)}
+
+
+def bench_bulk_load(args):
+    conn = minicql.connect(args.host, port=args.port, protocol_version=args.protocol_version)
+    rows = [(i % 1000, 'row%d' % i, i / 4, i * 1000) for i in range(args.inserts)]
+    seconds = best(lambda: minicql.bulk_load(
+        conn, 'bulk', [c[0] for c in COLUMNS], iter(rows)
+    ), args.repeat)
+    conn.close()
+    return {'bulk_load': (args.inserts / seconds, 'rows/s', True)}
+
+
+BENCHMARKS = {
+    'connect': bench_connect,
+    'round_trip': bench_round_trip,
+    'decode': bench_decode,
+    'fetch': bench_fetch,
+    'scan': bench_scan,
+    'insert': bench_insert,
+    'bulk_load': bench_bulk_load,
+}
+
+
+def compare(results, baseline, threshold):
+    "Print changes from the baseline and return names of regressed results"
+    regressions = []
+    print('%-20s %14s %14s %8s %8s' % ('', 'baseline', 'result', '', 'change'))
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['value']
+        change = (r['value'] - base) / base if base else 0.0
+        worse = -change if r['higher_is_better'] else change
+        mark = ''
+        if worse > threshold:
+            mark = 'REGRESSION'
+            regressions.append(name)
+        print('%-20s %14.1f %14.1f %8s %+7.1f%% %s' % (
+            name, base, r['value'], r['unit'], change * 100, mark
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='minicql benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help=', '.join(BENCHMARKS))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='server to use instead of the fake server')
+    parser.add_argument('--protocol-version', type=int, default=minicql.PROTOCOL_VERSION_V5)
+    parser.add_argument('--connects', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--inserts', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write results to the JSON file')
+    parser.add_argument('--compare', help='compare with results in the JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='ratio of the change taken as a regression')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+
+    server = None
+    if args.port is None:
+        server = fakecql.Server(args.host)
+        setup(server, args.rows)
+        args.port = server.port
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        for key, (value, unit, higher_is_better) in BENCHMARKS[name](args).items():
+            results[key] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+    if server:
+        server.close()
+
+    report = {
+        'minicql': minicql.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'server': 'fakecql' if server else '%s:%d' % (args.host, args.port),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    elif not args.output:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
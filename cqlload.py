@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+###############################################################################
+# MIT License
+#
+# Copyright (c) 2017,2020 Hajime Nakagami
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+###############################################################################
+# Bulk load CSV or JSON lines into a table (like cqlsh COPY FROM).
+#
+#   cqlload.py host[:port] keyspace.table data.csv [--columns id,name] [--user ...]
+#   cqlload.py host[:port] keyspace.table data.jsonl
+#
+# CSV files have a header line unless --columns is given, and JSON lines
+# files have an object per line. '-' reads the standard input.
+import sys
+import csv
+import json
+import time
+import decimal
+import itertools
+import argparse
+
+import minicql
+
+
+def _boolean(s):
+    return s.lower() in ('true', 't', 'yes', 'y', '1')
+
+
+def _blob(s):
+    return bytes.fromhex(s[2:] if s[:2].lower() == '0x' else s)
+
+
+# type code to the function converting a string, others are encoded from strings
+_PARSERS = {
+    0x0002: int, 0x0005: int, 0x0009: int, 0x0013: int, 0x0014: int, 0x000E: int,
+    0x0007: float, 0x0008: float, 0x0006: decimal.Decimal,
+    0x0004: _boolean, 0x0003: _blob,
+    0x0020: json.loads, 0x0021: json.loads, 0x0022: json.loads,
+}
+
+
+def parse_value(s, type_code, null=''):
+    "Convert a string of a file to the Python value of the CQL type"
+    if not isinstance(s, str):
+        return s
+    if s == null:
+        return None
+    parser = _PARSERS.get(type_code)
+    return parser(s) if parser else s
+
+
+def read_csv(f, columns=None, delimiter=','):
+    "Return columns and an iterator of rows"
+    reader = csv.reader(f, delimiter=delimiter)
+    if columns is None:
+        columns = next(reader)
+    return columns, reader
+
+
+def read_jsonl(f, columns=None):
+    "Return columns and an iterator of rows"
+    objects = (json.loads(line) for line in f if line.strip())
+    if columns is None:
+        first = next(objects, {})
+        columns = list(first)
+        objects = itertools.chain([first], objects)
+    return columns, ([d.get(c) for c in columns] for d in objects)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load CSV or JSON lines into a table')
+    parser.add_argument('server', help='host[:port]')
+    parser.add_argument('table', help='[keyspace.]table')
+    parser.add_argument('file', help="CSV or JSON lines file, or '-' for the standard input")
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='format of the file (default by the file name)')
+    parser.add_argument('--columns', help='comma separated columns of the rows')
+    parser.add_argument('--delimiter', default=',')
+    parser.add_argument('--null', default='', help='string of null values in CSV')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--single', action='store_true',
+                        help='load through one connection instead of token aware Cluster')
+    parser.add_argument('--batch-size', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--retries', type=int, default=3)
+    args = parser.parse_args()
+
+    server = args.server.split(':')
+    port = int(server[1]) if len(server) > 1 else 9042
+    keyspace, _, table = args.table.rpartition('.')
+    columns = args.columns.split(',') if args.columns else None
+    fmt = args.format or ('jsonl' if args.file.endswith(('.jsonl', '.json')) else 'csv')
+
+    if args.single:
+        target = minicql.connect(
+            server[0], keyspace or None, port=port, user=args.user, password=args.password
+        )
+    else:
+        target = minicql.Cluster(
+            server[0], keyspace or None, port=port, user=args.user, password=args.password,
+            watch_events=False
+        )
+    f = sys.stdin if args.file == '-' else open(args.file, newline='' if fmt == 'csv' else None)
+    if fmt == 'csv':
+        columns, rows = read_csv(f, columns, args.delimiter)
+    else:
+        columns, rows = read_jsonl(f, columns)
+    columns = [c.strip() for c in columns]
+
+    conn = target if args.single else target.control_connection
+    types = [p[1] for p in conn.prepare("INSERT INTO %s (%s) VALUES (%s)" % (
+        table, ', '.join(columns), ', '.join('?' * len(columns))
+    )).params]
+    rows = ([parse_value(v, t, args.null) for v, t in zip(row, types)] for row in rows)
+
+    def progress(n, seconds):
+        print('\r%d rows, %.0f rows/s' % (n, n / seconds if seconds else 0),
+              end='', file=sys.stderr, flush=True)
+    start = time.monotonic()
+    try:
+        n = minicql.bulk_load(
+            target, table, columns, rows, batch_size=args.batch_size,
+            concurrency=args.concurrency, retries=args.retries, progress=progress
+        )
+    finally:
+        print(file=sys.stderr)
+        target.close()
+        f.close()
+    seconds = time.monotonic() - start
+    print('%d rows loaded in %.3f seconds, %.0f rows/s' % (n, seconds, n / seconds if seconds else 0))
+
+
+if __name__ == '__main__':
+    main()
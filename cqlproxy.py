@@ -22,25 +22,28 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 ###############################################################################
+# CQL proxy which relays traffic between clients and a server,
+# and collects latency histograms per opcode and per query.
+#
+#   cqlproxy.py server[:port] [listen_host:]listen_port [--interval 60] [--verbose]
+#       [--capture capture.log]
+#
+# Statistics are printed at the interval, on SIGUSR1 and at exit.
+# Frames are written to the capture file to be replayed by cqlreplay.py.
 import sys
-import os
-import socket
+import math
+import struct
+import itertools
+import signal
+import asyncio
+import argparse
 import binascii
-import threading
-import datetime
+import collections
+import time
 
 import minicql
 
 
-def _recv_from_sock(sock, nbytes):
-    n = nbytes
-    recieved = b''
-    while n:
-        bs = sock.recv(n)
-        recieved += bs
-        n -= len(bs)
-    return recieved
-
 OPCODE = {
     0x00: 'ERROR',
     0x01: 'STARTUP',
@@ -61,120 +64,369 @@ OPCODE = {
 }
 
 
-def read_frame(sock):
-    header = _recv_from_sock(sock, 9)
-    stream = int.from_bytes(header[2:4], byteorder='big')
-    ln = int.from_bytes(header[-4:], byteorder='big')
-    body = _recv_from_sock(sock, ln)
-    opcode = OPCODE[header[4]]
-    if header[0] == 0x04:
-        version = 'C->S'
-    elif header[0] == 0x84:
-        version = 'S->C'
-    else:
-        version = hex(header[0])
-    print('%s:flags=%d:stream=%d:%s:len=%d' % (version, header[1], stream, opcode, ln), end=' ')
+def describe_frame(header, body):
+    "Return a line describing the frame"
+    stream = int.from_bytes(header[2:4], byteorder='big', signed=True)
+    opcode = OPCODE.get(header[4], hex(header[4]))
+    version = header[0] & 0x7F
+    direction = 'S->C' if header[0] & 0x80 else 'C->S'
+    line = '%s:v%d:flags=%d:stream=%d:%s:len=%d ' % (
+        direction, version, header[1], stream, opcode, len(body)
+    )
     if opcode == 'ERROR':
         n, b = minicql.decode_int(body)
         s, b = minicql.decode_string(b)
-        print('%s:"%s"' % (hex(n), s))
-    elif opcode == 'STARTUP':
+        line += '%s:"%s"' % (hex(n), s)
+    elif opcode in ('STARTUP', ):
         d, b = minicql.decode_string_map(body)
-        print(d)
+        line += str(d)
     elif opcode == 'AUTHENTICATE':
         s, _ = minicql.decode_string(body)
-        print(binascii.b2a_hex(body).decode('utf-8'), s)
+        line += s
     elif opcode == 'SUPPORTED':
         d, b = minicql.decode_string_multimap(body)
-        print(d)
+        line += str(d)
     elif opcode == 'QUERY':
         query, b = minicql.decode_long_string(body)
-        consistency = int.from_bytes(b[:2], byteorder='big')
-        flags = b[2]
-        b = b[3:]
-        print("query=%s,consistency=%d,flags=%s" % (
-            query, consistency, hex(flags)
-        ), binascii.b2a_hex(b).decode('utf-8'))
+        d = minicql.Decoder(b)
+        consistency = d.short()
+        if version >= minicql.PROTOCOL_VERSION_V5:
+            flags = d.int()
+        else:
+            flags = d.buf[d.pos]
+            d.pos += 1
+        line += "query=%s,consistency=%d,flags=%s" % (query, consistency, hex(flags))
         if flags & 0x01:
-            num_params = int.from_bytes(b[:2], byteorder='big')
-            b = b[2:]
+            line += ',values=%d' % len([d.bytes() for i in range(d.short())])
         if flags & 0x04:
-            result_page_size = int.from_bytes(b[:2], byteorder='big')
-            b = b[2:]
-            print('result_page_size=', result_page_size)
+            line += ',result_page_size=%d' % d.int()
         if flags & 0x08:
-            paging_state = b[:2]
-            b = b[2:]
-            print('page_state=', binascii.b2a_hex(serial_consistency).decode('utf-8'))
+            line += ',paging_state=%s' % binascii.b2a_hex(d.bytes()).decode('utf-8')
         if flags & 0x10:
-            serial_consistency = int.from_bytes(b[:2], byteorder='big')
-            b = b[2:]
-            print('serial_consistency=', serial_consistency)
+            line += ',serial_consistency=%d' % d.short()
         if flags & 0x20:
-            t = b[:8]
-            b = b[8:]
-            print('timestamp=', t)
+            line += ',timestamp=%d' % int.from_bytes(d.buf[d.pos:d.pos+8], 'big', signed=True)
+            d.pos += 8
+        if flags & 0x80:
+            line += ',keyspace=%s' % d.string()
     elif opcode == 'RESULT':
         kind, b = minicql.decode_int(body)
-        if kind == 2:
-            description, data, more_data = minicql.decode_rows(body)
-            print(description)
-            print(data)
-            print(more_data)
+        if kind == 2 and minicql.decode_int(b)[0] & 0x0004:    # No_metadata
+            line += 'rows (no metadata)'
+        elif kind == 2:
+            description, data, paging_state = minicql.decode_rows(body)
+            line += '%s rows=%d paging_state=%s' % (
+                [c[0] for c in description], len(data), binascii.b2a_hex(paging_state).decode('utf-8')
+            )
         else:
-            print('kind=%d' % (kind,))
-            print(b)
+            line += 'kind=%d' % (kind,)
+    elif opcode == 'PREPARE':
+        query, b = minicql.decode_long_string(body)
+        line += 'query=%s' % (query, )
+    elif opcode == 'EXECUTE':
+        query_id, b = minicql.decode_short_bytes(body)
+        line += 'id=%s' % (binascii.b2a_hex(query_id).decode('utf-8'), )
     elif opcode == 'REGISTER':
         r, b = minicql.decode_string_list(body)
-        print(r)
+        line += str(r)
+    elif opcode == 'EVENT':
+        line += str(minicql.decode_event(body))
     elif opcode == 'AUTH_RESPONSE':
-        u, p = body[5:].split(b'\x00')
-        print(binascii.b2a_hex(body).decode('utf-8'), end=' ')
-        print("user={},password={}".format(u.decode('utf-8'), p.decode('utf-8')))
+        line += 'user=%s' % bytes(body[5:]).split(b'\x00')[0].decode('utf-8')
     else:
-        print(binascii.b2a_hex(body).decode('utf-8'))
-    return header + body
+        line += binascii.b2a_hex(body[:64]).decode('utf-8')
+    return line
 
 
-def relay_packets(client_sock, server_sock):
-    while True:
-        b = read_frame(client_sock)
-        server_sock.send(b)
-        b = read_frame(server_sock)
-        client_sock.send(b)
+class Histogram:
+    "Latency histogram with 4 buckets per power of 2 microseconds"
+    __slots__ = ('count', 'total', 'max', 'errors', 'buckets')
 
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.buckets = collections.Counter()
 
-def proxy_wire(server_name, server_port, listen_host, listen_port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind((listen_host, listen_port))
-    sock.listen(1)
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.errors += error
+        self.buckets[max(0, int(math.log2(max(seconds * 1e6, 1)) * 4))] += 1
 
-    while True:
-        client_sock, addr = sock.accept()
-        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sock.connect((server_name, server_port))
-        threading.Thread(target=relay_packets, args=(client_sock, server_sock)).start()
+    def percentile(self, p):
+        "Return upper bound seconds of the bucket at p percentile"
+        n = self.count * p / 100
+        for i in sorted(self.buckets):
+            n -= self.buckets[i]
+            if n <= 0:
+                return min(2 ** ((i + 1) / 4) / 1e6, self.max)
+        return self.max
 
+    def to_dict(self):
+        return {
+            'count': self.count, 'errors': self.errors, 'total': self.total, 'max': self.max,
+            'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+        }
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('Usage : ' + sys.argv[0] + ' server[:port] [listen_host:]listen_port')
-        sys.exit()
-
-    server = sys.argv[1].split(':')
-    server_name = server[0]
-    if len(server) == 1:
-        server_port = 9042
-    else:
-        server_port = int(server[1])
 
-    listen = sys.argv[2].split(':')
+class Stats:
+    def __init__(self):
+        self.total = Histogram()
+        self.opcodes = collections.defaultdict(Histogram)
+        self.queries = collections.defaultdict(Histogram)
+        self.prepared = {}      # query id to query
+
+    def add(self, opcode, query, seconds, error):
+        self.total.add(seconds, error)
+        self.opcodes[opcode].add(seconds, error)
+        if query:
+            self.queries[query].add(seconds, error)
+
+    def report(self, top=20):
+        lines = ['%-12s %8s %6s %9s %9s %9s %9s %9s' % (
+            'opcode', 'count', 'errors', 'mean(ms)', 'p50', 'p90', 'p99', 'max'
+        )]
+        for name, h in sorted(self.opcodes.items()) + [('ALL', self.total)]:
+            if not h.count:
+                continue
+            lines.append('%-12s %8d %6d %9.3f %9.3f %9.3f %9.3f %9.3f' % (
+                name, h.count, h.errors, h.total / h.count * 1e3, h.percentile(50) * 1e3,
+                h.percentile(90) * 1e3, h.percentile(99) * 1e3, h.max * 1e3
+            ))
+        lines.append('%9s %8s %9s %9s %9s  %s' % ('total(s)', 'count', 'mean(ms)', 'p99', 'max', 'query'))
+        for query, h in sorted(self.queries.items(), key=lambda e: -e[1].total)[:top]:
+            lines.append('%9.3f %8d %9.3f %9.3f %9.3f  %s' % (
+                h.total, h.count, h.total / h.count * 1e3, h.percentile(99) * 1e3, h.max * 1e3,
+                ' '.join(query.split())[:200]
+            ))
+        return '\n'.join(lines)
+
+
+class FrameReader:
+    "Split bytes of one direction into frames, following v5 segments and compression"
+    def __init__(self):
+        self.buf = bytearray()
+        self.envelopes = bytearray()
+        self.framing = False
+        self.compression = None
+
+    def _segment(self):
+        "Move a segment payload from buf to envelopes. Return False if it is incomplete"
+        header_length = 8 if self.compression else 6
+        if len(self.buf) < header_length:
+            return False
+        ln, uncompressed_length = minicql.decode_segment_header(bytes(self.buf[:header_length]))
+        if len(self.buf) < header_length + ln + 4:
+            return False
+        self.envelopes += minicql.decode_segment_payload(
+            bytes(self.buf[header_length:header_length+ln+4]), uncompressed_length,
+            minicql.lz4_decompress_block
+        )
+        del self.buf[:header_length+ln+4]
+        return True
+
+    def feed(self, data):
+        "Yield (header, body) of complete frames"
+        self.buf += data
+        while True:
+            buf = self.envelopes if self.framing else self.buf
+            if len(buf) < 9 or len(buf) < 9 + int.from_bytes(buf[5:9], 'big'):
+                if self.framing and self._segment():
+                    continue
+                return
+            ln = 9 + int.from_bytes(buf[5:9], 'big')
+            header, body = bytes(buf[:9]), bytes(buf[9:ln])
+            del buf[:ln]
+            if header[1] & minicql.COMPRESSION_FLAG and self.compression:
+                body = minicql.COMPRESSIONS[self.compression][1](body)
+            yield header, body
+
+
+# capture file is the magic and records of
+# (time, connection id) + frame with the uncompressed body
+CAPTURE_MAGIC = b'CQLCAP\x01\n'
+CAPTURE_RECORD = struct.Struct('>dI')
+
+
+class Capture:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.connection_ids = itertools.count(1)
+
+    def write(self, connection_id, header, body):
+        header = bytes([header[0], header[1] & ~minicql.COMPRESSION_FLAG]) + header[2:5] + \
+            len(body).to_bytes(4, byteorder='big')
+        self.file.write(CAPTURE_RECORD.pack(time.time(), connection_id) + header + body)
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    "Yield (time, connection id, header, body) from the capture file"
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('%s is not a capture file' % (path, ))
+        while True:
+            b = f.read(CAPTURE_RECORD.size + 9)
+            if len(b) < CAPTURE_RECORD.size + 9:
+                return
+            t, connection_id = CAPTURE_RECORD.unpack(b[:CAPTURE_RECORD.size])
+            header = b[CAPTURE_RECORD.size:]
+            yield t, connection_id, header, f.read(int.from_bytes(header[5:9], 'big'))
+
+
+class Session:
+    "Matches requests and responses of a client connection by stream id"
+    def __init__(self, stats, verbose=False, capture=None):
+        self.stats = stats
+        self.verbose = verbose
+        self.capture = capture
+        if capture:
+            self.connection_id = next(capture.connection_ids)
+        self.requests = FrameReader()
+        self.responses = FrameReader()
+        self.pending = {}       # stream: (start time, opcode, query)
+
+    def on_request(self, header, body, now):
+        if self.verbose:
+            print(describe_frame(header, body))
+        if self.capture:
+            self.capture.write(self.connection_id, header, body)
+        stream = int.from_bytes(header[2:4], byteorder='big', signed=True)
+        opcode = header[4]
+        query = None
+        if opcode == minicql.OP_STARTUP:
+            compression = minicql.decode_string_map(body)[0].get('COMPRESSION')
+            self.requests.compression = self.responses.compression = compression
+        elif opcode in (minicql.OP_QUERY, minicql.OP_PREPARE):
+            query, _ = minicql.decode_long_string(body)
+        elif opcode == minicql.OP_EXECUTE:
+            query_id, _ = minicql.decode_short_bytes(body)
+            query = self.stats.prepared.get(bytes(query_id), 'EXECUTE ' + bytes(query_id).hex())
+        self.pending[stream] = (now, OPCODE.get(opcode, hex(opcode)), query)
+
+    def on_response(self, header, body, now):
+        if self.capture:
+            self.capture.write(self.connection_id, header, body)
+        if header[1] & (minicql.TRACING_FLAG | minicql.WARNING_FLAG | minicql.CUSOM_PAYLOAD_FLAG):
+            _, _, body = minicql.decode_frame_prefix(header[1], body)
+        if self.verbose:
+            print(describe_frame(header, body))
+        stream = int.from_bytes(header[2:4], byteorder='big', signed=True)
+        opcode = header[4]
+        if opcode in (minicql.OP_READY, minicql.OP_AUTHENTICATE) and \
+                header[0] & 0x7F >= minicql.PROTOCOL_VERSION_V5:
+            # frames after the response to STARTUP are in segments
+            self.requests.framing = self.responses.framing = True
+        request = self.pending.pop(stream, None)
+        if request is None:     # EVENT
+            return
+        start, request_opcode, query = request
+        if request_opcode == 'PREPARE' and opcode == minicql.OP_RESULT:
+            d = minicql.Decoder(body)
+            if d.int() == 4:
+                self.stats.prepared[bytes(d.short_bytes())] = query
+            query = 'PREPARE ' + query
+        self.stats.add(request_opcode, query, now - start, opcode == minicql.OP_ERROR)
+
+
+async def relay(reader, writer, frames, on_frame):
+    "Forward bytes as they arrive, then parse frames from them"
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            now = time.perf_counter()
+            try:
+                for header, body in frames and frames.feed(data) or ():
+                    on_frame(header, body, now)
+            except Exception as e:
+                # keep relaying without statistics
+                print('cqlproxy: stop parsing frames: %r' % (e, ), file=sys.stderr)
+                frames = None
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def proxy(server_name, server_port, listen_host, listen_port, stats, verbose=False, capture=None):
+    async def on_client(client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(server_name, server_port)
+        except OSError:
+            client_writer.close()
+            return
+        session = Session(stats, verbose, capture)
+        await asyncio.gather(
+            relay(client_reader, server_writer, session.requests, session.on_request),
+            relay(server_reader, client_writer, session.responses, session.on_response),
+        )
+    return await asyncio.start_server(on_client, listen_host, listen_port)
+
+
+async def main(args):
+    stats = Stats()
+    capture = Capture(args.capture) if args.capture else None
+    server = await proxy(
+        args.server_name, args.server_port, args.listen_host, args.listen_port, stats,
+        args.verbose, capture
+    )
+
+    def dump():
+        print(stats.report(args.top), flush=True)
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, 'SIGUSR1'):
+        loop.add_signal_handler(signal.SIGUSR1, dump)
+    try:
+        async with server:
+            if args.interval:
+                while True:
+                    await asyncio.sleep(args.interval)
+                    dump()
+            else:
+                await server.serve_forever()
+    finally:
+        dump()
+        if capture:
+            capture.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='CQL proxy')
+    parser.add_argument('server', help='server[:port]')
+    parser.add_argument('listen', help='[listen_host:]listen_port')
+    parser.add_argument('--interval', type=float, help='print statistics every seconds')
+    parser.add_argument('--top', type=int, default=20, help='number of queries to print')
+    parser.add_argument('--verbose', action='store_true', help='print frames')
+    parser.add_argument('--capture', help='write frames to the file')
+    args = parser.parse_args(argv)
+
+    server = args.server.split(':')
+    args.server_name = server[0]
+    args.server_port = int(server[1]) if len(server) > 1 else 9042
+    listen = args.listen.split(':')
     if len(listen) == 1:
-        listen_host = 'localhost'
-        listen_port = int(listen[0])
+        args.listen_host = 'localhost'
+        args.listen_port = int(listen[0])
     else:
-        listen_host = listen[0]
-        listen_port = int(listen[1])
+        args.listen_host = listen[0]
+        args.listen_port = int(listen[1])
+    return args
 
-    print(server_name, server_port, listen_host, listen_port)
-    proxy_wire(server_name, server_port, listen_host, listen_port)
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(args.server_name, args.server_port, args.listen_host, args.listen_port)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
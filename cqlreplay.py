@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+###############################################################################
+# MIT License
+#
+# Copyright (c) 2017,2020 Hajime Nakagami
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+###############################################################################
+# Replay client frames captured by cqlproxy.py --capture to a server
+# as a load generator.
+#
+#   cqlreplay.py capture.log server[:port] [--speed 2] [--max] [--concurrency 128]
+#
+# Each captured connection is replayed on its own connection.
+# Requests are sent at the captured times divided by --speed, or as fast as
+# --concurrency in flight requests per connection allow with --max.
+# Stream ids and prepared statement ids are rewritten.
+import sys
+import time
+import asyncio
+import argparse
+import collections
+
+import minicql
+import cqlproxy
+
+# requests which wait for their responses before the next request
+SYNC_OPCODES = (
+    minicql.OP_STARTUP, minicql.OP_OPTIONS, minicql.OP_AUTH_RESPONSE, minicql.OP_PREPARE,
+    minicql.OP_REGISTER,
+)
+
+
+def load_capture(path):
+    "Return {connection id: [(time, header, body, prepared query id)]} of requests"
+    connections = collections.defaultdict(list)
+    prepares = {}   # (connection id, stream): request
+    for t, connection_id, header, body in cqlproxy.read_capture(path):
+        stream = header[2:4]
+        if not header[0] & 0x80:
+            request = [t, header, body, None]
+            connections[connection_id].append(request)
+            if header[4] == minicql.OP_PREPARE:
+                prepares[connection_id, stream] = request
+        elif header[4] == minicql.OP_RESULT and (connection_id, stream) in prepares:
+            d = minicql.Decoder(body)
+            if d.int() == 4:
+                prepares[connection_id, stream][3] = bytes(d.short_bytes())
+            del prepares[connection_id, stream]
+    return connections
+
+
+class Replayer:
+    def __init__(self, host, port, stats, speed=1.0, concurrency=128):
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.speed = speed
+        self.concurrency = concurrency
+        self.prepared = {}      # captured query id: (query id, result metadata id)
+
+    def rewrite(self, header, body):
+        "Adjust a captured request to the connection to the server"
+        opcode = header[4]
+        if opcode == minicql.OP_STARTUP:
+            # bodies are captured uncompressed
+            options, _ = minicql.decode_string_map(body)
+            options.pop('COMPRESSION', None)
+            body = minicql.encode_string_map(options)
+        elif opcode == minicql.OP_EXECUTE:
+            d = minicql.Decoder(body)
+            query_id = bytes(d.short_bytes())
+            if header[0] >= minicql.PROTOCOL_VERSION_V5:
+                d.short_bytes()
+            if query_id in self.prepared:
+                query_id, result_metadata_id = self.prepared[query_id]
+                b = minicql.encode_integer(len(query_id), 2) + query_id
+                if header[0] >= minicql.PROTOCOL_VERSION_V5:
+                    b += minicql.encode_integer(len(result_metadata_id), 2) + result_metadata_id
+                body = b + body[d.pos:]
+        elif opcode == minicql.OP_BATCH:
+            body = self.rewrite_batch(body)
+        return body
+
+    def rewrite_batch(self, body):
+        "Rewrite prepared query ids of the statements in a BATCH body"
+        d = minicql.Decoder(body, 1)    # after the batch type
+        n = d.short()
+        parts = [body[:d.pos]]
+        start = d.pos
+        for i in range(n):
+            kind = d.buf[d.pos]
+            d.pos += 1
+            if kind == 0:   # query string
+                ln = d.int()
+                d.pos += ln
+            else:           # prepared query id
+                id_start = d.pos
+                query_id = bytes(d.short_bytes())
+                if query_id in self.prepared:
+                    parts.append(body[start:id_start])
+                    query_id = self.prepared[query_id][0]
+                    parts.append(minicql.encode_integer(len(query_id), 2) + query_id)
+                    start = d.pos
+            for j in range(d.short()):
+                d.bytes()
+        parts.append(body[start:])
+        return b''.join(parts)
+
+    async def replay(self, requests, start):
+        "Replay requests of a captured connection"
+        loop = asyncio.get_running_loop()
+        session = cqlproxy.Session(self.stats)
+        origin = requests[0][0]
+        if self.speed:
+            await asyncio.sleep(start + (origin - self.origin) / self.speed - loop.time())
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        streams = asyncio.Queue()
+        for i in range(self.concurrency):
+            streams.put_nowait(i)
+        waiters = {}
+
+        async def read():
+            try:
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                    now = time.perf_counter()
+                    for header, body in session.responses.feed(data):
+                        session.on_response(header, body, now)
+                        stream = int.from_bytes(header[2:4], byteorder='big', signed=True)
+                        if stream in waiters:
+                            waiters.pop(stream).set_result((header, body))
+                            streams.put_nowait(stream)
+            except OSError:
+                pass
+            # fail the in flight requests and give their streams back,
+            # so that the sender doesn't wait for them
+            for stream, waiter in waiters.items():
+                waiter.set_exception(ConnectionError('connection closed'))
+                streams.put_nowait(stream)
+        reader_task = asyncio.create_task(read())
+
+        try:
+            for t, header, body, captured_id in requests:
+                if self.speed:
+                    await asyncio.sleep(start + (t - self.origin) / self.speed - loop.time())
+                stream = await streams.get()
+                if reader_task.done():
+                    raise ConnectionError('connection closed')
+                body = self.rewrite(header, body)
+                header = header[:2] + stream.to_bytes(2, byteorder='big') + header[4:5] + \
+                    len(body).to_bytes(4, byteorder='big')
+                waiter = waiters[stream] = loop.create_future()
+                session.on_request(header, body, time.perf_counter())
+                if session.responses.framing:
+                    writer.write(b''.join(minicql.encode_segments([header + body])))
+                else:
+                    writer.write(header + body)
+                if header[4] in SYNC_OPCODES or (
+                    header[4] == minicql.OP_QUERY and
+                    minicql.decode_long_string(body)[0].strip().lower().startswith('use ')
+                ):
+                    response_header, response_body = await waiter
+                    if header[4] == minicql.OP_PREPARE and response_header[4] == minicql.OP_RESULT:
+                        query_id, _, _, _, result_metadata_id = minicql.decode_prepared(
+                            response_body, response_header[0] & 0x7F
+                        )
+                        self.prepared[captured_id] = (query_id, result_metadata_id)
+                await writer.drain()
+            # wait for in flight requests, which fail if the connection is closed
+            await asyncio.gather(*waiters.values())
+        finally:
+            writer.close()
+            reader_task.cancel()
+            for waiter in waiters.values():
+                if waiter.done() and not waiter.cancelled():
+                    waiter.exception()  # raised once by the sender
+
+    async def run(self, connections):
+        "Replay all connections and return elapsed seconds"
+        self.origin = min(requests[0][0] for requests in connections.values())
+        start = asyncio.get_running_loop().time()
+        results = await asyncio.gather(
+            *[self.replay(requests, start) for requests in connections.values()],
+            return_exceptions=True
+        )
+        for r in results:
+            if isinstance(r, Exception):
+                print('cqlreplay: %r' % (r, ), file=sys.stderr)
+        return asyncio.get_running_loop().time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a CQL capture')
+    parser.add_argument('capture', help='file written by cqlproxy.py --capture')
+    parser.add_argument('server', help='server[:port]')
+    parser.add_argument('--speed', type=float, default=1.0, help='multiple of the captured speed')
+    parser.add_argument('--max', action='store_true', help='send without waiting for captured times')
+    parser.add_argument('--concurrency', type=int, default=128,
+                        help='in flight requests per connection')
+    parser.add_argument('--top', type=int, default=20, help='number of queries to print')
+    args = parser.parse_args()
+    if not 0 < args.concurrency <= 32768:
+        parser.error('--concurrency must be in 1..32768')
+    server = args.server.split(':')
+    port = int(server[1]) if len(server) > 1 else 9042
+
+    connections = load_capture(args.capture)
+    if not connections:
+        parser.error('no requests in %s' % (args.capture, ))
+    stats = cqlproxy.Stats()
+    replayer = Replayer(server[0], port, stats, 0 if args.max else args.speed, args.concurrency)
+    elapsed = asyncio.run(replayer.run(connections))
+
+    print(stats.report(args.top))
+    print('%d connections, %d requests, %d errors in %.3f seconds, %.1f requests/s' % (
+        len(connections), stats.total.count, stats.total.errors, elapsed,
+        stats.total.count / elapsed if elapsed else 0
+    ))
+
+
+if __name__ == '__main__':
+    main()
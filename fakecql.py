@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+###############################################################################
+# MIT License
+#
+# Copyright (c) 2017,2020 Hajime Nakagami
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+###############################################################################
+# Fake CQL server for tests and benchmarks.
+# It speaks the part of the native protocol (v4 and v5) minicql uses,
+# and serves synthetic tables.
+#
+#   server = fakecql.Server()
+#   server.add_table('test', [('id', 'int'), ('s', 'text')], 1000)
+#   conn = minicql.connect('127.0.0.1', port=server.port)
+#
+# or run standalone: python fakecql.py [port]
+import sys
+import re
+import struct
+import hashlib
+import time
+import socket
+import threading
+import socketserver
+import datetime
+import uuid
+
+import minicql
+
+
+def parse_type(name):
+    "Return (type_code, sub_type) of a type name like 'int' or 'list<text>'"
+    name = name.strip().lower()
+    m = re.match(r'(list|set)<(.+)>$', name)
+    if m:
+        return (0x0020 if m.group(1) == 'list' else 0x0022), parse_type(m.group(2))
+    return minicql.TYPE_CODES[name], None
+
+
+def encode_type_option(type_code, sub_type=None):
+    b = minicql.encode_integer(type_code, 2)
+    if type_code in (0x0020, 0x0022):
+        b += encode_type_option(*sub_type)
+    return b
+
+
+def synthetic_value(i, type_code, sub_type=None):
+    "Return a python value of the type for the i-th row"
+    if type_code == 0x0020:
+        return [synthetic_value(i + j, *sub_type) for j in range(3)]
+    elif type_code == 0x0022:
+        return {synthetic_value(i + j, *sub_type) for j in range(3)}
+    elif type_code in (0x0001, 0x000D):
+        return 'row%d' % i
+    elif type_code in (0x0002, 0x0005, 0x000E):
+        return i * 1000003
+    elif type_code in (0x0009, 0x0013, 0x0014):
+        return i % 128
+    elif type_code == 0x0003:
+        return b'%08d' % i
+    elif type_code == 0x0004:
+        return i % 2 == 0
+    elif type_code == 0x0006:
+        return '%d.%02d' % (i, i % 100)
+    elif type_code in (0x0007, 0x0008):
+        return i / 4
+    elif type_code == 0x000B:
+        return datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=i)
+    elif type_code in (0x000C, 0x000F):
+        return uuid.UUID(int=i)
+    elif type_code == 0x0010:
+        return '10.0.%d.%d' % (i // 256 % 256, i % 256)
+    elif type_code == 0x0011:
+        return datetime.date(2020, 1, 1) + datetime.timedelta(days=i % 1000)
+    elif type_code == 0x0012:
+        return datetime.time(i // 3600 % 24, i // 60 % 60, i % 60)
+    raise minicql.NotSupportedError()
+
+
+# "token(pk) > start AND token(pk) <= end" of a scan
+TOKEN_RANGE_RE = re.compile(
+    r'token\s*\([^)]*\)\s*>\s*(\?|-?\d+)\s+and\s+token\s*\([^)]*\)\s*<=\s*(\?|-?\d+)'
+)
+
+
+class Table:
+    def __init__(self, name, columns, rows):
+        "columns are [(name, type name)], rows are python values or number of synthetic rows"
+        self.name = name
+        self.columns = [(column_name, *parse_type(t)) for column_name, t in columns]
+        if isinstance(rows, int):
+            rows = [
+                [synthetic_value(i, type_code, sub_type) for _, type_code, sub_type in self.columns]
+                for i in range(rows)
+            ]
+        self.rows = [
+            [minicql.encode_value(v, type_code, sub_type) for v, (_, type_code, sub_type) in zip(
+                row, self.columns
+            )] for row in rows
+        ]
+        self.metadata_id = hashlib.md5(repr(self.columns).encode()).digest()
+        self._tokens = None
+
+    def tokens(self):
+        "Return Murmur3 tokens of rows, with the first column as the partition key"
+        if self._tokens is None:
+            self._tokens = [minicql.murmur3(row[0]) for row in self.rows]
+        return self._tokens
+
+    def selected(self, query):
+        "Return indexes of columns selected by the query, or None for all columns"
+        m = re.match(r'\s*select\s+(.+?)\s+from\s', query, re.IGNORECASE | re.DOTALL)
+        names = [name.strip() for name in m.group(1).split(',')] if m else ['*']
+        column_names = [c[0] for c in self.columns]
+        if names == ['*'] or not all(name in column_names for name in names):
+            return None
+        return [column_names.index(name) for name in names]
+
+    def column(self, name):
+        if name.startswith('token'):
+            return ('partition key token', 0x0002, None)
+        for column in self.columns:
+            if column[0] == name:
+                return column
+        return (name, 0x000D, None)
+
+
+def encode_metadata(keyspace, table, columns, paging_state=None, skip_metadata=False):
+    flags = 0x0001      # Global_tables_spec
+    if paging_state is not None:
+        flags |= 0x0002
+    if skip_metadata:
+        flags |= 0x0004
+    parts = [struct.pack('>ii', flags, len(columns))]
+    if paging_state is not None:
+        parts.append(minicql.encode_bytes(paging_state))
+    if not skip_metadata:
+        parts.append(minicql.encode_string(keyspace) + minicql.encode_string(table))
+        for name, type_code, sub_type in columns:
+            parts.append(minicql.encode_string(name) + encode_type_option(type_code, sub_type))
+    return b''.join(parts)
+
+
+def encode_rows(keyspace, table, columns, rows, paging_state=None, skip_metadata=False):
+    "Return body of Rows RESULT"
+    parts = [
+        struct.pack('>i', 2),
+        encode_metadata(keyspace, table, columns, paging_state, skip_metadata),
+        struct.pack('>i', len(rows)),
+    ]
+    for row in rows:
+        parts.extend(minicql.encode_bytes(v) for v in row)
+    return b''.join(parts)
+
+
+def encode_error(code, message):
+    return struct.pack('>i', code) + minicql.encode_string(message)
+
+
+def decode_long_string(d):
+    ln = d.int()
+    d.pos += ln
+    return str(d.buf[d.pos-ln:d.pos], 'utf-8')
+
+
+def decode_query_parameters(d, version):
+    "Return dict of query parameters read by minicql.Decoder d"
+    consistency = d.short()
+    if version >= minicql.PROTOCOL_VERSION_V5:
+        flags = d.int()
+    else:
+        flags = d.buf[d.pos]
+        d.pos += 1
+    params = {'consistency': consistency, 'flags': flags, 'values': []}
+    if flags & 0x01:
+        params['values'] = [d.bytes() for i in range(d.short())]
+    if flags & 0x04:
+        params['page_size'] = d.int()
+    if flags & 0x08:
+        params['paging_state'] = bytes(d.bytes())
+    if flags & 0x10:
+        d.short()
+    if flags & 0x20:
+        d.pos += 8
+    if flags & 0x80:
+        params['keyspace'] = d.string()
+    return params
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.version = None
+        self.framing = False
+        self.compression = None
+        self.keyspace = None
+        self._envelopes = bytearray()
+        self._write_lock = threading.Lock()
+        with self.server.lock:
+            self.server.handlers.add(self)
+
+    def _recv(self, n):
+        b = bytearray()
+        while len(b) < n:
+            r = self.request.recv(n - len(b))
+            if not r:
+                raise EOFError()
+            b += r
+        return bytes(b)
+
+    def _read_envelope(self):
+        if not self.framing:
+            header = self._recv(9)
+            return header, self._recv(int.from_bytes(header[5:], 'big'))
+        envelopes = self._envelopes
+        while len(envelopes) < 9 or len(envelopes) < 9 + int.from_bytes(envelopes[5:9], 'big'):
+            decompress = minicql.lz4_decompress_block if self.compression else None
+            ln, uncompressed_length = minicql.decode_segment_header(
+                self._recv(8 if decompress else 6)
+            )
+            envelopes += minicql.decode_segment_payload(
+                self._recv(ln + 4), uncompressed_length, decompress
+            )
+        ln = 9 + int.from_bytes(envelopes[5:9], 'big')
+        header, body = bytes(envelopes[:9]), bytes(envelopes[9:ln])
+        del envelopes[:ln]
+        return header, body
+
+    def send(self, stream, opcode, body, flags=0):
+        if self.compression and not self.framing and len(body) > 512:
+            body = minicql.COMPRESSIONS[self.compression][0](body)
+            flags |= minicql.COMPRESSION_FLAG
+        envelope = struct.pack(
+            '>BBhBL', 0x80 | self.version, flags, stream, opcode, len(body)
+        ) + body
+        if self.framing:
+            compress = minicql.lz4_compress_block if self.compression else None
+            envelope = b''.join(minicql.encode_segments([envelope], compress, 512))
+        with self._write_lock:
+            self.request.sendall(envelope)
+
+    def handle(self):
+        try:
+            while True:
+                header, body = self._read_envelope()
+                version, flags, stream, opcode, _ = struct.unpack('>BBhBL', header)
+                if self.version is None:
+                    if version > self.server.max_version:
+                        self.version = self.server.max_version
+                        self.send(stream, minicql.OP_ERROR, encode_error(
+                            0x000A, "Invalid or unsupported protocol version (%d)" % version
+                        ))
+                        return
+                    self.version = version
+                if flags & minicql.COMPRESSION_FLAG:
+                    body = minicql.COMPRESSIONS[self.compression][1](body)
+                with self.server.lock:
+                    self.server.requests += 1
+                try:
+                    opcode, body = self.dispatch(opcode, body)
+                except minicql.OperationalError as e:
+                    opcode, body = minicql.OP_ERROR, encode_error(e.code, e.message)
+                response_flags = 0
+                if opcode == minicql.OP_RESULT:
+                    if self.server.warnings:
+                        body = minicql.encode_string_list(self.server.warnings) + body
+                        response_flags |= minicql.WARNING_FLAG
+                    if flags & minicql.TRACING_FLAG:
+                        body = uuid.uuid1().bytes + body
+                        response_flags |= minicql.TRACING_FLAG
+                self.send(stream, opcode, body, response_flags)
+                if opcode in (minicql.OP_READY, minicql.OP_AUTHENTICATE):
+                    # v5 frames after the response to STARTUP are in segments
+                    self.framing = self.version >= minicql.PROTOCOL_VERSION_V5
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.server.lock:
+                self.server.handlers.discard(self)
+                if self in self.server.listeners:
+                    self.server.listeners.remove(self)
+
+    def dispatch(self, opcode, body):
+        "Return opcode and body of the response"
+        if opcode == minicql.OP_OPTIONS:
+            d = {'CQL_VERSION': ['3.4.5'], 'COMPRESSION': list(minicql.COMPRESSIONS)}
+            b = minicql.encode_integer(len(d), 2)
+            for k, v in d.items():
+                b += minicql.encode_string(k) + minicql.encode_string_list(v)
+            return minicql.OP_SUPPORTED, b
+        elif opcode == minicql.OP_STARTUP:
+            options, _ = minicql.decode_string_map(body)
+            self.compression = options.get('COMPRESSION')
+            if self.server.user:
+                return minicql.OP_AUTHENTICATE, minicql.encode_string(
+                    'org.apache.cassandra.auth.PasswordAuthenticator'
+                )
+            return minicql.OP_READY, b''
+        elif opcode == minicql.OP_AUTH_RESPONSE:
+            token = bytes(minicql.Decoder(body).bytes())
+            if token != minicql.encode_auth_response(
+                self.server.user, self.server.password
+            )[4:]:
+                raise minicql.OperationalError(0x0100, "Bad credentials")
+            return minicql.OP_AUTH_SUCCESS, struct.pack('>i', -1)
+        elif opcode == minicql.OP_QUERY:
+            d = minicql.Decoder(body)
+            query = decode_long_string(d)
+            return minicql.OP_RESULT, self.query(query, decode_query_parameters(d, self.version))
+        elif opcode == minicql.OP_PREPARE:
+            query, _ = minicql.decode_long_string(body)
+            return minicql.OP_RESULT, self.prepare(query)
+        elif opcode == minicql.OP_EXECUTE:
+            d = minicql.Decoder(body)
+            query_id = bytes(d.short_bytes())
+            if self.version >= minicql.PROTOCOL_VERSION_V5:
+                d.short_bytes()     # result_metadata_id
+            if query_id not in self.server.prepared:
+                raise minicql.OperationalError(0x2500, "Prepared query not found")
+            return minicql.OP_RESULT, self.query(
+                self.server.prepared[query_id], decode_query_parameters(d, self.version)
+            )
+        elif opcode == minicql.OP_BATCH:
+            d = minicql.Decoder(body)
+            d.pos += 1  # type
+            for i in range(d.short()):
+                kind = d.buf[d.pos]
+                d.pos += 1
+                if kind == 0:
+                    query = decode_long_string(d)
+                else:
+                    query_id = bytes(d.short_bytes())
+                    if query_id not in self.server.prepared:
+                        raise minicql.OperationalError(0x2500, "Prepared query not found")
+                    query = self.server.prepared[query_id]
+                values = [d.bytes() for i in range(d.short())]
+                self.query(query, {'values': values, 'flags': 0})
+            return minicql.OP_RESULT, struct.pack('>i', 1)
+        elif opcode == minicql.OP_REGISTER:
+            with self.server.lock:
+                self.server.listeners.append(self)
+            return minicql.OP_READY, b''
+        raise minicql.OperationalError(0x000A, "Unsupported opcode %d" % opcode)
+
+    def query(self, query, params):
+        "Return RESULT body of the query"
+        with self.server.lock:
+            self.server.queries += 1
+            self.server.last_query = (
+                query, [None if v is None else bytes(v) for v in params['values']]
+            )
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        q = query.strip().lower()
+        if q.startswith('use '):
+            self.keyspace = query.strip()[4:].strip('"')
+            return struct.pack('>i', 3) + minicql.encode_string(self.keyspace)
+        if q.startswith(('insert', 'update', 'delete')):
+            with self.server.lock:
+                self.server.modifications += 1
+            return struct.pack('>i', 1)
+        m = re.search(r'\bfrom\s+([\w.]+)', q)
+        if not q.startswith('select') or not m:
+            return struct.pack('>i', 1)
+        table = self.server.table(m.group(1))
+        columns, rows = table.columns, table.rows
+        m = TOKEN_RANGE_RE.search(q)
+        if m:
+            values = iter(params['values'])
+            start, end = [
+                struct.unpack('>q', next(values))[0] if b == '?' else int(b) for b in m.groups()
+            ]
+            rows = [row for row, token in zip(rows, table.tokens()) if start < token <= end]
+        indexes = table.selected(query)
+        if indexes is not None:
+            columns = [columns[i] for i in indexes]
+            rows = [[row[i] for i in indexes] for row in rows]
+        start = int(params.get('paging_state') or 0)
+        end = len(rows)
+        paging_state = None
+        if params.get('page_size'):
+            end = min(start + params['page_size'], end)
+            if end < len(rows):
+                paging_state = str(end).encode()
+        return encode_rows(
+            self.keyspace or 'ks', table.name, columns, rows[start:end],
+            paging_state, bool(params['flags'] & 0x02)
+        )
+
+    def prepare(self, query):
+        "Return Prepared RESULT body of the query"
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        query_id = hashlib.md5(
+            b'%d:' % self.server.prepared_epoch + query.encode('utf-8')
+        ).digest()
+        with self.server.lock:
+            self.server.prepared[query_id] = query
+        q = query.strip().lower()
+        m = re.search(r'\b(?:from|into|update)\s+([\w.]+)', q)
+        table = self.server.tables.get(m.group(1).split('.')[-1]) if m else None
+        columns = table.columns if table else []
+        m = re.match(r'insert\s+into\s+[\w.]+\s*\(([^)]*)\)', q)
+        if m:
+            names = [name.strip() for name in m.group(1).split(',')]
+        else:
+            names = re.findall(r'(token\s*\([^)]*\)|\w+)\s*(?:=|<=|>=|<|>)\s*\?', q)
+        names = names[:q.count('?')]
+        params = [table.column(name) if table else (name, 0x000D, None) for name in names]
+        pk_indexes = [i for i, name in enumerate(names) if columns and name == columns[0][0]]
+
+        b = struct.pack('>i', 4) + minicql.encode_integer(len(query_id), 2) + query_id
+        result_columns = []
+        if q.startswith('select') and table:
+            indexes = table.selected(query)
+            result_columns = columns if indexes is None else [columns[i] for i in indexes]
+        if self.version >= minicql.PROTOCOL_VERSION_V5:
+            metadata_id = table.metadata_id if table else b'\x00' * 16
+            b += minicql.encode_integer(len(metadata_id), 2) + metadata_id
+        b += struct.pack('>iii', 0x0001, len(params), len(pk_indexes))
+        b += b''.join(struct.pack('>H', i) for i in pk_indexes)
+        b += minicql.encode_string(self.keyspace or 'ks') + minicql.encode_string(
+            table.name if table else 't'
+        )
+        for name, type_code, sub_type in params:
+            b += minicql.encode_string(name) + encode_type_option(type_code, sub_type)
+        if result_columns:
+            b += encode_metadata(self.keyspace or 'ks', table.name, result_columns)
+        else:
+            b += struct.pack('>ii', 0x0004, 0)
+        return b
+
+
+class Server(socketserver.ThreadingTCPServer):
+    "Fake CQL server running in a daemon thread"
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(
+        self, host='127.0.0.1', port=0, user=None, password=None, max_version=5, delay=0
+    ):
+        super().__init__((host, port), Handler)
+        self.user = user
+        self.password = password
+        self.max_version = max_version
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.prepared = {}
+        self.prepared_epoch = 0     # increment to give statements prepared again new ids
+        self.listeners = []
+        self.handlers = set()
+        self.requests = 0
+        self.queries = 0
+        self.modifications = 0
+        self.last_query = None  # (query, values)
+        self.warnings = []      # sent with every RESULT
+        self.add_table('local', [('key', 'text'), ('tokens', 'set<text>')], [['local', ['0']]])
+        self.add_table('peers', [('peer', 'inet'), ('rpc_address', 'inet'), ('tokens', 'set<text>')], [])
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        self.close()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_table(self, name, columns, rows):
+        "columns are [(name, type name)], rows are lists of values or number of synthetic rows"
+        self.tables[name] = Table(name, columns, rows)
+        return self.tables[name]
+
+    def table(self, name):
+        table = self.tables.get(name.split('.')[-1])
+        if table is None:
+            raise minicql.OperationalError(0x2200, "unconfigured table %s" % name)
+        return table
+
+    def push_event(self, body):
+        "Send EVENT frame to registered connections"
+        with self.lock:
+            listeners = list(self.listeners)
+        for handler in listeners:
+            handler.send(-1, minicql.OP_EVENT, body)
+
+    def disconnect(self):
+        "Close the connections of the clients"
+        with self.lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9042
+    server = Server('0.0.0.0', port)
+    server.add_table('test', [('id', 'int'), ('s', 'text')], 1000)
+    print('listening on port %d' % server.port)
+    threading.Event().wait()
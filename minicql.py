@@ -24,14 +24,34 @@
 
 # https://github.com/apache/cassandra/blob/trunk/doc/native_protocol_v5.spec
 
+import re
 import socket
 import ssl
 import struct
 import decimal
 import datetime
 import time
-import binascii
 import uuid
+import threading
+import ipaddress
+import collections
+import functools
+import concurrent.futures
+import contextlib
+import itertools
+import bisect
+import weakref
+import mmap
+import zlib
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+try:
+    import snappy
+except ImportError:
+    snappy = None
 
 VERSION = (0, 3, 0)
 __version__ = '%s.%s.%s' % VERSION
@@ -40,6 +60,7 @@ threadsafety = 1
 paramstyle = 'format'
 
 # protocol version
+PROTOCOL_VERSION_V5 = 0x05
 REQUEST_PROTOCOL_VERSION = 0x04
 RESPONSE_PROTOCOL_VERSION = 0x84
 
@@ -80,6 +101,11 @@ CONSISTENCY_SERIAL = b'\x00\x08'
 CONSISTENCY_LOCAL_SERIAL = b'\x00\x09'
 CONSISTENCY_LOCAL_ONE = b'\x00\x0A'
 
+# batch type
+BATCH_LOGGED = 0
+BATCH_UNLOGGED = 1
+BATCH_COUNTER = 2
+
 
 def encode_integer(n, ln):
     b = bytearray()
@@ -102,6 +128,13 @@ def encode_long_string(s):
     return encode_integer(len(b), 4) + b
 
 
+def encode_string_list(l):
+    b = encode_integer(len(l), 2)
+    for s in l:
+        b += encode_string(s)
+    return b
+
+
 def encode_string_map(d):
     b = encode_integer(len(d), 2)
     for k, v in d.items():
@@ -111,10 +144,7 @@ def encode_string_map(d):
 
 
 def decode_varint(b):
-    n = int(binascii.b2a_hex(b).decode('utf-8'), 16)
-    if b[0] & 0x80:
-        n -= 1 << (len(b) * 8)
-    return n
+    return int.from_bytes(b, byteorder='big', signed=True)
 
 
 def decode_int(b):
@@ -134,14 +164,14 @@ def decode_short(b):
 
 def decode_string(b):
     ln, b = decode_short(b)
-    s = b[:ln].decode('utf-8')
+    s = str(b[:ln], 'utf-8')
     b = b[ln:]
     return s, b
 
 
 def decode_long_string(b):
     ln, b = decode_int(b)
-    s = b[:ln].decode('utf-8')
+    s = str(b[:ln], 'utf-8')
     b = b[ln:]
     return s, b
 
@@ -182,53 +212,738 @@ def decode_string_multimap(b):
     return r, b
 
 
-def decode_rows(body):
-    kind, b = decode_int(body)
-    assert kind == 2    # Rows
-    flags, b = decode_int(b)
-    column_count, b = decode_int(b)
-    if flags & 0x0002:
-        paging_state, b = decode_bytes(b)
-    else:
-        paging_state = b''
-    if flags & 0x0001:
-        keyspace_name, b = decode_string(b)
-        table_name, b = decode_string(b)
-    else:
-        keyspace_name = table_name = ''
-
-    description = []
-    for i in range(column_count):
-        if flags & 0x001 == 0:
-            keyspace_name, b = decode_string(b)
-            table_name, b = decode_string(b)
-        column_name, b = decode_string(b)
-        type_code, b = decode_short(b)
+def decode_short_bytes(b):
+    ln = int.from_bytes(b[0:2], byteorder='big')
+    return b[2:2+ln], b[2+ln:]
+
+
+_INT = struct.Struct('>i')
+_SHORT = struct.Struct('>h')
+_USHORT = struct.Struct('>H')
+
+
+class Decoder:
+    "Decode a frame body walking a memoryview with an offset, without copying it"
+    __slots__ = ('buf', 'pos')
+
+    def __init__(self, b, pos=0):
+        self.buf = memoryview(b)
+        self.pos = pos
+
+    def int(self):
+        n = _INT.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return n
+
+    def short(self):
+        n = _SHORT.unpack_from(self.buf, self.pos)[0]
+        self.pos += 2
+        return n
+
+    def string(self):
+        ln = _USHORT.unpack_from(self.buf, self.pos)[0]
+        self.pos += 2 + ln
+        return str(self.buf[self.pos-ln:self.pos], 'utf-8')
+
+    def bytes(self):
+        ln = self.int()
+        if ln < 0:
+            return None
+        self.pos += ln
+        return self.buf[self.pos-ln:self.pos]
+
+    def short_bytes(self):
+        ln = _USHORT.unpack_from(self.buf, self.pos)[0]
+        self.pos += 2 + ln
+        return self.buf[self.pos-ln:self.pos]
+
+    def rest(self):
+        return self.buf[self.pos:]
+
+    def string_list(self):
+        return [self.string() for i in range(self.short())]
+
+    def inet(self):
+        ln = self.buf[self.pos]
+        self.pos += 1 + ln
+        address = ipaddress.ip_address(bytes(self.buf[self.pos-ln:self.pos]))
+        return str(address), self.int()
+
+    def type_option(self):
+        "Return (type_code, sub_type). sub_type of collections are nested type options"
+        type_code = self.short()
         sub_type = None
         if type_code == 0x0000:     # Custom
             raise ValueError("Custom type still not support")
         elif type_code == 0x0020:   # List
-            sub_type, b = decode_short(b)
+            sub_type = self.type_option()
         elif type_code == 0x0021:   # Map
-            k, b = decode_short(b)
-            v, b = decode_short(b)
-            sub_type = (k, v)
+            sub_type = (self.type_option(), self.type_option())
         elif type_code == 0x0022:   # Set
-            sub_type, b = decode_short(b)
-        description.append((column_name, type_code, sub_type, None, None, None, None))
+            sub_type = self.type_option()
+        elif type_code == 0x0030:   # UDT
+            keyspace_name = self.string()
+            udt_name = self.string()
+            sub_type = (keyspace_name, udt_name, tuple(
+                (self.string(), self.type_option()) for i in range(self.short())
+            ))
+        elif type_code == 0x0031:   # Tuple
+            sub_type = tuple(self.type_option() for i in range(self.short()))
+        return type_code, sub_type
+
+    def column_specs(self, flags, column_count):
+        if flags & 0x0001:
+            keyspace_name = self.string()
+            table_name = self.string()
+        else:
+            keyspace_name = table_name = ''
+
+        description = []
+        for i in range(column_count):
+            if flags & 0x001 == 0:
+                keyspace_name = self.string()
+                table_name = self.string()
+            column_name = self.string()
+            type_code, sub_type = self.type_option()
+            description.append((column_name, type_code, sub_type, None, None, None, None))
+        return description
+
+    def metadata(self, description=None):
+        flags = self.int()
+        column_count = self.int()
+        if flags & 0x0002:
+            paging_state = bytes(self.bytes())
+        else:
+            paging_state = b''
+        if flags & 0x0008:          # Metadata_changed (v5)
+            self.short_bytes()      # new_metadata_id
+        if flags & 0x0004 == 0:     # No_metadata is not set
+            description = self.column_specs(flags, column_count)
+        return description, paging_state
+
+
+class RawRow:
+    "Sequence of memoryview cells (None for null) of a row in RawRows, sliced when accessed"
+    __slots__ = ('rows', 'start')
+
+    def __init__(self, rows, start):
+        self.rows = rows
+        self.start = start
+
+    def __len__(self):
+        return self.rows.width
+
+    def __getitem__(self, j):
+        if not 0 <= j < self.rows.width:
+            raise IndexError("cell index out of range")
+        return self.rows.cell(self.start + j)
+
+    def __iter__(self):
+        return iter(self.rows.cells(self.start, self.start + self.rows.width))
+
+
+class RawRows:
+    """Rows of a RESULT body kept as the buffer and offsets of the cells,
+    instead of a list of cells per row. rows[i] is a RawRow."""
+    __slots__ = ('buf', 'offsets', 'width', 'count')
+
+    def __init__(self, buf, offsets, width, count):
+        self.buf = buf
+        self.offsets = offsets
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("row index out of range")
+        return RawRow(self, i * self.width)
+
+    def __iter__(self):
+        "Yield lists of cells, which are cheaper than RawRow when all cells are converted"
+        buf = self.buf
+        width = self.width
+        offsets = self.offsets
+        unpack_from = _INT.unpack_from
+        for start in range(0, self.count * width, width):
+            cells = []
+            for pos in offsets[start:start+width]:
+                ln = unpack_from(buf, pos)[0]
+                cells.append(None if ln < 0 else buf[pos+4:pos+4+ln])
+            yield cells
+
+    def cell(self, k):
+        pos = self.offsets[k]
+        ln = _INT.unpack_from(self.buf, pos)[0]
+        return None if ln < 0 else self.buf[pos+4:pos+4+ln]
+
+    def cells(self, start, stop):
+        buf = self.buf
+        unpack_from = _INT.unpack_from
+        cells = []
+        for pos in self.offsets[start:stop]:
+            ln = unpack_from(buf, pos)[0]
+            cells.append(None if ln < 0 else buf[pos+4:pos+4+ln])
+        return cells
+
+
+def decode_rows(body, description=None):
+    "Return description, RawRows of memoryview cells into body and paging_state"
+    d = Decoder(body)
+    kind = d.int()
+    assert kind == 2    # Rows
+    description, paging_state = d.metadata(description)
+
+    rows_count = d.int()
+    column_count = len(description)
+    buf = d.buf
+    pos = d.pos
+    unpack_from = _INT.unpack_from
+
+    offsets = []
+    append = offsets.append
+    for i in range(rows_count * column_count):
+        append(pos)
+        ln = unpack_from(buf, pos)[0]
+        pos += 4 + ln if ln > 0 else 4
+
+    return description, RawRows(buf, offsets, column_count, rows_count), paging_state
+
+
+def decode_event(body):
+    "Decode an EVENT frame body to a dict with 'type' and 'change' keys"
+    d = Decoder(body)
+    event = {'type': d.string(), 'change': d.string()}
+    if event['type'] in ('TOPOLOGY_CHANGE', 'STATUS_CHANGE'):
+        event['address'] = d.inet()
+    elif event['type'] == 'SCHEMA_CHANGE':
+        event['target'] = d.string()
+        event['keyspace'] = d.string()
+        if event['target'] != 'KEYSPACE':
+            event['name'] = d.string()
+        if event['target'] in ('FUNCTION', 'AGGREGATE'):
+            event['arguments'] = d.string_list()
+    return event
+
+
+def decode_frame_prefix(flags, body):
+    "Return tracing id, warnings and the rest of a response body which has the flags"
+    d = Decoder(body)
+    tracing_id = warnings = None
+    if flags & TRACING_FLAG:
+        tracing_id = uuid.UUID(bytes=bytes(d.buf[:16]))
+        d.pos = 16
+    if flags & WARNING_FLAG:
+        warnings = d.string_list()
+    if flags & CUSOM_PAYLOAD_FLAG:
+        for i in range(d.short()):
+            d.string()
+            d.bytes()
+    return tracing_id, warnings, bytes(d.rest())
+
+
+def decode_prepared(body, version=REQUEST_PROTOCOL_VERSION):
+    d = Decoder(body)
+    kind = d.int()
+    assert kind == 4    # Prepared
+    query_id = bytes(d.short_bytes())
+    result_metadata_id = None
+    if version >= PROTOCOL_VERSION_V5:
+        result_metadata_id = bytes(d.short_bytes())
+    flags = d.int()
+    column_count = d.int()
+    pk_count = d.int()
+    pk_indexes = [d.short() for i in range(pk_count)]
+    params = d.column_specs(flags, column_count)
+    description, _ = d.metadata()
+    return query_id, params, pk_indexes, description, result_metadata_id
+
+
+def encode_varint(n):
+    ln = (n + (n < 0)).bit_length() // 8 + 1
+    return n.to_bytes(ln, byteorder='big', signed=True)
+
+
+def encode_value(v, type_code, sub_type=None):
+    "Encode a python value to the binary representation of the CQL type"
+    if v is None:
+        return None
+    if type_code in (0x0001, 0x000D):     # string
+        return v.encode('utf-8')
+    elif type_code in (0x0002, 0x0005):   # bigint, counter
+        return struct.pack('>q', v)
+    elif type_code == 0x0009:   # int
+        return struct.pack('>i', v)
+    elif type_code == 0x0013:   # smallint
+        return struct.pack('>h', v)
+    elif type_code == 0x0014:   # tinyint
+        return struct.pack('>b', v)
+    elif type_code == 0x000E:   # varint
+        return encode_varint(v)
+    elif type_code in (0x0000, 0x0003):   # binary
+        if isinstance(v, bytes):
+            return v
+        # bytearray, memoryview, mmap, ... are copied only if small
+        v = memoryview(v).cast('B')
+        return v if len(v) >= LARGE_VALUE_SIZE else bytes(v)
+    elif type_code == 0x0004:   # bool
+        return b'\x01' if v else b'\x00'
+    elif type_code == 0x0006:   # decimal
+        v = decimal.Decimal(v)
+        sign, digits, exponent = v.as_tuple()
+        unscaled = int(''.join(str(d) for d in digits))
+        if sign:
+            unscaled = -unscaled
+        return struct.pack('>i', -exponent) + encode_varint(unscaled)
+    elif type_code == 0x0007:   # double
+        return struct.pack('>d', v)
+    elif type_code == 0x0008:   # float
+        return struct.pack('>f', v)
+    elif type_code == 0x000B:   # Timestamp
+        if isinstance(v, str):
+            v = datetime.datetime.fromisoformat(v)
+        if isinstance(v, datetime.datetime):
+            if v.tzinfo is None:
+                v = v.replace(tzinfo=datetime.timezone.utc)
+            delta = v - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+            v = delta // datetime.timedelta(milliseconds=1)
+        return struct.pack('>q', v)
+    elif type_code in (0x000C, 0x000F):     # UUID
+        if isinstance(v, str):
+            v = uuid.UUID(v)
+        return v.bytes
+    elif type_code == 0x0010:   # inet
+        return ipaddress.ip_address(v).packed
+    elif type_code == 0x0011:   # Date
+        if isinstance(v, str):
+            v = datetime.date.fromisoformat(v)
+        return struct.pack('>I', (v - datetime.date(1970, 1, 1)).days + 2 ** 31)
+    elif type_code == 0x0012:   # Time
+        if isinstance(v, str):
+            v = datetime.time.fromisoformat(v)
+        return struct.pack('>q', (
+            ((v.hour * 60 + v.minute) * 60 + v.second) * 1000000 + v.microsecond
+        ) * 1000)
+    elif type_code in (0x0020, 0x0022):     # List, Set
+        b = struct.pack('>i', len(v))
+        for e in v:
+            b += encode_bytes(encode_value(e, *sub_type))
+        return b
+    elif type_code == 0x0021:   # Map
+        b = struct.pack('>i', len(v))
+        for k, e in v.items():
+            b += encode_bytes(encode_value(k, *sub_type[0]))
+            b += encode_bytes(encode_value(e, *sub_type[1]))
+        return b
+    elif type_code == 0x0030:   # UDT
+        return b''.join(
+            encode_bytes(encode_value(v.get(name), *option)) for name, option in sub_type[2]
+        )
+    elif type_code == 0x0031:   # Tuple
+        return b''.join(
+            encode_bytes(encode_value(e, *option)) for e, option in zip(v, sub_type)
+        )
+    raise NotSupportedError()
+
+
+# type name to type code of simple types
+TYPE_CODES = {
+    'ascii': 0x0001, 'bigint': 0x0002, 'blob': 0x0003, 'boolean': 0x0004,
+    'counter': 0x0005, 'decimal': 0x0006, 'double': 0x0007, 'float': 0x0008,
+    'int': 0x0009, 'timestamp': 0x000B, 'uuid': 0x000C, 'text': 0x000D,
+    'varchar': 0x000D, 'varint': 0x000E, 'timeuuid': 0x000F, 'inet': 0x0010,
+    'date': 0x0011, 'time': 0x0012, 'smallint': 0x0013, 'tinyint': 0x0014,
+    'duration': 0x0015,
+}
+
+
+def encode_bytes(b):
+    if b is None:
+        return b'\xff\xff\xff\xff'
+    return struct.pack('>i', len(b)) + b
+
+
+# values at least this large are sent from their own buffers, not copied into the body
+LARGE_VALUE_SIZE = 65536
+
+
+def encode_values(values):
+    "Return [bytes] of encoded values, where large values are kept in their own buffers"
+    parts = []
+    for v in values:
+        if v is not None and len(v) >= LARGE_VALUE_SIZE:
+            parts.append(struct.pack('>i', len(v)))
+            parts.append(v)
+        else:
+            parts.append(encode_bytes(v))
+    return parts
+
+
+def join_buffers(parts):
+    "Return parts joined to bytes, or a list of buffers if some are large not to copy them"
+    buffers = []
+    small = []
+    for b in parts:
+        if len(b) < LARGE_VALUE_SIZE:
+            small.append(b)
+            continue
+        if small:
+            buffers.append(b''.join(small))
+            small = []
+        buffers.append(b)
+    if not buffers:
+        return b''.join(small)
+    small = b''.join(small)
+    if small:
+        buffers.append(small)
+    return buffers
+
+
+# ------------------------------------------------------------------------------
+# Frame body compression.
+# lz4 and python-snappy are used if installed, or fall back to pure python.
+
+def _find_matches(src, tail):
+    "Greedy LZ77 match finder. Yield (position, offset, length) of matches."
+    n = len(src)
+    limit = n - tail
+    table = {}
+    i = 0
+    while i < limit:
+        key = src[i:i+4]
+        ref = table.get(key)
+        table[key] = i
+        if ref is None or i - ref > 0xFFFF:
+            i += 1
+            continue
+        ln = 4
+        max_ln = n - i - (tail - 7 if tail > 7 else 0)
+        while ln + 16 <= max_ln and src[ref+ln:ref+ln+16] == src[i+ln:i+ln+16]:
+            ln += 16
+        while ln < max_ln and src[ref+ln] == src[i+ln]:
+            ln += 1
+        yield i, i - ref, ln
+        i += ln
+
+
+def _copy_match(dst, offset, ln):
+    start = len(dst) - offset
+    if offset >= ln:
+        dst += dst[start:start+ln]
+    else:
+        dst += (dst[start:] * (ln // offset + 1))[:ln]
+
+
+def _lz4_length(dst, n):
+    while n >= 255:
+        dst.append(255)
+        n -= 255
+    dst.append(n)
+
+
+def _lz4_sequence(dst, literals, offset, ln):
+    ln -= 4
+    dst.append(min(len(literals), 15) << 4 | min(ln, 15))
+    if len(literals) >= 15:
+        _lz4_length(dst, len(literals) - 15)
+    dst += literals
+    if offset:
+        dst += offset.to_bytes(2, byteorder='little')
+        if ln >= 15:
+            _lz4_length(dst, ln - 15)
+
+
+def lz4_compress_block(b):
+    "Compress to a raw lz4 block"
+    b = bytes(b)
+    if lz4:
+        return lz4.block.compress(b, store_size=False)
+    dst = bytearray()
+    anchor = 0
+    # the last match must start 12 bytes before the end, and end 5 bytes before
+    for i, offset, ln in _find_matches(b, 12):
+        _lz4_sequence(dst, b[anchor:i], offset, ln)
+        anchor = i + ln
+    _lz4_sequence(dst, b[anchor:], 0, 4)
+    return bytes(dst)
+
+
+def lz4_decompress_block(b, size):
+    if lz4:
+        return lz4.block.decompress(bytes(b), uncompressed_size=size)
+    dst = bytearray()
+    i = 0
+    n = len(b)
+    while i < n:
+        token = b[i]
+        i += 1
+        ln = token >> 4
+        if ln == 15:
+            while True:
+                i += 1
+                ln += b[i-1]
+                if b[i-1] != 255:
+                    break
+        dst += b[i:i+ln]
+        i += ln
+        if i >= n:
+            break
+        offset = b[i] | (b[i+1] << 8)
+        i += 2
+        ln = token & 0x0F
+        if ln == 15:
+            while True:
+                i += 1
+                ln += b[i-1]
+                if b[i-1] != 255:
+                    break
+        _copy_match(dst, offset, ln + 4)
+    return bytes(dst)
+
+
+def lz4_compress(b):
+    "Compress body. It is prefixed by big endian uncompressed length"
+    return encode_integer(len(b), 4) + lz4_compress_block(b)
+
+
+def lz4_decompress(b):
+    return lz4_decompress_block(memoryview(b)[4:], int.from_bytes(b[:4], byteorder='big'))
+
+
+def _snappy_literal(dst, literals):
+    ln = len(literals) - 1
+    if ln < 60:
+        dst.append(ln << 2)
+    else:
+        nbytes = (ln.bit_length() + 7) // 8
+        dst.append((59 + nbytes) << 2)
+        dst += ln.to_bytes(nbytes, byteorder='little')
+    dst += literals
+
+
+def snappy_compress(b):
+    b = bytes(b)
+    if snappy:
+        return snappy.compress(b)
+    dst = bytearray()
+    n = len(b)
+    while True:     # uncompressed length as varint
+        if n < 0x80:
+            dst.append(n)
+            break
+        dst.append(n & 0x7F | 0x80)
+        n >>= 7
+    anchor = 0
+    for i, offset, ln in _find_matches(b, 4):
+        if anchor < i:
+            _snappy_literal(dst, b[anchor:i])
+        anchor = i + ln
+        while ln > 0:
+            n = min(ln, 64)
+            if ln - n and ln - n < 4:    # leave at least 4 bytes for the next copy
+                n = ln - 4
+            if n < 12 and offset < 2048:
+                dst.append((offset >> 8) << 5 | (n - 4) << 2 | 0x01)
+                dst.append(offset & 0xFF)
+            else:
+                dst.append((n - 1) << 2 | 0x02)
+                dst += offset.to_bytes(2, byteorder='little')
+            ln -= n
+    if anchor < len(b):
+        _snappy_literal(dst, b[anchor:])
+    return bytes(dst)
+
+
+def snappy_decompress(b):
+    if snappy:
+        return snappy.decompress(bytes(b))
+    i = 0
+    while b[i] & 0x80:  # skip uncompressed length
+        i += 1
+    i += 1
+    dst = bytearray()
+    n = len(b)
+    while i < n:
+        tag = b[i]
+        i += 1
+        kind = tag & 0x03
+        if kind == 0:   # literal
+            ln = tag >> 2
+            if ln >= 60:
+                nbytes = ln - 59
+                ln = int.from_bytes(b[i:i+nbytes], byteorder='little')
+                i += nbytes
+            ln += 1
+            dst += b[i:i+ln]
+            i += ln
+            continue
+        if kind == 1:
+            ln = ((tag >> 2) & 0x07) + 4
+            offset = (tag >> 5) << 8 | b[i]
+            i += 1
+        elif kind == 2:
+            ln = (tag >> 2) + 1
+            offset = int.from_bytes(b[i:i+2], byteorder='little')
+            i += 2
+        else:
+            ln = (tag >> 2) + 1
+            offset = int.from_bytes(b[i:i+4], byteorder='little')
+            i += 4
+        _copy_match(dst, offset, ln)
+    return bytes(dst)
+
+
+COMPRESSIONS = {
+    'lz4': (lz4_compress, lz4_decompress),
+    'snappy': (snappy_compress, snappy_decompress),
+}
+
+
+def choose_compression(supported_params, compression):
+    "Return compression name to use from SUPPORTED options, or None"
+    if not compression:
+        return None
+    names = [compression] if isinstance(compression, str) else list(COMPRESSIONS)
+    for name in names:
+        if name in COMPRESSIONS and name in supported_params.get('COMPRESSION', []):
+            return name
+    return None
+
+
+# v5 segment framing
+MAX_SEGMENT_PAYLOAD = 0x1FFFF
+CRC32_INITIAL = zlib.crc32(b'\xfa\x2d\x55\xca')
+
+
+def _crc24_table():
+    table = []
+    for i in range(256):
+        crc = i << 16
+        for j in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1974F0B
+        table.append(crc)
+    return table
 
-    rows_count, b = decode_int(b)
 
-    rows = []
+_CRC24_TABLE = _crc24_table()
 
-    for i in range(rows_count):
-        row = []
-        for j in range(len(description)):
-            raw_data, b = decode_bytes(b)
-            row.append(raw_data)
-        rows.append(row)
 
-    return description, rows, paging_state
+def crc24(n, ln):
+    "CRC24 of a segment header, ln bytes of n in little endian"
+    crc = 0x875060
+    for i in range(ln):
+        crc = ((crc << 8) & 0xFFFFFF) ^ _CRC24_TABLE[(crc >> 16) ^ ((n >> (i * 8)) & 0xff)]
+    return crc
+
+
+def crc32(b):
+    return zlib.crc32(b, CRC32_INITIAL)
+
+
+def encode_segment(payload, self_contained=True, compress=None, threshold=0):
+    "Return a segment: header with CRC24, payload and CRC32 of the payload"
+    if compress is None:
+        n = len(payload) | (self_contained << 17)
+        header = n.to_bytes(3, 'little') + crc24(n, 3).to_bytes(3, 'little')
+    else:
+        uncompressed_length = 0     # 0 means not compressed
+        if len(payload) > threshold:
+            compressed = compress(payload)
+            if len(compressed) < len(payload):
+                payload, uncompressed_length = compressed, len(payload)
+        n = len(payload) | (uncompressed_length << 17) | (self_contained << 34)
+        header = n.to_bytes(5, 'little') + crc24(n, 5).to_bytes(3, 'little')
+    return header + payload + crc32(payload).to_bytes(4, 'little')
+
+
+def encode_segment_buffers(buffers):
+    """Return segments of an envelope in buffers as [header, slices of buffers, CRC32]
+    items, without copying the buffers"""
+    self_contained = sum(len(b) for b in buffers) <= MAX_SEGMENT_PAYLOAD
+    items = []
+    pieces = []
+    size = 0
+    for b in buffers:
+        b = memoryview(b)
+        while len(b):
+            n = min(len(b), MAX_SEGMENT_PAYLOAD - size)
+            pieces.append(b[:n])
+            size += n
+            b = b[n:]
+            if size == MAX_SEGMENT_PAYLOAD:
+                items.extend(_segment_items(pieces, size, self_contained))
+                pieces = []
+                size = 0
+    if pieces:
+        items.extend(_segment_items(pieces, size, self_contained))
+    return items
+
+
+def _segment_items(pieces, size, self_contained):
+    n = size | (self_contained << 17)
+    crc = CRC32_INITIAL
+    for piece in pieces:
+        crc = zlib.crc32(piece, crc)
+    header = n.to_bytes(3, 'little') + crc24(n, 3).to_bytes(3, 'little')
+    return [header] + pieces + [crc.to_bytes(4, 'little')]
+
+
+def encode_segments(envelopes, compress=None, threshold=0):
+    """Coalesce envelopes into as few segments as possible.
+    An envelope in a list of buffers (with large values) is sent from them without
+    compression, and returned as items of encode_segment_buffers()."""
+    segments = []
+    payload = bytearray()
+    for envelope in envelopes:
+        if isinstance(envelope, list):
+            if compress is None:
+                if payload:
+                    segments.append(encode_segment(bytes(payload), True, compress, threshold))
+                    payload = bytearray()
+                segments.extend(encode_segment_buffers(envelope))
+                continue
+            envelope = b''.join(envelope)
+        if payload and len(payload) + len(envelope) > MAX_SEGMENT_PAYLOAD:
+            segments.append(encode_segment(bytes(payload), True, compress, threshold))
+            payload = bytearray()
+        if len(envelope) > MAX_SEGMENT_PAYLOAD:
+            # a large envelope is split into segments which are not self contained
+            for i in range(0, len(envelope), MAX_SEGMENT_PAYLOAD):
+                segments.append(encode_segment(
+                    envelope[i:i+MAX_SEGMENT_PAYLOAD], False, compress, threshold
+                ))
+        else:
+            payload += envelope
+    if payload:
+        segments.append(encode_segment(bytes(payload), True, compress, threshold))
+    return segments
+
+
+def decode_segment_header(header):
+    "Return (payload length, uncompressed length) of 6 or 8 bytes segment header"
+    ln = len(header) - 3
+    n = int.from_bytes(header[:ln], 'little')
+    if crc24(n, ln) != int.from_bytes(header[ln:], 'little'):
+        raise OperationalError(-1, "Segment header CRC mismatch")
+    if ln == 3:
+        return n & MAX_SEGMENT_PAYLOAD, 0
+    return n & MAX_SEGMENT_PAYLOAD, (n >> 17) & MAX_SEGMENT_PAYLOAD
+
+
+def decode_segment_payload(b, uncompressed_length=0, decompress=None):
+    "b is payload and its CRC32"
+    payload = memoryview(b)[:-4]
+    if crc32(payload) != int.from_bytes(b[-4:], 'little'):
+        raise OperationalError(-1, "Segment payload CRC mismatch")
+    if uncompressed_length:
+        return decompress(payload, uncompressed_length)
+    return payload
 
 
 def escape_parameter(v):
@@ -256,6 +971,83 @@ def escape_parameter(v):
     else:
         return "'" + str(v) + "'"
 
+# ------------------------------------------------------------------------------
+# Murmur3Partitioner token
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _rotl64(n, r):
+    return ((n << r) | (n >> (64 - r))) & _MASK64
+
+
+def _fmix64(k):
+    k ^= k >> 33
+    k = k * 0xff51afd7ed558ccd & _MASK64
+    k ^= k >> 33
+    k = k * 0xc4ceb9fe1a85ec53 & _MASK64
+    k ^= k >> 33
+    return k
+
+
+def murmur3(data):
+    "Return Murmur3Partitioner token of a partition key (Cassandra's MurmurHash3_x64_128)"
+    c1 = 0x87c37b91114253d5
+    c2 = 0x4cf5ad432745937f
+    length = len(data)
+    nblocks = length // 16
+    h1 = h2 = 0
+    for i in range(nblocks):
+        k1, k2 = struct.unpack_from('<QQ', data, i * 16)
+        k1 = _rotl64(k1 * c1 & _MASK64, 31) * c2 & _MASK64
+        h1 ^= k1
+        h1 = (_rotl64(h1, 27) + h2) * 5 + 0x52dce729 & _MASK64
+        k2 = _rotl64(k2 * c2 & _MASK64, 33) * c1 & _MASK64
+        h2 ^= k2
+        h2 = (_rotl64(h2, 31) + h1) * 5 + 0x38495ab5 & _MASK64
+
+    # Cassandra's implementation sign extends the tail bytes
+    tail = [b - 256 if b > 127 else b for b in data[nblocks*16:]]
+    k1 = k2 = 0
+    for i in range(len(tail) - 1, 7, -1):
+        k2 ^= (tail[i] << ((i - 8) * 8)) & _MASK64
+    if len(tail) > 8:
+        h2 ^= _rotl64(k2 * c2 & _MASK64, 33) * c1 & _MASK64
+    for i in range(min(len(tail), 8) - 1, -1, -1):
+        k1 ^= (tail[i] << (i * 8)) & _MASK64
+    if tail:
+        h1 ^= _rotl64(k1 * c1 & _MASK64, 31) * c2 & _MASK64
+
+    h1 ^= length
+    h2 ^= length
+    h1 = (h1 + h2) & _MASK64
+    h2 = (h2 + h1) & _MASK64
+    h1 = (_fmix64(h1) + _fmix64(h2)) & _MASK64
+    token = h1 - (1 << 64) if h1 >> 63 else h1
+    return (1 << 63) - 1 if token == -(1 << 63) else token
+
+
+def routing_key(values):
+    "Return serialized partition key from encoded partition key column values"
+    if len(values) == 1:
+        return values[0]
+    return b''.join(struct.pack('>H', len(v)) + v + b'\x00' for v in values)
+
+
+MIN_TOKEN = -(1 << 63)
+MAX_TOKEN = (1 << 63) - 1
+
+
+def token_ranges(splits, ring=()):
+    "Return [(start, end)] ranges of the Murmur3 ring in splits, also split at tokens of ring"
+    bounds = set(ring)
+    bounds.update(MIN_TOKEN + (i << 64) // splits for i in range(1, splits))
+    bounds.add(MAX_TOKEN)
+    bounds.discard(MIN_TOKEN)
+    bounds = sorted(bounds)
+    return list(zip([MIN_TOKEN] + bounds[:-1], bounds))
+
+
 # ------------------------------------------------------------------------------
 class Error(Exception):
     def __init__(self, code, message):
@@ -304,14 +1096,831 @@ class NotSupportedError(DatabaseError):
         DatabaseError.__init__(self, -1, 'NotSupportedError')
 
 
+class OperationTimedOut(OperationalError):
+    "A connection or a request did not complete before its deadline"
+    def __init__(self, message):
+        OperationalError.__init__(self, -1, message)
+
+
+class Trace:
+    """Tracing session of a request executed with trace=True.
+    client has the seconds spent on the client side, and session and events
+    are fetched from system_traces on first access."""
+    def __init__(self, connection, tracing_id, warnings, client):
+        self.connection = connection
+        self.tracing_id = tracing_id
+        self.warnings = warnings
+        self.client = client    # encode, send, wait, receive and decode seconds
+        self._session = None
+        self._events = None
+
+    def __repr__(self):
+        return '<Trace %s>' % (self.tracing_id, )
+
+    def fetch(self, max_wait=2.0):
+        "Fetch the session and events, waiting for the server to finish writing them"
+        deadline = time.monotonic() + max_wait
+        with self.connection.cursor(result_cache=False) as cur:
+            while True:
+                cur.execute(
+                    "SELECT * FROM system_traces.sessions WHERE session_id=%s", (self.tracing_id, )
+                )
+                names = [d[0] for d in cur.description]
+                row = cur.fetchone()
+                if (row and row[names.index('duration')] is not None) or time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            self._session = dict(zip(names, row)) if row else {}
+            cur.execute(
+                "SELECT * FROM system_traces.events WHERE session_id=%s", (self.tracing_id, )
+            )
+            names = [d[0] for d in cur.description]
+            self._events = [dict(zip(names, row)) for row in cur.fetchall()]
+
+    @property
+    def session(self):
+        if self._session is None:
+            self.fetch()
+        return self._session
+
+    @property
+    def events(self):
+        if self._events is None:
+            self.fetch()
+        return self._events
+
+    def breakdown(self):
+        """Return seconds of encode, send, network, server, receive and decode.
+        network is the wait for the response minus the duration on the coordinator."""
+        server = (self.session.get('duration') or 0) / 1e6
+        return {
+            'encode': self.client['encode'],
+            'send': self.client['send'],
+            'network': max(self.client['wait'] - server, 0.0),
+            'server': server,
+            'receive': self.client['receive'],
+            'decode': self.client['decode'],
+        }
+
+    def timeline(self):
+        """Return [(seconds from the start, source, activity)] of the client and the servers.
+        Server events are placed assuming the network takes the same time both ways."""
+        client = self.client
+        b = self.breakdown()
+        sent = client['encode'] + client['send']
+        received = sent + client['wait']
+        timeline = [
+            (0.0, 'client', 'encode'),
+            (client['encode'], 'client', 'send'),
+            (sent, 'client', 'wait'),
+            (received, 'client', 'receive'),
+            (received + client['receive'], 'client', 'decode'),
+            (received + client['receive'] + client['decode'], 'client', 'done'),
+        ]
+        for event in self.events:
+            timeline.append((
+                sent + b['network'] / 2 + (event.get('source_elapsed') or 0) / 1e6,
+                str(event.get('source')), event.get('activity'),
+            ))
+        timeline.sort(key=lambda e: e[0])
+        return timeline
+
+
+class PreparedStatement:
+    def __init__(
+        self, query, query_id, params, pk_indexes, description, result_metadata_id=None,
+        keyspace=None
+    ):
+        self.query = query
+        self.query_id = query_id
+        self.params = params
+        self.pk_indexes = pk_indexes
+        self.description = description
+        self.result_metadata_id = result_metadata_id
+        self.keyspace = keyspace
+
+    def __repr__(self):
+        return '<PreparedStatement %s>' % (self.query, )
+
+    def bind(self, args):
+        if len(args) != len(self.params):
+            raise ProgrammingError(
+                "%d parameters required but %d given" % (len(self.params), len(args))
+            )
+        try:
+            return [encode_value(v, p[1], p[2]) for v, p in zip(args, self.params)]
+        except (TypeError, ValueError, AttributeError, struct.error) as e:
+            # e.g. a str for an int column
+            raise DataError(-1, "Can't encode %r: %s" % (args, e))
+
+
+def check_frame(opcode, body):
+    if opcode == OP_ERROR:
+        n, b = decode_int(body)
+        if n == 0x0001000d:
+            # ??? Azure Cosmos DB has unknown prefix bytes
+            body = body[29:]
+            n, b = decode_int(body)
+        s, b = decode_string(b)
+        raise OperationalError(n, s)
+    return opcode, body
+
+
+def decode_result(opcode, body):
+    assert opcode == OP_RESULT
+    kind = _INT.unpack_from(body, 0)[0]
+    if kind == 0x0001000d:
+        # ??? Azure Cosmos DB has unknown prefix bytes
+        body = body[29:]
+        kind = _INT.unpack_from(body, 0)[0]
+    return kind, body
+
+
+# Python types of values which are better sent as binary values than inlined.
+# A query with them is prepared at once, to encode them by the column types
+# of the server: their width doesn't tell the type (e.g. '2024' and an int)
+_BIND_TYPES = frozenset([
+    bool, str, bytes, bytearray, memoryview, mmap.mmap,
+    uuid.UUID, datetime.datetime, datetime.date, datetime.time, decimal.Decimal,
+    ipaddress.IPv4Address, ipaddress.IPv6Address,
+])
+
+
+class QueryTemplate:
+    "'format' paramstyle query split at its parameters"
+    __slots__ = ('query', 'parts')
+
+    def __init__(self, query):
+        self.query = query
+        self.parts = ['']
+        pos = 0
+        for m in re.finditer('%[%s]', query):
+            self.parts[-1] += query[pos:m.start()]
+            if m.group() == '%%':
+                self.parts[-1] += '%'
+            else:
+                self.parts.append('')
+            pos = m.end()
+        self.parts[-1] += query[pos:]
+
+    def _check(self, args):
+        if len(args) != len(self.parts) - 1:
+            raise ProgrammingError("%d parameters required but %d given" % (
+                len(self.parts) - 1, len(args)
+            ))
+
+    def format(self, args):
+        "Return the query with inlined args"
+        self._check(args)
+        texts = [self.parts[0]]
+        for v, part in zip(args, self.parts[1:]):
+            texts.append(escape_parameter(v))
+            texts.append(part)
+        return ''.join(texts)
+
+
+@functools.lru_cache(maxsize=1024)
+def query_template(query):
+    return QueryTemplate(query)
+
+
+def format_query(query, args):
+    "Inline 'format' paramstyle args into query"
+    return query_template(query).format(args)
+
+
+def bind_args(query, args, stmt):
+    "Return the PreparedStatement of query and args, or query with inlined args if not prepared"
+    if stmt and len(stmt.params) == len(args):
+        return stmt, args
+    return format_query(query, args), ()
+
+
+def encode_flags(flags, version):
+    "Flags of query parameters are an int since v5"
+    if version >= PROTOCOL_VERSION_V5:
+        return encode_integer(flags, 4)
+    return bytes([flags])
+
+
+def encode_keyspace(flags, keyspace, version):
+    "Return flags and keyspace parameter of a per query keyspace (v5)"
+    if not keyspace:
+        return flags, b''
+    if version < PROTOCOL_VERSION_V5:
+        raise ProgrammingError("Per query keyspace requires protocol v5")
+    return flags | 0x80, encode_string(keyspace)
+
+
+def encode_prepare(query, version=REQUEST_PROTOCOL_VERSION, keyspace=None):
+    "Return body of PREPARE request"
+    body = encode_long_string(query)
+    if version >= PROTOCOL_VERSION_V5:
+        flags, keyspace = encode_keyspace(0, keyspace, version)
+        body += encode_integer(flags and 0x01, 4) + keyspace
+    elif keyspace:
+        raise ProgrammingError("Per query keyspace requires protocol v5")
+    return body
+
+
+def encode_query(
+    query, args=(), page_size=None, paging_state=None,
+    version=REQUEST_PROTOCOL_VERSION, keyspace=None
+):
+    """Return opcode and body of QUERY or EXECUTE request.
+    args of a query string are encoded values of its '?' markers.
+    The body is a list of buffers (see join_buffers) if it has large values."""
+    flags = 0
+    params = []
+    prepared = isinstance(query, PreparedStatement)
+    if prepared or args:
+        values = query.bind(args) if prepared else args
+        flags |= 0x01
+        params.append(encode_integer(len(values), 2))
+        params.extend(encode_values(values))
+        if prepared and query.description is not None:
+            flags |= 0x02   # Skip_metadata
+    if page_size:
+        flags |= 0x04
+        params.append(encode_integer(page_size, 4))
+    if paging_state:
+        flags |= 0x08
+        params.append(encode_integer(len(paging_state), 4) + paging_state)
+    if prepared:
+        # the keyspace of a prepared statement is given by PREPARE
+        query_id = encode_integer(len(query.query_id), 2) + query.query_id
+        if version >= PROTOCOL_VERSION_V5:
+            query_id += encode_integer(len(query.result_metadata_id), 2) + query.result_metadata_id
+        return OP_EXECUTE, join_buffers(
+            [query_id, CONSISTENCY_ONE + encode_flags(flags, version)] + params
+        )
+    flags, keyspace = encode_keyspace(flags, keyspace, version)
+    return OP_QUERY, join_buffers(
+        [encode_long_string(query), CONSISTENCY_ONE + encode_flags(flags, version)] + params
+        + [keyspace]
+    )
+
+
+def decode_query_result(query, opcode, body):
+    "Return description, rows and paging_state of QUERY or EXECUTE response"
+    kind, body = decode_result(opcode, body)
+    if kind == 2:
+        description, data, paging_state = decode_rows(
+            body, getattr(query, 'description', None)
+        )
+        if isinstance(query, PreparedStatement) and _INT.unpack_from(body, 4)[0] & 0x0008:
+            # Metadata_changed (v5), following requests use the new metadata
+            d = Decoder(body, 4)
+            flags = d.int()
+            d.int()         # columns_count
+            if flags & 0x0002:
+                d.bytes()   # paging_state
+            query.result_metadata_id = bytes(d.short_bytes())
+            query.description = description
+    else:
+        description = data = []
+        paging_state = b''
+
+    return description, data, paging_state
+
+
+_DOUBLE = struct.Struct('>d')
+_FLOAT = struct.Struct('>f')
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _decode_items(b, count=None, width=1):
+    "Return [bytes] items of a collection (count is None), tuple or UDT value"
+    pos = 0
+    if count is None:
+        count = _INT.unpack_from(b, 0)[0] * width
+        pos = 4
+    items = []
+    for i in range(count):
+        if pos >= len(b):   # UDT value may lack trailing fields
+            items.append(None)
+            continue
+        ln = _INT.unpack_from(b, pos)[0]
+        pos += 4
+        if ln < 0:
+            items.append(None)
+        else:
+            items.append(b[pos:pos+ln])
+            pos += ln
+    return items
+
+
+def _decode_vint(b, pos):
+    n = b[pos]
+    extra = 0
+    while n & (0x80 >> extra):
+        extra += 1
+    n &= 0xFF >> extra
+    for i in range(extra):
+        n = (n << 8) | b[pos+1+i]
+    return (n >> 1) ^ -(n & 1), pos + 1 + extra
+
+
+def _decode_duration(b):
+    months, pos = _decode_vint(b, 0)
+    days, pos = _decode_vint(b, pos)
+    nanoseconds, pos = _decode_vint(b, pos)
+    return months, days, nanoseconds
+
+
+def _decode_decimal(b):
+    scale = int.from_bytes(b[:4], byteorder='big', signed=True)
+    unscaled = int.from_bytes(b[4:], byteorder='big', signed=True)
+    return decimal.Decimal('%de%d' % (unscaled, -scale))
+
+
+def _decode_time(b):
+    nanosec = int.from_bytes(b, byteorder='big')
+    microsecond = nanosec // 1000 % 1000000
+    second = nanosec // 1000000000 % 60
+    minute = nanosec // (60 * 1000000000) % 60
+    hour = nanosec // (3600 * 1000000000)
+    return datetime.time(hour, minute, second, microsecond)
+
+
+_CONVERTERS = {
+    0x0001: lambda b: str(b, 'utf-8'),                          # ascii
+    0x0002: functools.partial(int.from_bytes, byteorder='big', signed=True),   # bigint
+    0x0003: bytes,                                              # blob
+    0x0004: lambda b: b[0] != 0,                                # boolean
+    0x0006: _decode_decimal,                                    # decimal
+    0x0007: lambda b: _DOUBLE.unpack(b)[0],                     # double
+    0x0008: lambda b: _FLOAT.unpack(b)[0],                      # float
+    0x000B: lambda b: _EPOCH + datetime.timedelta(              # timestamp
+        milliseconds=int.from_bytes(b, byteorder='big', signed=True)
+    ),
+    0x000C: lambda b: uuid.UUID(bytes=bytes(b)),                # uuid
+    0x0010: lambda b: ipaddress.ip_address(bytes(b)),           # inet
+    0x0011: lambda b: datetime.date.fromordinal(                # date
+        _EPOCH_ORDINAL + int.from_bytes(b, byteorder='big') - 2 ** 31
+    ),
+    0x0012: _decode_time,                                       # time
+    0x0015: _decode_duration,                                   # duration
+}
+_CONVERTERS[0x000D] = _CONVERTERS[0x0001]   # varchar
+_CONVERTERS[0x000F] = _CONVERTERS[0x000C]   # timeuuid
+_CONVERTERS[0x0005] = _CONVERTERS[0x0002]   # counter
+_CONVERTERS[0x0009] = _CONVERTERS[0x0002]   # int
+_CONVERTERS[0x000E] = _CONVERTERS[0x0002]   # varint
+_CONVERTERS[0x0013] = _CONVERTERS[0x0002]   # smallint
+_CONVERTERS[0x0014] = _CONVERTERS[0x0002]   # tinyint
+
+
+@functools.lru_cache(maxsize=None)
+def type_converter(type_code, sub_type=None, hashable=False):
+    """Return a function which converts a not null value of the type to a python object.
+    Collections in set elements and map keys are converted to hashable objects."""
+    if type_code in (0x0020, 0x0022):   # List, Set
+        f = type_converter(*sub_type, hashable=hashable or type_code == 0x0022)
+        if type_code == 0x0020:
+            container = tuple if hashable else list
+        else:
+            container = frozenset if hashable else set
+        return lambda b: container([None if v is None else f(v) for v in _decode_items(b)])
+    elif type_code == 0x0021:   # Map
+        fk = type_converter(*sub_type[0], hashable=True)
+        fv = type_converter(*sub_type[1], hashable=hashable)
+
+        def convert_map(b):
+            items = _decode_items(b, width=2)
+            d = {
+                None if k is None else fk(k): None if v is None else fv(v)
+                for k, v in zip(items[0::2], items[1::2])
+            }
+            return tuple(d.items()) if hashable else d
+        return convert_map
+    elif type_code == 0x0030:   # UDT
+        names = tuple(name for name, option in sub_type[2])
+        fs = tuple(type_converter(*option, hashable=hashable) for name, option in sub_type[2])
+
+        def convert_udt(b):
+            values = [
+                None if v is None else f(v) for f, v in zip(fs, _decode_items(b, len(fs)))
+            ]
+            return tuple(zip(names, values)) if hashable else dict(zip(names, values))
+        return convert_udt
+    elif type_code == 0x0031:   # Tuple
+        fs = tuple(type_converter(*option, hashable=hashable) for option in sub_type)
+        return lambda b: tuple([
+            None if v is None else f(v) for f, v in zip(fs, _decode_items(b, len(fs)))
+        ])
+    return _CONVERTERS.get(type_code, bytes)
+
+
+def _column_converter(type_code, sub_type, blob):
+    "blob converts the memoryview of a blob column value, other than bytes"
+    return blob if type_code == 0x0003 else type_converter(type_code, sub_type)
+
+
+@functools.lru_cache(maxsize=256)
+def _row_converter(types, blob=bytes):
+    converters = tuple(
+        _column_converter(type_code, sub_type, blob) for type_code, sub_type in types
+    )
+
+    def convert_row(row):
+        return tuple([None if v is None else f(v) for f, v in zip(converters, row)])
+    return convert_row
+
+
+def row_converter(description, blob=bytes):
+    """Return a function which converts a raw row of the description to a tuple.
+    blob=memoryview returns blob values as views into the received frame, not copied."""
+    return _row_converter(tuple((d[1], d[2]) for d in description), blob)
+
+
+def convert_row(description, row):
+    return row_converter(description)(row)
+
+
+@functools.lru_cache(maxsize=256)
+def _namedtuple(names):
+    return collections.namedtuple('Row', names, rename=True)
+
+
+def dict_row_converter(description, blob=bytes):
+    "Return a function which converts a raw row of the description to a dict"
+    names = tuple(d[0] for d in description)
+    convert = row_converter(description, blob)
+    return lambda row: dict(zip(names, convert(row)))
+
+
+def namedtuple_row_converter(description, blob=bytes):
+    "Return a function which converts a raw row of the description to a namedtuple"
+    cls = _namedtuple(tuple(d[0] for d in description))
+    convert = row_converter(description, blob)
+    return lambda row: cls._make(convert(row))
+
+
+_UNSET = object()
+
+
+class Row:
+    """Row which converts a value when it is first accessed, by index or by column name.
+    It compares equal to the tuple of its values, and keeps the buffer of the result alive."""
+    __slots__ = ('_raw', '_columns', '_values')
+
+    def __init__(self, raw, columns):
+        self._raw = raw
+        self._columns = columns     # (names, {name: index}, converters)
+        self._values = None
+
+    def _value(self, j):
+        if self._values is None:
+            self._values = [_UNSET] * len(self._columns[0])
+        v = self._values[j]
+        if v is _UNSET:
+            b = self._raw[j]
+            v = self._values[j] = None if b is None else self._columns[2][j](b)
+        return v
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._value(self._columns[1][key])
+        if isinstance(key, slice):
+            return tuple(self)[key]
+        n = len(self._columns[0])
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError("row index out of range")
+        return self._value(key)
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __iter__(self):
+        return (self._value(j) for j in range(len(self._columns[0])))
+
+    def keys(self):
+        return list(self._columns[0])
+
+    def asdict(self):
+        return dict(zip(self._columns[0], self))
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = tuple(other)
+        return tuple(self) == other if isinstance(other, tuple) else NotImplemented
+
+    def __lt__(self, other):
+        return tuple(self) < tuple(other)
+
+    def __le__(self, other):
+        return tuple(self) <= tuple(other)
+
+    def __gt__(self, other):
+        return tuple(self) > tuple(other)
+
+    def __ge__(self, other):
+        return tuple(self) >= tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __reduce__(self):
+        return (tuple, (tuple(self), ))
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % (name, v) for name, v in zip(self._columns[0], self))
+
+
+@functools.lru_cache(maxsize=256)
+def _row_columns(columns, blob=bytes):
+    names = tuple(name for name, _, _ in columns)
+    return names, {name: j for j, name in enumerate(names)}, tuple(
+        _column_converter(type_code, sub_type, blob) for _, type_code, sub_type in columns
+    )
+
+
+def lazy_row_converter(description, blob=bytes):
+    "Return a function which makes a Row of a raw row of the description"
+    columns = _row_columns(tuple((d[0], d[1], d[2]) for d in description), blob)
+    return lambda row: Row(row, columns)
+
+
+ROW_FACTORIES = {
+    'tuple': row_converter,
+    'dict': dict_row_converter,
+    'namedtuple': namedtuple_row_converter,
+    'row': lazy_row_converter,
+}
+
+
+def resolve_row_factory(factory):
+    "Return a function of a description to a row converter, by name in ROW_FACTORIES or itself"
+    if not isinstance(factory, str):
+        return factory
+    if factory not in ROW_FACTORIES:
+        raise ProgrammingError("Unknown row factory %s" % (factory, ))
+    return ROW_FACTORIES[factory]
+
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+_CONDITION_RE = re.compile(r'\bIF\b', re.IGNORECASE)
+
+
+def is_modification(query):
+    """Return True if query is INSERT, UPDATE or DELETE, which can be in a batch.
+    Conditional ones (IF NOT EXISTS, IF col = ...) are not, as a batch of them
+    must be in one partition and their [applied] results are lost."""
+    if isinstance(query, PreparedStatement):
+        query = query.query
+    words = query.split(None, 1)
+    if not words or words[0].upper() not in ('INSERT', 'UPDATE', 'DELETE'):
+        return False
+    return not _CONDITION_RE.search(_LITERAL_RE.sub('', query))
+
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TRUNCATE|TABLE)\s+([\w."]+)', re.IGNORECASE)
+
+
+def query_table(query):
+    "Return the lower case table name (without keyspace) of the statement, or None"
+    if isinstance(query, PreparedStatement):
+        query = query.query
+    m = _TABLE_RE.search(query)
+    return m.group(1).split('.')[-1].strip('"').lower() if m else None
+
+
+def is_select(query):
+    if isinstance(query, PreparedStatement):
+        query = query.query
+    return query.lstrip()[:6].upper() == 'SELECT'
+
+
+def encode_batch(entries, batch_type=BATCH_UNLOGGED, version=REQUEST_PROTOCOL_VERSION, keyspace=None):
+    "entries are (query string or PreparedStatement, list of encoded values)"
+    parts = [bytes([batch_type]), encode_integer(len(entries), 2)]
+    for query, values in entries:
+        if isinstance(query, PreparedStatement):
+            parts.append(b'\x01' + encode_integer(len(query.query_id), 2) + query.query_id)
+        else:
+            parts.append(b'\x00' + encode_long_string(query))
+        parts.append(encode_integer(len(values), 2))
+        parts.extend(encode_values(values))
+    flags, keyspace = encode_keyspace(0, keyspace, version)
+    parts.append(CONSISTENCY_ONE + encode_flags(flags, version) + keyspace)
+    return join_buffers(parts)
+
+
+def chunk_batch(entries, max_statements, max_bytes):
+    "Split batch entries into lists of up to max_statements and about max_bytes"
+    chunk = []
+    size = 0
+    for query, values in entries:
+        n = sum(len(v) for v in values if v is not None)
+        if isinstance(query, str):
+            n += len(query)
+        if chunk and (len(chunk) >= max_statements or size + n > max_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((query, values))
+        size += n
+    if chunk:
+        yield chunk
+
+
+def encode_auth_response(user, password):
+    if not (user and password):
+        raise ValueError("Need credentials")
+    body = b'\x00' + user.encode('utf-8') + b'\x00' + password.encode('utf-8')
+    return encode_integer(len(body), 4) + body
+
+
+class StatementCache:
+    "LRU cache of prepared statements keyed by 'format' paramstyle query"
+    def __init__(self, size=256, threshold=2):
+        self.size = size
+        self.threshold = threshold
+        # an entry is a PreparedStatement, an execution count or False (can't prepare)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, query, force=False):
+        """Return (PreparedStatement or None, whether query should be prepared now)"""
+        if not (self.threshold or force):
+            return None, False
+        with self._lock:
+            entry = self._entries.pop(query, 0)
+            if not isinstance(entry, PreparedStatement) and entry is not False:
+                entry += 1
+            self._entries[query] = entry
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        if isinstance(entry, PreparedStatement) or entry is False:
+            return entry or None, False
+        return None, force or entry >= self.threshold
+
+    def prepare_first(self, args):
+        "Return True if a query with the args is prepared on its first execution (see _BIND_TYPES)"
+        return bool(self.threshold) and any(type(v) in _BIND_TYPES for v in args)
+
+    def store(self, query, stmt):
+        "Store PreparedStatement, or None if query can't be prepared"
+        with self._lock:
+            if query in self._entries:
+                self._entries[query] = stmt or False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, query):
+        return query in self._entries
+
+
+class ResultCache:
+    """LRU cache of single page SELECT results keyed by the request, bounded by
+    entries and bytes of the raw results. Entries expire after ttl seconds, or
+    ttls[statement] for the statement given to execute() (0 is not cached),
+    and writes to a table through connections using the cache invalidate it."""
+    def __init__(self, max_entries=1024, max_bytes=16*1024*1024, ttl=10.0, ttls=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.bytes = 0
+        self._entries = collections.OrderedDict()     # key: (expires, table, size, result)
+        self._tables = collections.defaultdict(set)    # table: keys
+        self._generations = collections.Counter()      # table: count of writes
+        self._lock = threading.Lock()
+
+    def ttl_of(self, query):
+        if isinstance(query, PreparedStatement):
+            query = query.query
+        return self.ttls.get(query, self.ttl)
+
+    def _remove(self, key):
+        _, table, size, _ = self._entries.pop(key)
+        self._tables[table].discard(key)
+        self.bytes -= size
+
+    def get(self, key):
+        "Return the result (description, rows, paging_state) or None"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                description, rows, paging_state = entry[3]
+                return description, list(rows), paging_state
+            if entry:
+                self._remove(key)
+            self.misses += 1
+        return None
+
+    def generation(self, table):
+        return self._generations[None], self._generations[table]
+
+    def put(self, key, table, generation, result, size, ttl):
+        "Store the result unless the table is written since generation(table)"
+        if not ttl or size > self.max_bytes:
+            return
+        with self._lock:
+            if self.generation(table) != generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, table, size, result)
+            self._tables[table].add(key)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, table=None):
+        "Drop results of the table, or all results if table is None"
+        with self._lock:
+            self._generations[table] += 1
+            self.invalidations += 1
+            keys = list(self._entries) if table is None else list(self._tables.pop(table, ()))
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+            'bytes': self.bytes, 'evictions': self.evictions, 'invalidations': self.invalidations,
+        }
+
+
+class _PageFetcher(threading.Thread):
+    def __init__(self, connection, query, args, page_size, paging_state, keyspace=None):
+        super().__init__(daemon=True)
+        self.connection = connection
+        self.query = query
+        self.args = args
+        self.page_size = page_size
+        self.paging_state = paging_state
+        self.keyspace = keyspace
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self.connection._execute(
+                self.query, self.args, self.page_size, self.paging_state, self.keyspace
+            )
+        except Exception as e:
+            self._error = e
+
+    def result(self, timeout=None):
+        self.join(timeout)
+        if self.is_alive():
+            raise concurrent.futures.TimeoutError()
+        if self._error:
+            raise self._error
+        return self._result
+
+
 class Cursor(object):
-    def __init__(self, connection):
+    def __init__(
+        self, connection, page_size=None, prefetch=True, keyspace=None, trace=False,
+        result_cache=None, row_factory=None, blob=bytes
+    ):
         self.connection = connection
+        # 'tuple', 'dict', 'namedtuple', 'row' (lazy Row) or a function of a description
+        self.row_factory = resolve_row_factory(row_factory or connection.row_factory)
+        # memoryview returns blob values as views into the received frame, not copied
+        self.blob = blob
+        self.keyspace = keyspace
+        self.tracing = trace
+        self.trace = None
+        # result_cache None is the connection's, and False is no cache
+        if result_cache is None:
+            result_cache = connection.result_cache
+        elif result_cache is False:
+            result_cache = None
+        else:
+            connection._result_caches.add(result_cache)
+        self.result_cache = result_cache
+        # seconds to wait for each response, multiplexing the connection
+        self.timeout = connection.timeout
+        self._timeout = self.timeout    # of the last execute(), also for its pages
         self.description = []
         self._rows = []
+        self._pos = 0
         self._rowcount = 0
         self.arraysize = 1
         self.query = None
+        self.args = ()
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self._paging_state = None
+        self._fetcher = None
+        self._convert_row = row_converter([])
 
     def __enter__(self):
         return self
@@ -331,91 +1940,206 @@ class Cursor(object):
     def setoutputsize(size, column=None):
         pass
 
-    def execute(self, query, args=()):
+    def execute(self, query, args=(), idempotent=False, trace=None, timeout=None):
+        """idempotent=True allows the statement to be sent again speculatively (see Cluster).
+        trace=True (default is the cursor's) sets self.trace to a Trace of the request.
+        OperationTimedOut is raised if the response doesn't arrive in timeout seconds
+        (default is the cursor's)."""
         if not self.connection or not self.connection.is_connect():
             raise ProgrammingError("Lost connection")
 
         self.description = []
-        self.args = args
-        if args:
-            escaped_args = tuple(escape_parameter(arg).replace('%', '%%') for arg in args)
-            query = query.replace('%', '%%').replace('%%s', '%s')
-            query = query % escaped_args
-            query = query.replace('%%', '%')
-        self.query = query
-        self.description, self._rows = self.connection._execute(query)
+        self.trace = None
+        self._cancel_fetch()
+        cache_ttl = self.result_cache.ttl_of(query) if self.result_cache is not None else 0
+        trace = self.tracing if trace is None else trace
+        timeout = self.timeout if timeout is None else timeout
+        self._timeout = timeout
+        self.query, self.args = self._bind_query(query, args)
+        self._set_result(*self._execute(idempotent, trace, cache_ttl, timeout))
+
+    def _execute(self, idempotent, trace=False, cache_ttl=0, timeout=None):
+        if timeout is not None:
+            # a blocked socket read can't be abandoned
+            self.connection._switch_to_multiplex()
+        future = self.connection._execute_async(
+            self.query, self.args, self.page_size, keyspace=self.keyspace, trace=trace,
+            result_cache=self.result_cache if cache_ttl else None, cache_ttl=cache_ttl
+        )
+        result = self.connection._wait(future, timeout)
+        self.trace = future.trace
+        return result
+
+    def execute_async(self, query, args=()):
+        "Execute query and return a future of a new Cursor holding the result"
+        if not self.connection or not self.connection.is_connect():
+            raise ProgrammingError("Lost connection")
+
+        cur = Cursor(
+            self.connection, self.page_size, self.prefetch, self.keyspace, self.tracing,
+            False if self.result_cache is None else self.result_cache, self.row_factory,
+            self.blob
+        )
+        cur.query, cur.args = self._bind_query(query, args)
+        future = concurrent.futures.Future()
+
+        def on_result(f):
+            try:
+                cur._set_result(*f.result())
+                cur.trace = f.trace
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(cur)
+
+        self.connection._execute_async(
+            cur.query, cur.args, self.page_size, keyspace=self.keyspace, trace=self.tracing
+        ).add_done_callback(on_result)
+        return future
+
+    def _bind_query(self, query, args):
+        """Return a PreparedStatement and args, or a query string with inlined args.
+        Queries with args of _BIND_TYPES are prepared on their first execution."""
+        if isinstance(query, str) and args:
+            connection = self.connection
+            stmt = connection._get_prepared(
+                query, connection._statement_cache.prepare_first(args), self.keyspace
+            )
+            return bind_args(query, args, stmt)
+        return query, args
+
+    def _set_result(self, description, rows, paging_state):
+        self.description, self._rows, self._paging_state = description, rows, paging_state
+        self._pos = 0
+        if self.blob is bytes:
+            self._convert_row = self.row_factory(description)
+        else:
+            self._convert_row = self.row_factory(description, blob=self.blob)
         self._rowcount = len(self._rows)
+        if self.prefetch:
+            self._start_fetch()
+
+    def _start_fetch(self):
+        if not self._paging_state:
+            return
+        if self.connection.multiplex:
+            self._fetcher = self.connection._execute_async(
+                self.query, self.args, self.page_size, self._paging_state, self.keyspace
+            )
+        else:
+            self._fetcher = _PageFetcher(
+                self.connection, self.query, self.args, self.page_size, self._paging_state,
+                self.keyspace
+            )
+
+    def _cancel_fetch(self):
+        # A multiplexed request is dropped, its stream is released when the response
+        # arrives, but _PageFetcher reads the socket and must finish first.
+        if isinstance(self._fetcher, _PageFetcher):
+            try:
+                self._fetcher.result(self._timeout)
+            except Exception:
+                pass
+        self._fetcher = None
+        self._paging_state = None
+
+    def _next_page(self):
+        "Load the next page into self._rows. Return False if no more pages."
+        if not self._paging_state:
+            return False
+        if self._fetcher:
+            fetcher, self._fetcher = self._fetcher, None
+            _, self._rows, self._paging_state = self.connection._wait(fetcher, self._timeout)
+        else:
+            _, self._rows, self._paging_state = self.connection._execute(
+                self.query, self.args, self.page_size, self._paging_state, self.keyspace,
+                self._timeout
+            )
+        self._pos = 0
+        self._rowcount += len(self._rows)
+        if self.prefetch:
+            self._start_fetch()
+        return True
+
+    def executemany(self, query, seq_of_params, batch_type=BATCH_UNLOGGED):
+        if not self.connection or not self.connection.is_connect():
+            raise ProgrammingError("Lost connection")
 
-    def executemany(self, query, seq_of_params):
+        if is_modification(query):
+            self.description = []
+            self._cancel_fetch()
+            self._rows, self._pos = [], 0
+            self._rowcount = self.connection.batch(
+                ((query, params) for params in seq_of_params), batch_type, self.keyspace
+            )
+            return
+
+        seq_of_params = list(seq_of_params)
+        if isinstance(query, str) and len(seq_of_params) > 1:
+            query = self.connection._get_prepared(query, True, self.keyspace) or query
         rowcount = 0
         for params in seq_of_params:
             self.execute(query, params)
             rowcount += self._rowcount
         self._rowcount = rowcount
 
-    def _convert_row(self, row):
-        for i in range(len(row)):
-            if row[i] is None:
-                continue
-            type_id = self.description[i][1]
-            if type_id in (0x0000, 0x0001, 0x000D):     # string
-                row[i] = row[i].decode('utf-8')
-            elif type_id in (0x0002, 0x0005, 0x0009, 0x000E, 0x0013, 0x0014):   # integer
-                row[i] = int.from_bytes(row[i], byteorder='big')
-            elif type_id in (0x0003, ):     # binary
-                pass
-            elif type_id in (0x0004, ):     # bool
-                row[i] = bool(int.from_bytes(row[i], byteorder='big'))
-            elif type_id in (0x0006, ):     # decimal
-                scale = int.from_bytes(row[i][:4], byteorder='big', signed=True)
-                unscaled = decode_varint(row[i][4:])
-                row[i] = decimal.Decimal('%de%d' % (unscaled, -scale))
-            elif type_id in (0x0007, ):     # double
-                row[i] = struct.unpack('>d', row[i])[0]
-            elif type_id in (0x0008, ):     # double
-                row[i] = struct.unpack('>f', row[i])[0]
-            elif type_id in (0x000B, ):     # Timestamp
-                row[i] = datetime.datetime.utcfromtimestamp(
-                    int.from_bytes(row[i], byteorder='big', signed=True) / 1000
-                ).replace(tzinfo=datetime.timezone.utc)
-            elif type_id in (0x000C, 0x000F):     # UUID
-                row[i] = uuid.UUID(bytes=row[i])
-            elif type_id in (0x0011, ):     # Date
-                days = int.from_bytes(row[i], byteorder='big') - 2 ** 31
-                dt = datetime.datetime(1970, 1, 1) + datetime.timedelta(days=days)
-                row[i] = datetime.date(dt.year, dt.month, dt.day)
-            elif type_id in (0x0012, ):     # Time
-                nanosec = int.from_bytes(row[i], byteorder='big')
-                microsecond = nanosec // 1000 % 1000000
-                second = nanosec // 1000000000 % 60
-                minute = nanosec // (60 * 1000000000) % 60
-                hour = nanosec // (3600 * 1000000000)
-                row[i] = datetime.time(hour, minute, second, microsecond)
-
-        return tuple(row)
-
-    def fetchone(self):
+    def _next_row(self):
+        "Return the next raw row, or None if no more rows"
         if not self.connection or not self.connection.is_connect():
             raise ProgrammingError("Lost connection")
-        if len(self._rows) == 0:
-            return None
-        return self._convert_row(self._rows.pop(0))
+        while self._pos >= len(self._rows):
+            if not self._next_page():
+                return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
 
-    def fetchmany(self, size=1):
+    def fetchone(self):
+        row = self._next_row()
+        return None if row is None else self._convert_row(row)
+
+    def fetchblob(self, file, column=0):
+        """Write the blob value of the column (index or name) of the next row into file
+        from the received frame without copying it, and return its length (0 if null),
+        or None if no more rows."""
+        row = self._next_row()
+        if row is None:
+            return None
+        if isinstance(column, str):
+            names = [d[0] for d in self.description]
+            if column not in names:
+                raise ProgrammingError("Unknown column %s" % (column, ))
+            column = names.index(column)
+        value = row[column]
+        if value is None:
+            return 0
+        file.write(value)
+        return len(value)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
         rs = []
         for i in range(size):
             r = self.fetchone()
-            if not r:
+            if r is None:
                 break
             rs.append(r)
         return rs
 
     def fetchall(self):
-        rows = list(self._rows)
-        self._rows = []
-        return [self._convert_row(r) for r in rows]
+        convert_row = self._convert_row
+        if self._pos:
+            rows = [convert_row(self._rows[i]) for i in range(self._pos, len(self._rows))]
+        else:
+            rows = list(map(convert_row, self._rows))
+        self._rows, self._pos = [], 0
+        while self._next_page():
+            rows.extend(map(convert_row, self._rows))
+            self._rows = []
+        return rows
 
     def close(self):
+        self._cancel_fetch()
         self.connection = None
 
     @property
@@ -431,7 +2155,7 @@ class Cursor(object):
 
     def __next__(self):
         r = self.fetchone()
-        if not r:
+        if r is None:
             raise StopIteration()
         return r
 
@@ -441,119 +2165,1273 @@ class Cursor(object):
 
 class Connection:
 
-    def _send(self, b):
-        n = 0
-        while (n < len(b)):
-            n += self._sock.send(b[n:])
+    def _send(self, *buffers):
+        "Send buffers with one gathering write if possible"
+        if len(buffers) == 1 or isinstance(self._sock, ssl.SSLSocket):
+            joined = join_buffers(buffers)
+            for b in joined if isinstance(joined, list) else [joined]:
+                self._sock.sendall(b)
+            return
+        buffers = [memoryview(b).cast('B') for b in buffers]
+        while buffers:
+            n = self._sock.sendmsg(buffers[:512])  # within IOV_MAX
+            while buffers and n >= len(buffers[0]):
+                n -= len(buffers.pop(0))
+            if n:
+                buffers[0] = buffers[0][n:]
+
+    def _fill(self, ln):
+        "Read ahead into the receive buffer until ln bytes are buffered"
+        if self._buf_start + ln > len(self._buf):
+            self._buf[:self._buf_end-self._buf_start] = self._buf[self._buf_start:self._buf_end]
+            self._buf_end -= self._buf_start
+            self._buf_start = 0
+        view = memoryview(self._buf)
+        while self._buf_end - self._buf_start < ln:
+            n = self._sock.recv_into(view[self._buf_end:])
+            if not n:
+                raise socket.error("Can't recv packets")
+            self._buf_end += n
 
     def _recv(self, ln):
-        r = b''
-        while len(r) < ln:
-            b = self._sock.recv(ln-len(r))
-            if not b:
-                raise socket.error("Can't recv packets")
-            r += b
+        buffered = self._buf_end - self._buf_start
+        if ln > len(self._buf):
+            # large data is received directly into its own buffer
+            r = bytearray(ln)
+            r[:buffered] = self._buf[self._buf_start:self._buf_end]
+            self._buf_start = self._buf_end = 0
+            view = memoryview(r)
+            while buffered < ln:
+                n = self._sock.recv_into(view[buffered:])
+                if not n:
+                    raise socket.error("Can't recv packets")
+                buffered += n
+            return r
+        if buffered < ln:
+            self._fill(ln)
+        r = bytes(self._buf[self._buf_start:self._buf_start+ln])
+        self._buf_start += ln
         return r
 
-    def _send_frame(self, opcode, body=b''):
-        self._send(struct.pack(
-            ">BBHBL",
-            REQUEST_PROTOCOL_VERSION,
-            0,
-            self.stream_number,
+    def _send_frame(self, opcode, body=b'', stream=None, flags=0):
+        "body is bytes, or a list of buffers sent without copying them (see join_buffers)"
+        if stream is None:
+            stream = self.stream_number
+            self.stream_number += 1
+            if self.stream_number > 32767:
+                self.stream_number = 0
+        if self._compress and isinstance(body, list):
+            body = b''.join(body)
+        if self._compress and len(body) > self.compression_threshold:
+            compressed = self._compress(body)
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= COMPRESSION_FLAG
+        header = struct.pack(
+            ">BBhBL",
+            self.protocol_version,
+            flags,
+            stream,
             opcode,
-            len(body),
-        ))
-        self._send(body)
-
-        self.stream_number += 1
-        if self.stream_number > 32768:
-            self.stream_number = 0
-
-    def _recv_frame(self):
-        header = self._recv(9)
-        # stream = int.from_bytes(header[2:4], byteorder='big')
-        ln = int.from_bytes(header[-4:], byteorder='big')
-        body = self._recv(ln)
-        opcode = header[4]
-        if opcode == OP_ERROR:
-            n, b = decode_int(body)
-            if n == 0x0001000d:
-                # ??? Azure Cosmos DB has unknown prefix bytes
-                body = body[29:]
-                n, b = decode_int(body)
-            s, b = decode_string(b)
-            raise OperationalError(n, s)
-        return opcode, body
-
-    def _execute(self, query):
-        body = encode_long_string(query) + b'\x00\x01\x00'
-        self._send_frame(OP_QUERY, body)
-        opcode, body = self._recv_frame()
-        kind, b = decode_int(body)
-        assert opcode == OP_RESULT
-        if kind == 0x0001000d:
-            # ??? Azure Cosmos DB has unknown prefix bytes
-            body = body[29:]
-            kind, b = decode_int(body)
-        if kind == 2:
-            description, data, more_data = decode_rows(body)
+            sum(len(b) for b in body) if isinstance(body, list) else len(body),
+        )
+        if isinstance(body, list):
+            frames = [[header] + body] if self._framing else [header] + body
+        elif self._framing or len(body) < 4096:
+            frames = [header + body]
         else:
-            description = data = []
-
-        return description, data
+            frames = [header, body]
+
+        # Frames queued while another thread is writing are sent together
+        # by that thread, with one write (and in one segment with v5).
+        with self._write_lock:
+            self._outgoing.extend(frames)
+            if self._writing:
+                return
+            self._writing = True
+        try:
+            while True:
+                with self._write_lock:
+                    frames, self._outgoing = self._outgoing[:512], self._outgoing[512:]
+                    if not frames:
+                        self._writing = False
+                        return
+                if self._framing:
+                    frames = encode_segments(
+                        frames, self._segment_compress, self.compression_threshold
+                    )
+                self._send(*frames)
+        except BaseException:
+            with self._write_lock:
+                self._outgoing = []
+                self._writing = False
+            raise
+
+    def _read_segment(self):
+        "Read a v5 segment and append its payload to self._envelopes"
+        if self._segment_decompress:
+            ln, uncompressed_length = decode_segment_header(self._recv(8))
+        else:
+            ln, uncompressed_length = decode_segment_header(self._recv(6))
+        self._envelopes += decode_segment_payload(
+            self._recv(ln + 4), uncompressed_length, self._segment_decompress
+        )
+
+    def _read_frame(self):
+        "Return stream, opcode and body. self._tracing is set for traced responses"
+        if self._framing:
+            envelopes = self._envelopes
+            while len(envelopes) < 9:
+                self._read_segment()
+            received = time.perf_counter() if envelopes[1] & TRACING_FLAG else None
+            ln = int.from_bytes(envelopes[5:9], byteorder='big')
+            while len(envelopes) < 9 + ln:
+                self._read_segment()
+            header = bytes(envelopes[:9])
+            if len(envelopes) == 9 + ln and ln >= LARGE_VALUE_SIZE:
+                # a large frame filling the buffer is handed over without copying
+                del envelopes[:9]
+                body = envelopes
+                self._envelopes = bytearray()
+            else:
+                body = bytes(envelopes[9:9+ln])
+                del envelopes[:9+ln]
+        else:
+            header = self._recv(9)
+            received = time.perf_counter() if header[1] & TRACING_FLAG else None
+            ln = int.from_bytes(header[-4:], byteorder='big')
+            body = self._recv(ln)
+            if header[1] & COMPRESSION_FLAG:
+                body = self._decompress(body)
+        self._tracing = None
+        if header[1] & (TRACING_FLAG | WARNING_FLAG | CUSOM_PAYLOAD_FLAG):
+            tracing_id, warnings, body = decode_frame_prefix(header[1], body)
+            if tracing_id:
+                self._tracing = {
+                    'tracing_id': tracing_id, 'warnings': warnings,
+                    'received': received, 'read': time.perf_counter(),
+                }
+        return int.from_bytes(header[2:4], byteorder='big', signed=True), header[4], body
 
-    def __init__(self, host, keyspace, port, user, password, use_ssl):
+    def _recv_frame(self):
+        stream, opcode, body = self._read_frame()
+        while stream == -1 and opcode == OP_EVENT:
+            self._dispatch_event(body)
+            stream, opcode, body = self._read_frame()
+        return check_frame(opcode, body)
+
+    def _dispatch_event(self, body):
+        event = decode_event(body)
+        for event_types, listener in list(self._listeners):
+            if event['type'] in event_types:
+                try:
+                    listener(event)
+                except Exception:
+                    # a failing listener must not break the connection
+                    pass
+
+    def _reader(self):
+        "Receive frames and route them to waiters by stream id (multiplex mode)"
+        try:
+            while True:
+                stream, opcode, body = self._read_frame()
+                if stream == -1 and opcode == OP_EVENT:
+                    self._dispatch_event(body)
+                    continue
+                with self._lock:
+                    future = self._waiters.pop(stream, None)
+                    if future is not None:
+                        self._free_streams.append(stream)
+                        self._stream_semaphore.release()
+                if future is None:
+                    continue
+                if self._tracing and future.timings is not None:
+                    future.timings.setdefault('sent', self._tracing['received'])
+                    future.timings.update(self._tracing)
+                try:
+                    future.set_result(check_frame(opcode, body))
+                except Error as e:
+                    future.set_exception(e)
+        except Exception as e:
+            # the connection is lost, later requests fail at once
+            with self._lock:
+                waiters, self._waiters = self._waiters, {}
+                sock, self._sock = self._sock, None
+            if sock:
+                sock.close()
+            for future in waiters.values():
+                future.set_exception(e)
+
+    def _request(self, opcode, body=b''):
+        if self.multiplex:
+            return self._wait(self._request_async(opcode, body), self.timeout)
+        with self._lock:
+            self._send_frame(opcode, body)
+            return self._recv_frame()
+
+    def _request_async(self, opcode, body=b'', flags=0, block=True):
+        """With TRACING_FLAG, future.timings has the times of the request and the tracing id.
+        block=False fails at once if no stream is free, as the reader thread must not wait."""
+        future = concurrent.futures.Future()
+        future.timings = {} if flags & TRACING_FLAG else None
+        if not self.multiplex:
+            try:
+                with self._lock:
+                    self._send_frame(opcode, body, flags=flags)
+                    if future.timings is not None:
+                        future.timings['sent'] = time.perf_counter()
+                    result = self._recv_frame()
+                    if self._tracing and future.timings is not None:
+                        future.timings.update(self._tracing)
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        if not self._stream_semaphore.acquire(block, self.timeout if block else None):
+            if not block:
+                raise OperationalError(-1, "No free stream on %s:%d" % (self.host, self.port))
+            raise OperationTimedOut("No free stream on %s:%d" % (self.host, self.port))
+        with self._lock:
+            if not self._sock:
+                self._stream_semaphore.release()
+                raise OperationalError(-1, "Lost connection")
+            stream = self._free_streams.pop()
+            self._waiters[stream] = future
+        try:
+            self._send_frame(opcode, body, stream, flags)
+            if future.timings is not None:
+                future.timings.setdefault('sent', time.perf_counter())
+        except Exception:
+            with self._lock:
+                if self._waiters.pop(stream, None) is not None:
+                    self._free_streams.append(stream)
+                    self._stream_semaphore.release()
+            raise
+        return future
+
+    def _get_prepared(self, query, force=False, keyspace=None):
+        "Return cached PreparedStatement of a 'format' paramstyle query, or None"
+        key = (keyspace, query) if keyspace else query
+        stmt, need_prepare = self._statement_cache.lookup(key, force)
+        if need_prepare:
+            try:
+                stmt = self.prepare('?'.join(query_template(query).parts), keyspace)
+            except OperationTimedOut:
+                raise
+            except OperationalError:
+                stmt = None
+            self._statement_cache.store(key, stmt)
+        return stmt
+
+    def prepare(self, query, keyspace=None):
+        "keyspace of the statement other than the connection's needs protocol v5"
+        kind, body = decode_result(*self._request(
+            OP_PREPARE, encode_prepare(query, self.protocol_version, keyspace)
+        ))
+        return PreparedStatement(
+            query, *decode_prepared(body, self.protocol_version), keyspace=keyspace
+        )
+
+    def _reprepare(self, query):
+        "Prepare PreparedStatement again which the server has evicted"
+        stmt = self.prepare(query.query, query.keyspace)
+        query.query_id, query.description = stmt.query_id, stmt.description
+        query.result_metadata_id = stmt.result_metadata_id
+
+    def _execute_async(
+        self, query, args=(), page_size=None, paging_state=None, keyspace=None, trace=False,
+        result_cache=None, cache_ttl=0
+    ):
+        """Return a future of (description, rows, paging_state). future.trace is a Trace if trace.
+        SELECT results are read through result_cache."""
+        start = time.perf_counter() if trace else None
+        opcode, body = encode_query(
+            query, args, page_size, paging_state, self.protocol_version, keyspace
+        )
+        flags = TRACING_FLAG if trace else 0
+        encoded = time.perf_counter() if trace else None
+        future = concurrent.futures.Future()
+        future.trace = None
+
+        table = cache_key = None
+        if self._result_caches:
+            table = query_table(query)
+            if not is_select(query):
+                caches = list(self._result_caches)
+
+                def invalidate(f=None):
+                    for cache in caches:
+                        cache.invalidate(table)
+                invalidate()
+                # and again when it's applied, for reads which overtook the write
+                future.add_done_callback(invalidate)
+            elif result_cache is not None and not paging_state and not trace and isinstance(
+                body, bytes
+            ):
+                cache_key = (self.keyspace, body)
+                result = result_cache.get(cache_key)
+                if result:
+                    future.set_result(result)
+                    return future
+                generation = result_cache.generation(table)
+
+        def on_prepared(f):
+            try:
+                _, prepared = decode_result(*f.result())
+                (
+                    query.query_id, _, _, query.description, query.result_metadata_id
+                ) = decode_prepared(prepared, self.protocol_version)
+                # result_metadata_id of the request may have changed
+                opcode, body = encode_query(
+                    query, args, page_size, paging_state, self.protocol_version
+                )
+                # in the reader thread
+                self._request_async(opcode, body, flags, False).add_done_callback(on_response)
+            except Exception as e:
+                future.set_exception(e)
+
+        def on_response(f, reprepare=False):
+            try:
+                response = f.result()
+                result = decode_query_result(query, *response)
+                if cache_key and not result[2]:
+                    result_cache.put(
+                        cache_key, table, generation, result, len(response[1]), cache_ttl
+                    )
+                t = f.timings
+                if t and 'tracing_id' in t:
+                    future.trace = Trace(self, t['tracing_id'], t['warnings'], {
+                        'encode': encoded - start,
+                        'send': t['sent'] - encoded,
+                        'wait': t['received'] - t['sent'],
+                        'receive': t['read'] - t['received'],
+                        'decode': time.perf_counter() - t['read'],
+                    })
+                future.set_result(result)
+            except OperationalError as e:
+                if not (reprepare and e.code == 0x2500):    # Unprepared
+                    future.set_exception(e)
+                    return
+                try:
+                    # in the reader thread
+                    self._request_async(
+                        OP_PREPARE, encode_prepare(query.query, self.protocol_version, query.keyspace),
+                        block=False
+                    ).add_done_callback(on_prepared)
+                except Exception as e:
+                    future.set_exception(e)
+            except Exception as e:
+                future.set_exception(e)
+
+        self._request_async(opcode, body, flags).add_done_callback(
+            functools.partial(on_response, reprepare=isinstance(query, PreparedStatement))
+        )
+        return future
+
+    def _execute(
+        self, query, args=(), page_size=None, paging_state=None, keyspace=None, timeout=None
+    ):
+        return self._wait(self._execute_async(query, args, page_size, paging_state, keyspace), timeout)
+
+    def _wait(self, future, timeout=None):
+        """Return the result of the future of a request, or raise OperationTimedOut if it
+        doesn't complete in timeout seconds. The timed out request is abandoned, and its
+        stream id is released when the late response arrives, so the connection stays usable."""
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            if future.done():
+                raise
+            raise OperationTimedOut("%s:%d did not respond in %g seconds" % (
+                self.host, self.port, timeout
+            ))
+
+    def _bind_statement(self, query, args, keyspace=None):
+        "Return (query, encoded values) of a batch entry"
+        if isinstance(query, str) and args:
+            query = self._get_prepared(query, True, keyspace) or format_query(query, args)
+        if isinstance(query, PreparedStatement):
+            return query, query.bind(args)
+        return query, []
+
+    def _invalidate(self, entries):
+        for cache in list(self._result_caches):
+            for table in set(query_table(q) for q, _ in entries):
+                cache.invalidate(table)
+
+    def _execute_batch(self, entries, batch_type, keyspace=None):
+        self._invalidate(entries)
+        try:
+            decode_result(*self._request(OP_BATCH, encode_batch(
+                entries, batch_type, self.protocol_version, keyspace
+            )))
+        except OperationalError as e:
+            if e.code != 0x2500:    # Unprepared
+                raise
+            for query in set(q for q, _ in entries if isinstance(q, PreparedStatement)):
+                self._reprepare(query)
+            decode_result(*self._request(OP_BATCH, encode_batch(
+                entries, batch_type, self.protocol_version, keyspace
+            )))
+        finally:
+            # again for reads which overtook the batch
+            self._invalidate(entries)
+
+    def batch(self, statements, batch_type=BATCH_UNLOGGED, keyspace=None):
+        """Execute (query, args) statements by BATCH requests, split into chunks of
+        batch_max_statements statements and about batch_max_bytes.
+        Return the number of statements executed."""
+        entries = (self._bind_statement(query, args, keyspace) for query, args in statements)
+        rowcount = 0
+        for i, chunk in enumerate(
+            chunk_batch(entries, self.batch_max_statements, self.batch_max_bytes)
+        ):
+            try:
+                self._execute_batch(chunk, batch_type, keyspace)
+            except OperationTimedOut:
+                raise
+            except OperationalError as e:
+                raise OperationalError(e.code, "batch chunk %d (statements %d-%d) failed: %s" % (
+                    i, rowcount, rowcount + len(chunk) - 1, e.message
+                ))
+            rowcount += len(chunk)
+        return rowcount
+
+    def __init__(
+        self, host, keyspace, port, user, password, use_ssl,
+        page_size=None, prepare_threshold=2, statement_cache_size=256,
+        multiplex=False, max_requests=32768, compression=None, compression_threshold=512,
+        recv_buffer_size=65536, batch_max_statements=100, batch_max_bytes=40960,
+        protocol_version=PROTOCOL_VERSION_V5, result_cache=None, row_factory='tuple',
+        connect_timeout=None, timeout=None,
+    ):
         self.host = host
         self.keyspace = keyspace
         self.port = port
         self.user = user
         self.password = password
         self.use_ssl = use_ssl
+        self.page_size = page_size
+        self.batch_max_statements = batch_max_statements
+        self.batch_max_bytes = batch_max_bytes
+        self._statement_cache = StatementCache(statement_cache_size, prepare_threshold)
+        self.result_cache = result_cache
+        self.row_factory = resolve_row_factory(row_factory)
+        self._result_caches = weakref.WeakSet()
+        if result_cache is not None:
+            self._result_caches.add(result_cache)
+        self._listeners = []
+        self.multiplex = False
+        self.compression = None
+        self.compression_threshold = compression_threshold
+        self._compress = self._decompress = None
+        self._segment_compress = self._segment_decompress = None
         self.stream_number = 0
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.connect((self.host, self.port))
-        if self.use_ssl:
-            self._sock = ssl.wrap_socket(self._sock)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._outgoing = []
+        self._writing = False
+        self._buf = bytearray(recv_buffer_size)
+        # seconds to wait for a response by default, requests are multiplexed to wait for them
+        self.timeout = timeout
+        if timeout is not None:
+            multiplex = True
+        # connect and handshake must complete within connect_timeout seconds
+        deadline = None if connect_timeout is None else time.monotonic() + connect_timeout
+        self._sock = None
+        self.max_requests = max_requests
+        try:
+            self._handshake(protocol_version, compression, deadline)
+            # the reader thread waits for responses without socket timeout
+            self._sock.settimeout(None if multiplex else self._remaining(deadline))
+            if multiplex:
+                self._start_reader()
+            if self.keyspace:
+                self._execute("use " + keyspace, timeout=self._remaining(deadline))
+            self._sock.settimeout(None)
+        except (socket.timeout, OperationTimedOut):
+            if self._sock:
+                self.close()
+            raise OperationTimedOut("Connecting to %s:%d timed out" % (self.host, self.port))
+
+    def _remaining(self, deadline):
+        "Return seconds until the deadline (time.monotonic), or None without deadline"
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("timed out")
+        return remaining
+
+    def _handshake(self, protocol_version, compression, deadline):
+        # try v5, and v4 if the server rejects it
+        while True:
+            self.protocol_version = protocol_version
+            self._open(self._remaining(deadline))
+            try:
+                self._send_frame(OP_OPTIONS)
+                opcode, body = self._recv_frame()
+                break
+            except (OperationalError, OSError) as e:
+                self._sock.close()
+                if protocol_version <= REQUEST_PROTOCOL_VERSION or isinstance(
+                    e, socket.timeout
+                ) or (
+                    isinstance(e, OperationalError) and e.code != 0x000A    # Protocol error
+                ):
+                    raise
+                protocol_version -= 1
 
-        self._send_frame(OP_OPTIONS)
-        opcode, body = self._recv_frame()
         assert opcode == OP_SUPPORTED
         supported_params, _ = decode_string_multimap(body)
-        body = encode_string_map({'CQL_VERSION': supported_params['CQL_VERSION'][0]})
-        self._send_frame(OP_STARTUP, body)
+        startup = {'CQL_VERSION': supported_params['CQL_VERSION'][0]}
+        if protocol_version >= PROTOCOL_VERSION_V5 and compression:
+            # v5 compresses segments, only with lz4
+            compression = 'lz4' if compression == 'lz4' or not isinstance(compression, str) else None
+        compression = choose_compression(supported_params, compression)
+        if compression:
+            startup['COMPRESSION'] = compression
+        self._send_frame(OP_STARTUP, encode_string_map(startup))
+        if compression:
+            self.compression = compression
+            if protocol_version < PROTOCOL_VERSION_V5:
+                self._compress, self._decompress = COMPRESSIONS[compression]
+        self._sock.settimeout(self._remaining(deadline))
         opcode, body = self._recv_frame()
+        if protocol_version >= PROTOCOL_VERSION_V5:
+            # frames after the response to STARTUP are in segments
+            self._framing = True
+            if compression:
+                self._segment_compress = lz4_compress_block
+                self._segment_decompress = lz4_decompress_block
 
         if opcode == OP_AUTHENTICATE:
-            if not (self.user and self.password):
-                raise ValueError("Need credentials")
-            body = b'\x00' + self.user.encode('utf-8') + b'\x00' + self.password.encode('utf-8')
-            body = encode_integer(len(body), 4) + body
-            self._send_frame(OP_AUTH_RESPONSE, body)
+            self._send_frame(OP_AUTH_RESPONSE, encode_auth_response(self.user, self.password))
+            self._sock.settimeout(self._remaining(deadline))
             opcode, _ = self._recv_frame()
             assert opcode == OP_AUTH_SUCCESS
         else:
             assert opcode == OP_READY
 
-        if self.keyspace:
-            self._execute("use " + keyspace)
-
     def __enter__(self):
         return self
 
     def __exit__(self, exc, value, traceback):
         self.close()
 
+    def _open(self, timeout=None):
+        self._framing = False
+        self._envelopes = bytearray()
+        self._buf_start = self._buf_end = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.settimeout(timeout)
+        self._sock.connect((self.host, self.port))
+        if self.use_ssl:
+            self._sock = ssl.wrap_socket(self._sock)
+
+    def _start_reader(self):
+        self._waiters = {}
+        self._free_streams = list(reversed(range(self.max_requests)))
+        self._stream_semaphore = threading.Semaphore(self.max_requests)
+        self.multiplex = True
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _switch_to_multiplex(self):
+        with self._lock:
+            if not self.multiplex:
+                self._start_reader()
+
+    def register(self, event_types, listener):
+        """Register listener(event) called for server pushed events.
+        event_types are some of 'TOPOLOGY_CHANGE', 'STATUS_CHANGE' and 'SCHEMA_CHANGE'.
+        The connection switches to multiplex mode to receive events while idle,
+        and listeners are called in its reader thread.
+        """
+        if isinstance(event_types, str):
+            event_types = [event_types]
+        self._switch_to_multiplex()
+        entry = (frozenset(event_types), listener)
+        self._listeners.append(entry)
+        try:
+            opcode, _ = self._request(OP_REGISTER, encode_string_list(event_types))
+        except Exception:
+            self._listeners.remove(entry)
+            raise
+        assert opcode == OP_READY
+
     def is_connect(self):
         return bool(self._sock)
 
-    def cursor(self):
-        return Cursor(self)
+    def cursor(
+        self, page_size=None, prefetch=True, keyspace=None, trace=False, result_cache=None,
+        row_factory=None, blob=bytes
+    ):
+        "keyspace other than the connection's, which needs protocol v5"
+        return Cursor(
+            self, page_size or self.page_size, prefetch, keyspace, trace, result_cache,
+            row_factory, blob
+        )
+
+    def ping(self):
+        "Send OPTIONS and return True if the server responds"
+        try:
+            opcode, _ = self._request(OP_OPTIONS)
+        except (Error, OSError):
+            return False
+        return opcode == OP_SUPPORTED
 
     def close(self):
-        self._sock.close()
-        self._sock = None
+        sock, self._sock = self._sock, None
+        if not sock:
+            return      # lost already
+        if self.multiplex:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        sock.close()
+
+
+class _HostPool:
+    def __init__(self, connect, min_size, max_size, max_idle, ping_interval):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        self.size = 0
+        self._idle = collections.deque()    # (connection, released time) oldest first
+        self._cond = threading.Condition()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._idle and self.size > self.min_size and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.popleft()
+            self.size -= 1
+            conn.close()
+
+    def _discard(self, conn):
+        if conn.is_connect():
+            conn.close()
+        with self._cond:
+            self.size -= 1
+            self._cond.notify()
+
+    def fill(self):
+        while self.size < self.min_size:
+            self.size += 1
+            self._idle.append((self.connect(), time.monotonic()))
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                self._evict()
+                while not self._idle and self.size >= self.max_size:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if (remaining is not None and remaining <= 0) or not self._cond.wait(remaining):
+                        raise OperationalError(-1, "Connection pool exhausted")
+                if self._idle:
+                    conn, released = self._idle.pop()
+                else:
+                    self.size += 1
+                    conn = released = None
+
+            if conn is None:
+                try:
+                    return self.connect()
+                except Exception:
+                    with self._cond:
+                        self.size -= 1
+                        self._cond.notify()
+                    raise
+            if conn.is_connect() and (
+                time.monotonic() - released < self.ping_interval or conn.ping()
+            ):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn):
+        if not conn.is_connect():
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._evict()
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                self.size -= 1
+                conn.close()
+
+
+class Pool:
+    """Thread safe pool of connections to one or more hosts.
+    min_size and max_size are per host. Idle connections over min_size are closed
+    after max_idle seconds, and connections idle over ping_interval seconds are
+    validated by OPTIONS request before they are handed out.
+    acquire() waits up to acquire_timeout seconds for a free connection. Other
+    kwargs are of connect(), e.g. timeout and connect_timeout of the connections.
+    """
+    def __init__(
+        self, hosts, keyspace=None, port=9042, user=None, password=None, use_ssl=False,
+        min_size=1, max_size=8, max_idle=600, ping_interval=30, acquire_timeout=None, **kwargs
+    ):
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        self.acquire_timeout = acquire_timeout
+        self._pools = {}
+        for host in hosts:
+            self._pools[host] = _HostPool(
+                functools.partial(
+                    Connection, host, keyspace, port, user, password, use_ssl, **kwargs
+                ),
+                min_size, max_size, max_idle, ping_interval
+            )
+        self._hosts = itertools.cycle(hosts)
+        self._lock = threading.Lock()
+        for pool in self._pools.values():
+            pool.fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        self.close()
+
+    def acquire(self, host=None):
+        if host is None:
+            with self._lock:
+                host = next(self._hosts)
+        return self._pools[host].acquire(self.acquire_timeout)
+
+    def release(self, conn):
+        self._pools[conn.host].release(conn)
+
+    @contextlib.contextmanager
+    def connection(self, host=None):
+        conn = self.acquire(host)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
+
+
+class SpeculativeExecution:
+    """Speculative execution policy of Cluster.
+    When an idempotent statement gets no response within delay seconds
+    (or percentile of observed latencies, once min_samples are observed),
+    it is sent to another node too, up to max_hedges times.
+    The first response wins and the others are ignored.
+    """
+    def __init__(self, delay=0.1, percentile=None, max_hedges=1, samples=1000, min_samples=100):
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.max_hedges = max_hedges
+        self.min_samples = min_samples
+        self.executions = 0
+        self.fired = 0
+        self.won = 0
+        self._latencies = collections.deque(maxlen=samples)
+        self._delay = delay
+        self._lock = threading.Lock()
+
+    def delay(self):
+        return self._delay
+
+    def record(self, latency, fired, won):
+        with self._lock:
+            self.executions += 1
+            self.fired += fired
+            self.won += won
+            self._latencies.append(latency)
+            # re-calculate the percentile once in a while, not every execution
+            if self.percentile is not None and len(self._latencies) >= self.min_samples and (
+                self.executions % 64 == 0 or len(self._latencies) == self.min_samples
+            ):
+                latencies = sorted(self._latencies)
+                self._delay = latencies[
+                    min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+                ]
+
+    def stats(self):
+        return {'executions': self.executions, 'fired': self.fired, 'won': self.won}
+
+
+def partition_key_columns(conn, table, keyspace):
+    "Return [(column_name, type name)] of the partition key of the table"
+    cur = conn.cursor(result_cache=False)
+    cur.execute(
+        "SELECT column_name, kind, position, type FROM system_schema.columns "
+        "WHERE keyspace_name=%s AND table_name=%s", (keyspace, table)
+    )
+    columns = sorted(
+        (position, column_name, column_type)
+        for column_name, kind, position, column_type in cur.fetchall()
+        if kind == 'partition_key'
+    )
+    if not columns:
+        raise ProgrammingError("Unknown table %s.%s" % (keyspace, table))
+    return [(column_name, column_type) for _, column_name, column_type in columns]
+
+
+class ClusterCursor(Cursor):
+    "Cursor which sends each statement to a replica of its partition"
+    def __init__(
+        self, cluster, page_size=None, prefetch=True, keyspace=None, trace=False,
+        result_cache=None, row_factory=None, blob=bytes
+    ):
+        super().__init__(
+            cluster.control_connection, page_size, prefetch, keyspace, trace, result_cache,
+            row_factory, blob
+        )
+        self.cluster = cluster
+
+    def _bind_query(self, query, args):
+        self.connection = self.cluster.control_connection
+        query, args = super()._bind_query(query, args)
+        self.connection = self.cluster.route(query, args)
+        return query, args
+
+    def _execute(self, idempotent, trace=False, cache_ttl=0, timeout=None):
+        if self.result_cache is not None:
+            self.connection._result_caches.add(self.result_cache)
+        if idempotent and self.cluster.speculative:
+            self.connection, future = self.cluster._execute_speculative(
+                self.connection, self.query, self.args, self.page_size, self.keyspace, trace,
+                timeout
+            )
+            self.trace = future.trace
+            return future.result()
+        try:
+            return super()._execute(idempotent, trace, cache_ttl, timeout)
+        except OperationTimedOut:
+            # an idempotent statement is tried once more on another node
+            hedge = self.cluster._hedge_connection({self.connection.host}) if idempotent else None
+            if hedge is None:
+                raise
+            self.connection = hedge
+            return super()._execute(idempotent, trace, cache_ttl, timeout)
 
+    def close(self):
+        super().close()
+        self.cluster = None
+
+
+class Cluster:
+    """Token aware client of a cluster.
+    It discovers nodes and their tokens from system.local and system.peers, and
+    sends bound statements to a replica of the partition computing Murmur3 token.
+    With watch_events the control connection registers for topology, status and
+    schema change events, and the ring is refreshed when they arrive.
+    """
+    def __init__(
+        self, hosts, keyspace=None, port=9042, user=None, password=None, use_ssl=False,
+        watch_events=True, refresh_delay=1.0, speculative=None, **kwargs
+    ):
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        self.speculative = speculative
+        if speculative:
+            # requests must be in flight on several connections at once
+            kwargs['multiplex'] = True
+        self.keyspace = keyspace
+        self.port = port
+        self._connect = functools.partial(
+            Connection, keyspace=keyspace, port=port, user=user, password=password,
+            use_ssl=use_ssl, **kwargs
+        )
+        self._connections = {}
+        self._partition_keys = {}
+        self._lock = threading.Lock()
+        self._tokens = []
+        self._owners = []
+        self._down = set()
+        self._refresh_timer = None
+        self.refresh_delay = refresh_delay
+        self.hosts = []
+        self.control_connection = None
+        error = None
+        for host in hosts:
+            try:
+                self.control_connection = self._connect(host)
+                break
+            except (Error, OSError) as e:
+                error = e
+        if self.control_connection is None:
+            raise error
+        self._connections[self.control_connection.host] = self.control_connection
+        self.refresh()
+        if watch_events:
+            self.control_connection.register(
+                ['TOPOLOGY_CHANGE', 'STATUS_CHANGE', 'SCHEMA_CHANGE'], self._on_event
+            )
+
+    def __enter__(self):
+        return self
 
-def connect(host, keyspace=None, port=9042, user=None, password=None, use_ssl=False):
-    return Connection(host, keyspace, port, user, password, use_ssl)
+    def __exit__(self, exc, value, traceback):
+        self.close()
+
+    def _query(self, query, args=()):
+        cur = self.control_connection.cursor(result_cache=False)
+        cur.execute(query, args)
+        return cur.fetchall()
+
+    def refresh(self):
+        "Reload nodes and the token ring"
+        ring = []
+        host = self.control_connection.host
+        hosts = [host]
+        for tokens, in self._query("SELECT tokens FROM system.local WHERE key='local'"):
+            ring.extend((int(t), host) for t in tokens or ())
+        for peer, rpc_address, tokens in self._query(
+            "SELECT peer, rpc_address, tokens FROM system.peers"
+        ):
+            host = str(rpc_address if rpc_address and not rpc_address.is_unspecified else peer)
+            hosts.append(host)
+            ring.extend((int(t), host) for t in tokens or ())
+        ring.sort()
+        with self._lock:
+            self.hosts = hosts
+            self._tokens = [t for t, _ in ring]
+            self._owners = [h for _, h in ring]
+            self._round_robin = itertools.cycle(hosts)
+
+    def _on_event(self, event):
+        "Called in the reader thread of the control connection"
+        if event['type'] == 'SCHEMA_CHANGE':
+            with self._lock:
+                for key in list(self._partition_keys):
+                    if key[0] == event['keyspace'] and (
+                        event['target'] == 'KEYSPACE' or key[1] == event.get('name')
+                    ):
+                        del self._partition_keys[key]
+            return
+        host = event['address'][0]
+        conn = None
+        with self._lock:
+            if event['change'] in ('DOWN', 'REMOVED_NODE'):
+                self._down.add(host)
+                if host != self.control_connection.host:
+                    conn = self._connections.pop(host, None)
+            else:
+                self._down.discard(host)
+            # events come in bursts, refresh once after them
+            if self._refresh_timer is None:
+                self._refresh_timer = threading.Timer(self.refresh_delay, self._refresh_on_event)
+                self._refresh_timer.daemon = True
+                self._refresh_timer.start()
+        if conn is not None and conn.is_connect():
+            conn.close()
+
+    def _refresh_on_event(self):
+        with self._lock:
+            self._refresh_timer = None
+        try:
+            self.refresh()
+        except (Error, OSError):
+            pass
+
+    def replica(self, token):
+        "Return the host which owns the token"
+        i = bisect.bisect_left(self._tokens, token)
+        if i == len(self._tokens):
+            i = 0
+        return self._owners[i]
+
+    def connection(self, host):
+        "Return the connection to the host, connecting if not yet"
+        with self._lock:
+            conn = self._connections.get(host)
+        if conn is not None and conn.is_connect():
+            return conn
+        conn = self._connect(host)
+        with self._lock:
+            self._connections[host] = conn
+        return conn
+
+    def route(self, query, args=()):
+        "Return a connection to a replica for the query, or to any node if unknown"
+        host = None
+        if isinstance(query, PreparedStatement) and query.pk_indexes and args and self._tokens:
+            key = routing_key([
+                encode_value(args[i], query.params[i][1], query.params[i][2])
+                for i in query.pk_indexes
+            ])
+            host = self.replica(murmur3(key))
+        elif self.hosts:
+            with self._lock:
+                host = next(self._round_robin)
+        return self._connection_or_control(host)
+
+    def _connection_or_control(self, host):
+        "Return a connection to the host, or the control connection if it is down"
+        if host is None or host in self._down:
+            return self.control_connection
+        try:
+            return self.connection(host)
+        except (Error, OSError):
+            return self.control_connection
+
+    def _hedge_connection(self, tried):
+        "Return a connection to a node not tried yet, or None"
+        for i in range(len(self.hosts)):
+            with self._lock:
+                host = next(self._round_robin)
+            if host in tried or host in self._down:
+                continue
+            try:
+                return self.connection(host)
+            except (Error, OSError):
+                tried.add(host)
+        return None
+
+    def _execute_speculative(
+        self, conn, query, args, page_size, keyspace=None, trace=False, timeout=None
+    ):
+        "Return (connection, future) of the first response within timeout seconds"
+        policy = self.speculative
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        first = conn._execute_async(query, args, page_size, keyspace=keyspace, trace=trace)
+        futures = {first: conn}
+        pending = set(futures)
+        tried = {conn.host}
+        hedges = 0
+        error = None
+        while pending:
+            wait = policy.delay() if hedges < policy.max_hedges else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise OperationTimedOut("No response in %g seconds from %s" % (
+                        timeout, ', '.join(sorted(tried))
+                    ))
+                wait = remaining if wait is None else min(wait, remaining)
+            done, pending = concurrent.futures.wait(
+                pending, wait, concurrent.futures.FIRST_COMPLETED
+            )
+            for f in done:
+                if isinstance(f.exception(), Error):
+                    error = error or f.exception()
+                    continue
+                # the latency seen by the caller, also when a hedge wins
+                policy.record(time.monotonic() - start, hedges, f is not first)
+                return futures[f], f
+            if not done and (deadline is None or time.monotonic() < deadline):
+                hedge = self._hedge_connection(tried)
+                if hedge is None:
+                    hedges = policy.max_hedges
+                    continue
+                tried.add(hedge.host)
+                hedges += 1
+                f = hedge._execute_async(query, args, page_size, keyspace=keyspace, trace=trace)
+                futures[f] = hedge
+                pending.add(f)
+        raise error
+
+    def partition_key(self, table, keyspace=None):
+        "Return [(column_name, type_code)] of the partition key of the table"
+        keyspace = keyspace or self.keyspace
+        key = (keyspace, table)
+        if key not in self._partition_keys:
+            columns = partition_key_columns(self.control_connection, table, keyspace)
+            for _, column_type in columns:
+                if column_type not in TYPE_CODES:
+                    raise NotSupportedError()
+            self._partition_keys[key] = [
+                (column_name, TYPE_CODES[column_type]) for column_name, column_type in columns
+            ]
+        return self._partition_keys[key]
+
+    def token(self, table, values, keyspace=None):
+        "Return token of partition key values of the table"
+        return murmur3(routing_key([
+            encode_value(v, type_code)
+            for v, (_, type_code) in zip(values, self.partition_key(table, keyspace))
+        ]))
+
+    def cursor(
+        self, page_size=None, prefetch=True, keyspace=None, trace=False, result_cache=None,
+        row_factory=None, blob=bytes
+    ):
+        return ClusterCursor(
+            self, page_size, prefetch, keyspace, trace, result_cache, row_factory, blob
+        )
+
+    def close(self):
+        with self._lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+            connections, self._connections = self._connections, {}
+        for conn in connections.values():
+            if conn.is_connect():
+                conn.close()
+
+
+# errors of a bulk load chunk which may succeed if retried
+RETRYABLE_ERRORS = (
+    0x1000,     # Unavailable
+    0x1001,     # Overloaded
+    0x1002,     # Is_bootstrapping
+    0x1100,     # Write_timeout
+    0x1300,     # Write_failure
+)
+
+
+def bulk_load(
+    target, table, columns, rows, keyspace=None, batch_size=20, window=10000,
+    concurrency=32, retries=3, progress=None, progress_interval=1.0
+):
+    """Insert rows (sequences of values of the columns) into the table and return
+    the number of rows inserted.
+    target is a Connection, which is switched to multiplex mode, or a Cluster.
+    Rows are grouped by their partition key within window rows, and sent in
+    unlogged batches of up to batch_size rows of one partition, with up to
+    concurrency batches in flight. Batches failing with timeout or unavailable
+    errors are retried up to retries times.
+    progress(rows inserted, seconds) is called every progress_interval seconds."""
+    cluster = target if isinstance(target, Cluster) else None
+    conn = cluster.control_connection if cluster else target
+    if keyspace:
+        table = keyspace + '.' + table
+    stmt = conn.prepare("INSERT INTO %s (%s) VALUES (%s)" % (
+        table, ', '.join(columns), ', '.join('?' * len(columns))
+    ))
+    start = last_progress = time.monotonic()
+    inflight = {}   # future: (connection, entries, attempts)
+    loaded = 0
+
+    def send(entries, attempts=0, connection=None):
+        if connection is None:
+            connection = cluster.route(stmt, entries[0][1]) if cluster else conn
+            connection._switch_to_multiplex()
+        future = connection._request_async(OP_BATCH, encode_batch(
+            [(stmt, values) for values, _ in entries], BATCH_UNLOGGED, connection.protocol_version
+        ))
+        inflight[future] = (connection, entries, attempts)
+
+    def wait(n):
+        "Wait until less than n batches are in flight"
+        nonlocal loaded, last_progress
+        while len(inflight) >= n:
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for f in done:
+                connection, entries, attempts = inflight.pop(f)
+                try:
+                    decode_result(*f.result())
+                    loaded += len(entries)
+                except OperationalError as e:
+                    if e.code == 0x2500:    # Unprepared on the node
+                        connection._reprepare(stmt)
+                        send(entries, attempts, connection)
+                    elif e.code in RETRYABLE_ERRORS and attempts < retries:
+                        time.sleep(0.1 * 2 ** attempts)
+                        send(entries, attempts + 1)
+                    else:
+                        raise
+                except OSError:
+                    if attempts >= retries:
+                        raise
+                    send(entries, attempts + 1)
+            if progress and time.monotonic() - last_progress >= progress_interval:
+                last_progress = time.monotonic()
+                progress(loaded, last_progress - start)
+
+    def flush(key, entries):
+        # rows of unknown partitions are not batched together
+        size = batch_size if key is not None else 1
+        for i in range(0, len(entries), size):
+            wait(concurrency)
+            send(entries[i:i+size])
+
+    groups = collections.defaultdict(list)  # partition key: [(values, row)]
+    buffered = 0
+    for row in rows:
+        values = stmt.bind(row)
+        key = None
+        if stmt.pk_indexes and all(values[i] is not None for i in stmt.pk_indexes):
+            key = routing_key([values[i] for i in stmt.pk_indexes])
+        group = groups[key]
+        group.append((values, row))
+        buffered += 1
+        if key is not None and len(group) >= batch_size:
+            del groups[key]
+            buffered -= len(group)
+            flush(key, group)
+        elif buffered >= window:
+            for key, group in groups.items():
+                flush(key, group)
+            groups.clear()
+            buffered = 0
+    for key, group in groups.items():
+        flush(key, group)
+    wait(1)
+    if progress:
+        progress(loaded, time.monotonic() - start)
+    return loaded
+
+
+def scan(
+    target, table, columns=None, keyspace=None, partition_key=None, splits=64, workers=8,
+    page_size=5000, row_factory=None
+):
+    """Return an iterator of all rows of the table, which is read by token ranges
+    "token(partition key) > start AND token(partition key) <= end" with up to workers
+    ranges in flight, and rows come in the order they arrive.
+    target is a Connection, which is switched to multiplex mode, or a Cluster,
+    which also splits ranges at the ring tokens and reads each from its owner.
+    partition_key is names of the partition key columns, or read from system_schema."""
+    cluster = target if isinstance(target, Cluster) else None
+    conn = cluster.control_connection if cluster else target
+    keyspace = keyspace or conn.keyspace
+    row_factory = resolve_row_factory(row_factory or conn.row_factory)
+    if partition_key is None:
+        partition_key = [name for name, _ in partition_key_columns(conn, table, keyspace)]
+    token = 'token(%s)' % ', '.join(partition_key)
+    stmt = conn.prepare("SELECT %s FROM %s WHERE %s > ? AND %s <= ?" % (
+        ', '.join(columns) if columns else '*',
+        keyspace + '.' + table if keyspace else table, token, token
+    ))
+    ranges = collections.deque(token_ranges(splits, cluster._tokens if cluster else ()))
+    inflight = {}   # future: (connection, token range)
+
+    def send(connection, token_range, paging_state=None):
+        connection._switch_to_multiplex()
+        future = connection._execute_async(stmt, token_range, page_size, paging_state)
+        inflight[future] = (connection, token_range)
+
+    while ranges or inflight:
+        while ranges and len(inflight) < workers:
+            token_range = ranges.popleft()
+            send(
+                cluster._connection_or_control(cluster.replica(token_range[1]))
+                if cluster else conn, token_range
+            )
+        done, _ = concurrent.futures.wait(
+            inflight, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for f in done:
+            connection, token_range = inflight.pop(f)
+            description, rows, paging_state = f.result()
+            if paging_state:
+                # the next page is read while rows of this page are consumed
+                send(connection, token_range, paging_state)
+            yield from map(row_factory(description), rows)
+
+
+def connect(host, keyspace=None, port=9042, user=None, password=None, use_ssl=False, **kwargs):
+    return Connection(host, keyspace, port, user, password, use_ssl, **kwargs)
@@ -20,5 +20,5 @@ setup(
     description='Yet another Cassandra database driver',
     long_description=open('README.rst').read(),
     license="MIT",
-    py_modules=['minicql'],
+    py_modules=['minicql', 'aiominicql'],
 )
@@ -23,9 +23,21 @@
 # SOFTWARE.
 ###############################################################################
 import unittest
+import asyncio
 import minicql
+import aiominicql
+import fakecql
+import cqlproxy
+import cqlreplay
 import decimal
+import io
 import uuid
+import os
+import pickle
+import socket
+import tempfile
+import threading
+import time
 import datetime
 
 
@@ -164,6 +176,837 @@ class TestMiniCQL(unittest.TestCase):
         self.assertEqual(r[1], datetime.date(1967, 8, 11))
         self.assertEqual(r[2], datetime.time(12, 34, 56, 123456))
 
+        # inlined without prepared statements, str for timestamp too
+        conn = minicql.connect(
+            self.host, self.keyspace, port=self.port, user=self.user, password=self.password,
+            use_ssl=self.use_ssl, prepare_threshold=0,
+        )
+        cur = conn.cursor()
+        for i, dt in ((2, datetime.datetime(1967, 8, 11, 12, 34, 56)), (3, '1967-08-11 12:34:56+00:00')):
+            cur.execute(
+                "INSERT INTO test_date_time_type (id, dt, d, t) VALUES (%s, %s, %s, %s)",
+                (i, dt, datetime.date(1967, 8, 11), datetime.time(12, 34, 56, 123456))
+            )
+            cur.execute("SELECT dt, d, t FROM test_date_time_type WHERE id=%s", (i, ))
+            self.assertEqual(cur.fetchone(), r)
+        conn.close()
+
+    def test_paging(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("drop table test_paging")
+        except:
+            pass
+        cur.execute("""
+            CREATE TABLE test_paging (
+                id INT,
+                PRIMARY KEY(id)
+            )
+        """)
+        for i in range(25):
+            cur.execute("INSERT INTO test_paging (id) VALUES (%s)", (i, ))
+
+        cur = self.conn.cursor(page_size=10)
+        cur.execute("SELECT id FROM test_paging")
+        self.assertEqual(len(cur.fetchmany(3)), 3)
+        self.assertEqual(len(list(cur)), 22)
+
+        cur.execute("SELECT id FROM test_paging")
+        self.assertEqual(sorted(r[0] for r in cur.fetchall()), list(range(25)))
+
+        cur = self.conn.cursor(page_size=10, prefetch=False)
+        cur.execute("SELECT id FROM test_paging")
+        self.assertEqual(len(list(cur)), 25)
+
+    def test_prepare(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("drop table test_prepare")
+        except:
+            pass
+        cur.execute("""
+            CREATE TABLE test_prepare (
+                id INT,
+                s TEXT,
+                dec decimal,
+                dt timestamp,
+                PRIMARY KEY(id)
+            )
+        """)
+        cur.executemany(
+            "INSERT INTO test_prepare (id, s, dec, dt) VALUES (%s, %s, %s, %s)",
+            [
+                (1, 'a', decimal.Decimal('-0.123'), datetime.datetime(2020, 1, 2, 3, 4, 5)),
+                (2, None, decimal.Decimal('123.4'), None),
+            ]
+        )
+        for i in range(3):
+            cur.execute("SELECT id, s, dec, dt FROM test_prepare WHERE id=%s", (1, ))
+            self.assertEqual(cur.fetchall(), [(
+                1, 'a', decimal.Decimal('-0.123'),
+                datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+            )])
+        self.assertTrue(isinstance(cur.query, minicql.PreparedStatement))
+
+        stmt = self.conn.prepare("SELECT id, s, dec FROM test_prepare WHERE id=?")
+        cur.execute(stmt, (2, ))
+        self.assertEqual(cur.fetchall(), [(2, None, decimal.Decimal('123.4'))])
+
+    def test_multiplex(self):
+        conn = minicql.connect(
+            self.host,
+            self.keyspace,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            use_ssl=self.use_ssl,
+            multiplex=True,
+        )
+        cur = conn.cursor()
+        futures = [
+            cur.execute_async("SELECT keyspace_name FROM system_schema.keyspaces WHERE keyspace_name=%s", (name, ))
+            for name in ('system', 'test_minicql', 'system_schema')
+        ]
+        self.assertEqual(
+            [f.result().fetchall() for f in futures],
+            [[('system', )], [('test_minicql', )], [('system_schema', )]],
+        )
+        cur.execute("SELECT keyspace_name FROM system_schema.keyspaces WHERE keyspace_name='system'")
+        self.assertEqual(cur.fetchall(), [('system', )])
+        conn.close()
+
+    def test_asyncio(self):
+        async def main():
+            conn = await aiominicql.connect(
+                self.host,
+                self.keyspace,
+                port=self.port,
+                user=self.user,
+                password=self.password,
+                use_ssl=self.use_ssl,
+                page_size=2,
+            )
+            cur = conn.cursor()
+            await cur.execute("SELECT keyspace_name FROM system_schema.keyspaces")
+            names = [r[0] async for r in cur]
+            self.assertTrue('test_minicql' in names)
+
+            async def select(name):
+                cur = conn.cursor()
+                await cur.execute(
+                    "SELECT keyspace_name FROM system_schema.keyspaces WHERE keyspace_name=%s", (name, )
+                )
+                return await cur.fetchall()
+            self.assertEqual(
+                await asyncio.gather(select('system'), select('test_minicql')),
+                [[('system', )], [('test_minicql', )]],
+            )
+            await conn.close()
+
+        asyncio.run(main())
+
+    def test_pool(self):
+        pool = minicql.Pool(
+            self.host,
+            self.keyspace,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            use_ssl=self.use_ssl,
+            min_size=1,
+            max_size=2,
+            acquire_timeout=1,
+            timeout=10,
+        )
+        with pool.connection() as conn1:
+            with pool.connection() as conn2:
+                self.assertNotEqual(conn1, conn2)
+                self.assertRaises(minicql.OperationalError, pool.acquire)
+            cur = conn1.cursor()
+            cur.execute("SELECT keyspace_name FROM system_schema.keyspaces WHERE keyspace_name='system'")
+            self.assertEqual(cur.fetchall(), [('system', )])
+        with pool.connection() as conn3:
+            self.assertTrue(conn3 in (conn1, conn2))
+            self.assertEqual(conn3.timeout, 10)
+            self.assertTrue(conn3.ping())
+        pool.close()
+
+    def test_compression(self):
+        for name, (compress, decompress) in minicql.COMPRESSIONS.items():
+            for b in [b'', b'abc', b'abcd' * 100, bytes(range(256)) * 10]:
+                self.assertEqual(decompress(compress(b)), b)
+
+        for compression in ('lz4', 'snappy'):
+            conn = minicql.connect(
+                self.host,
+                self.keyspace,
+                port=self.port,
+                user=self.user,
+                password=self.password,
+                use_ssl=self.use_ssl,
+                compression=compression,
+                compression_threshold=0,
+            )
+            cur = conn.cursor()
+            cur.execute("SELECT keyspace_name FROM system_schema.keyspaces WHERE keyspace_name='system'")
+            self.assertEqual(cur.fetchall(), [('system', )])
+            conn.close()
+
+    def test_collection_type(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("drop table test_collection_type")
+        except:
+            pass
+        cur.execute("""
+            CREATE TABLE test_collection_type (
+                id INT,
+                l list<int>,
+                s set<text>,
+                m map<text, bigint>,
+                t tuple<int, text>,
+                PRIMARY KEY(id)
+            )
+        """)
+        cur.execute("""INSERT INTO test_collection_type (id, l, s, m, t)
+            VALUES (-1, [1, -2], {'a', 'b'}, {'x': -3}, (4, 'y'))""")
+        cur.execute("SELECT id, l, s, m, t FROM test_collection_type")
+        self.assertEqual(
+            cur.fetchall(),
+            [(-1, [1, -2], {'a', 'b'}, {'x': -3}, (4, 'y'))]
+        )
+
+    def test_batch(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("drop table test_batch")
+        except:
+            pass
+        cur.execute("""
+            CREATE TABLE test_batch (
+                id INT,
+                s TEXT,
+                PRIMARY KEY(id)
+            )
+        """)
+        self.conn.batch_max_statements = 7
+        cur.executemany(
+            "INSERT INTO test_batch (id, s) VALUES (%s, %s)",
+            [(i, str(i)) for i in range(50)]
+        )
+        self.assertEqual(cur.rowcount, 50)
+        self.assertEqual(
+            self.conn.batch([
+                ("UPDATE test_batch SET s='x' WHERE id=%s", (1, )),
+                ("DELETE FROM test_batch WHERE id=2", ()),
+            ], minicql.BATCH_LOGGED),
+            2
+        )
+        cur.execute("SELECT id, s FROM test_batch")
+        rows = dict(cur.fetchall())
+        self.assertEqual(len(rows), 49)
+        self.assertEqual(rows[1], 'x')
+        self.assertEqual(rows[3], '3')
+
+    def test_cluster(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("drop table test_cluster")
+        except:
+            pass
+        cur.execute("""
+            CREATE TABLE test_cluster (
+                id INT,
+                s TEXT,
+                PRIMARY KEY((id, s))
+            )
+        """)
+        cur.execute("INSERT INTO test_cluster (id, s) VALUES (1, 'a')")
+        cur.execute("SELECT token(id, s) FROM test_cluster")
+        token = cur.fetchone()[0]
+
+        cluster = minicql.Cluster(
+            [self.host],
+            self.keyspace,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            use_ssl=self.use_ssl,
+        )
+        self.assertEqual(cluster.partition_key('test_cluster'), [('id', 0x0009), ('s', 0x000D)])
+        self.assertEqual(cluster.token('test_cluster', [1, 'a']), token)
+        cur = cluster.cursor()
+        for i in range(3):
+            cur.execute("SELECT id, s FROM test_cluster WHERE id=%s AND s=%s", (1, 'a'))
+            self.assertEqual(cur.fetchall(), [(1, 'a')])
+        cluster.close()
+
+    def test_speculative(self):
+        policy = minicql.SpeculativeExecution(delay=0)
+        cluster = minicql.Cluster(
+            [self.host],
+            self.keyspace,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            use_ssl=self.use_ssl,
+            speculative=policy,
+        )
+        cur = cluster.cursor()
+        cur.execute("SELECT key FROM system.local", idempotent=True)
+        self.assertEqual(cur.fetchall(), [('local', )])
+        self.assertEqual(policy.stats()['executions'], 1)
+        cluster.close()
+
+    def test_protocol_version(self):
+        conn = minicql.connect(
+            self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            use_ssl=self.use_ssl,
+        )
+        self.assertIn(conn.protocol_version, (4, 5))
+        if conn.protocol_version == 5:
+            cur = conn.cursor(keyspace='system')
+            cur.execute("SELECT key FROM local")
+            self.assertEqual(cur.fetchall(), [('local', )])
+        conn.close()
+
+    def test_event(self):
+        conn = minicql.connect(
+            self.host,
+            self.keyspace,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            use_ssl=self.use_ssl,
+        )
+        events = []
+        received = threading.Event()
+
+        def listener(event):
+            events.append(event)
+            received.set()
+        conn.register('SCHEMA_CHANGE', listener)
+
+        cur = self.conn.cursor()
+        try:
+            cur.execute("drop table test_event")
+        except:
+            pass
+        cur.execute("CREATE TABLE test_event (id INT PRIMARY KEY)")
+        self.assertTrue(received.wait(10))
+        self.assertEqual(events[-1]['type'], 'SCHEMA_CHANGE')
+        self.assertEqual(events[-1]['keyspace'], self.keyspace)
+        conn.close()
+
+    def test_trace(self):
+        cur = self.conn.cursor(trace=True)
+        cur.execute("SELECT key FROM system.local")
+        self.assertIsInstance(cur.trace.tracing_id, uuid.UUID)
+        self.assertEqual(cur.trace.session['session_id'], cur.trace.tracing_id)
+        self.assertTrue(cur.trace.events)
+        self.assertEqual(
+            sorted(cur.trace.breakdown()), ['decode', 'encode', 'network', 'receive', 'send', 'server']
+        )
+        cur.execute("SELECT key FROM system.local", trace=False)
+        self.assertIsNone(cur.trace)
+
+
+class TestFakeServer(unittest.TestCase):
+    def setUp(self):
+        self.server = fakecql.Server(user='cassandra', password='cassandra')
+        self.server.add_table('test', [('id', 'int'), ('s', 'text'), ('l', 'list<int>')], 25)
+
+    def tearDown(self):
+        self.server.close()
+
+    def connect(self, **kwargs):
+        return minicql.connect(
+            '127.0.0.1', 'ks', port=self.server.port, user='cassandra', password='cassandra',
+            **kwargs
+        )
+
+    def test_protocol_version(self):
+        for protocol_version, compression in ((4, None), (4, 'snappy'), (5, None), (5, 'lz4')):
+            conn = self.connect(protocol_version=protocol_version, compression=compression)
+            self.assertEqual(conn.protocol_version, protocol_version)
+            self.assertEqual(conn.compression, compression)
+            cur = conn.cursor(page_size=10)
+            cur.execute("SELECT * FROM test")
+            rows = cur.fetchall()
+            self.assertEqual(len(rows), 25)
+            self.assertEqual(rows[3], (3, 'row3', [3, 4, 5]))
+            conn.close()
+
+        self.server.max_version = 4
+        conn = self.connect()
+        self.assertEqual(conn.protocol_version, 4)
+        conn.close()
+
+    def test_prepare(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        for i in range(3):
+            cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+        self.assertIsInstance(cur.query, minicql.PreparedStatement)
+        self.server.prepared.clear()
+        cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+        self.assertEqual(cur.fetchone(), (0, 'row0'))
+        # prepared again with a new id, by the reader thread with multiplex
+        conn._switch_to_multiplex()
+        self.server.prepared.clear()
+        self.server.prepared_epoch += 1
+        cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+        self.assertEqual(cur.fetchone(), (0, 'row0'))
+        # '%%' is unescaped in the prepared statement too
+        for i in range(3):
+            cur.execute("SELECT id, s FROM test WHERE s LIKE '%%a' AND id=%s", (1, ))
+            self.assertEqual(
+                self.server.last_query[0].replace('1', '?'),
+                "SELECT id, s FROM test WHERE s LIKE '%a' AND id=?"
+            )
+        cur.executemany("INSERT INTO test (id, s) VALUES (%s, %s)", [(i, 'a') for i in range(10)])
+        self.assertEqual(self.server.modifications, 10)
+        # conditional statements are executed one by one, not in a batch
+        requests = self.server.requests
+        cur.executemany(
+            "INSERT INTO test (id, s) VALUES (%s, %s) IF NOT EXISTS", [(i, 'a') for i in range(10)]
+        )
+        self.assertEqual(self.server.modifications, 20)
+        self.assertGreaterEqual(self.server.requests - requests, 10)
+        with self.assertRaises(minicql.OperationalError):
+            cur.execute("SELECT * FROM unknown")
+        conn.close()
+
+        async def main():
+            conn = await aiominicql.connect(
+                '127.0.0.1', 'ks', port=self.server.port, user='cassandra', password='cassandra'
+            )
+            cur = conn.cursor()
+            for i in range(3):
+                await cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+            self.assertIsInstance(cur.query, minicql.PreparedStatement)
+            self.server.prepared.clear()
+            self.server.prepared_epoch += 1
+            await cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+            self.assertEqual(await cur.fetchone(), (0, 'row0'))
+            # prepared at once as by minicql
+            await cur.execute("SELECT id, s FROM test WHERE s=%s", ('row1', ))
+            self.assertIsInstance(cur.query, minicql.PreparedStatement)
+            await conn.close()
+        asyncio.run(main())
+
+    def test_auth(self):
+        with self.assertRaises(minicql.OperationalError):
+            minicql.connect('127.0.0.1', port=self.server.port, user='cassandra', password='x')
+
+    def test_trace(self):
+        tracing_id = uuid.uuid1()
+        self.server.add_table('sessions', [('session_id', 'uuid'), ('duration', 'int')], [
+            [tracing_id, 1500],
+        ])
+        self.server.add_table('events', [
+            ('session_id', 'uuid'), ('activity', 'text'), ('source', 'inet'), ('source_elapsed', 'int')
+        ], [
+            [tracing_id, 'Parsing', '127.0.0.1', 100],
+            [tracing_id, 'Read 1 live rows', '127.0.0.2', 900],
+        ])
+        self.server.warnings = ['Aggregation query used without partition key']
+        for multiplex in (False, True):
+            conn = self.connect(multiplex=multiplex)
+            cur = conn.cursor(trace=True)
+            cur.execute("SELECT id, s FROM test")
+            self.assertEqual(len(cur.fetchall()), 25)
+            self.assertIsInstance(cur.trace.tracing_id, uuid.UUID)
+            self.assertEqual(cur.trace.warnings, self.server.warnings)
+            self.assertEqual(cur.trace.session['duration'], 1500)
+            self.assertEqual(cur.trace.breakdown()['server'], 0.0015)
+            timeline = cur.trace.timeline()
+            self.assertEqual(timeline[0], (0.0, 'client', 'encode'))
+            server = [e for e in timeline if e[1] != 'client']
+            self.assertEqual(server[-1][1:], ('127.0.0.2', 'Read 1 live rows'))
+            cur.execute("SELECT id, s FROM test", trace=False)
+            self.assertIsNone(cur.trace)
+            self.assertEqual(len(cur.fetchall()), 25)
+            conn.close()
+
+        async def main():
+            conn = await aiominicql.connect(
+                '127.0.0.1', 'ks', port=self.server.port, user='cassandra', password='cassandra'
+            )
+            cur = conn.cursor()
+            await cur.execute("SELECT id, s FROM test")
+            self.assertEqual(len(await cur.fetchall()), 25)
+            await conn.close()
+        asyncio.run(main())
+
+    def test_query_template(self):
+        query = "SELECT id, s FROM test WHERE s=%s AND id=%s AND d=%s AND x LIKE '%%a'"
+        template = minicql.query_template(query)
+        self.assertIs(minicql.query_template(query), template)
+        self.assertEqual(
+            template.format(("a'b", 1.5, None)),
+            "SELECT id, s FROM test WHERE s='a''b' AND id=1.5 AND d=NULL AND x LIKE '%a'"
+        )
+        with self.assertRaises(minicql.ProgrammingError):
+            template.format(('a', ))
+
+        # values are encoded by the column types of the prepared statement
+        conn = self.connect()
+        cur = conn.cursor(page_size=10)
+        cur.execute("SELECT id, s FROM test WHERE s=%s AND id=%s", ('x', 1))
+        self.assertIsInstance(cur.query, minicql.PreparedStatement)
+        self.assertEqual(len(cur.fetchall()), 25)
+        self.assertEqual(
+            self.server.last_query,
+            ("SELECT id, s FROM test WHERE s=? AND id=?", [b'x', b'\x00\x00\x00\x01'])
+        )
+        with self.assertRaises(minicql.DataError):
+            cur.execute("SELECT id, s FROM test WHERE id=%s AND s=%s", ('2024', 'x'))
+        conn.close()
+
+        conn = self.connect(prepare_threshold=0)
+        cur = conn.cursor()
+        cur.execute("SELECT id, s FROM test WHERE s=%s AND id=%s", ('x', 1))
+        self.assertEqual(self.server.last_query, ("SELECT id, s FROM test WHERE s='x' AND id=1", []))
+        conn.close()
+
+    def test_result_cache(self):
+        cache = minicql.ResultCache(ttl=60, ttls={"SELECT id FROM test": 0})
+        conn = self.connect(result_cache=cache)
+        cur = conn.cursor()
+        queries = self.server.queries
+        for i in range(5):
+            cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+            self.assertEqual(len(cur.fetchall()), 25)
+            cur.execute("SELECT id FROM test")
+        # the first query is inlined, the second is prepared
+        self.assertEqual(self.server.queries - queries, 2 + 5)
+        self.assertEqual(cache.stats()['hits'], 3)
+
+        invalidations = cache.stats()['invalidations']
+        conn.cursor(result_cache=False).execute("INSERT INTO test (id, s) VALUES (1, 'a')")
+        self.assertEqual(cache.stats()['entries'], 0)
+        # when sent and when applied
+        self.assertEqual(cache.stats()['invalidations'] - invalidations, 2)
+        cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+        self.assertEqual(self.server.queries - queries, 2 + 5 + 2)
+
+        small = minicql.ResultCache(max_entries=2)
+        cur = conn.cursor(result_cache=small)
+        for i in range(3):
+            cur.execute("SELECT id, s FROM test WHERE id=%d" % (i, ))
+        self.assertEqual(small.stats()['entries'], 2)
+        self.assertEqual(small.stats()['evictions'], 1)
+        small.max_bytes = small.bytes // 2
+        cur.execute("SELECT id, s FROM test WHERE id=9")
+        self.assertEqual(small.stats()['entries'], 1)
+        conn.close()
+
+    def test_row_factory(self):
+        conn = self.connect(row_factory='row')
+        cur = conn.cursor(page_size=10)
+        cur.execute("SELECT * FROM test")
+        row = cur.fetchone()
+        self.assertIsInstance(row, minicql.Row)
+        self.assertEqual(row, (0, 'row0', [0, 1, 2]))
+        self.assertEqual((row['s'], row[-1], row[:2]), ('row0', [0, 1, 2], (0, 'row0')))
+        self.assertEqual(row.asdict(), {'id': 0, 's': 'row0', 'l': [0, 1, 2]})
+        self.assertEqual(pickle.loads(pickle.dumps(row)), (0, 'row0', [0, 1, 2]))
+        self.assertEqual(len(cur.fetchmany(12)), 12)
+        rows = cur.fetchall()
+        self.assertEqual([r[0] for r in rows], list(range(13, 25)))
+        self.assertEqual(cur.rowcount, 25)
+
+        cur = conn.cursor(row_factory='dict')
+        cur.execute("SELECT id, s FROM test")
+        self.assertEqual(cur.fetchone(), {'id': 0, 's': 'row0'})
+        cur = conn.cursor(row_factory='namedtuple')
+        cur.execute("SELECT id, s FROM test")
+        self.assertEqual(cur.fetchall()[1].s, 'row1')
+        cur = conn.cursor(row_factory='tuple')
+        cur.execute("SELECT id, s FROM test")
+        self.assertEqual(cur.fetchall()[1], (1, 'row1'))
+        with self.assertRaises(minicql.ProgrammingError):
+            conn.cursor(row_factory='list')
+        conn.close()
+
+    def test_timeout(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        self.server.delay = 0.5
+        with self.assertRaises(minicql.OperationTimedOut):
+            cur.execute("SELECT id, s FROM test", timeout=0.1)
+        self.assertTrue(conn.multiplex)
+        self.server.delay = 0
+        # the late response is discarded and its stream released
+        cur.execute("SELECT id FROM test WHERE id=1")
+        self.assertEqual(cur.description[0][0], 'id')
+        self.assertEqual(len(cur.fetchall()), 25)
+        self.assertEqual(conn._waiters, {})
+
+        # a prefetch is dropped without waiting for its page
+        cur = conn.cursor(page_size=10)
+        self.server.delay = 0.5
+        cur.execute("SELECT id FROM test")
+        start = time.monotonic()
+        cur.close()
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.server.delay = 0
+        for i in range(100):
+            if not conn._waiters:
+                break
+            time.sleep(0.01)
+        self.assertEqual(conn._waiters, {})
+
+        # pages are fetched within the timeout of execute()
+        cur = conn.cursor(page_size=10, prefetch=False)
+        cur.execute("SELECT id FROM test", timeout=0.2)
+        self.server.delay = 0.5
+        with self.assertRaises(minicql.OperationTimedOut):
+            cur.fetchall()
+        conn.close()
+
+        # and PREPARE, BATCH and OPTIONS within the timeout of the connection
+        conn = self.connect(timeout=0.2)
+        cur = conn.cursor()
+        start = time.monotonic()
+        with self.assertRaises(minicql.OperationTimedOut):
+            cur.execute("SELECT id, s FROM test WHERE s=%s", ('x', ))
+        with self.assertRaises(minicql.OperationTimedOut):
+            cur.executemany("INSERT INTO test (id, s) VALUES (%s, %s)", [(1, 'a'), (2, 'b')])
+        with self.assertRaises(minicql.OperationTimedOut):
+            conn.batch([("INSERT INTO test (id, s) VALUES (1, 'a')", ())])
+        self.assertFalse(conn.ping())
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.server.delay = 0
+        conn.close()
+
+        # a server which accepts the connection but never responds
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        start = time.monotonic()
+        with self.assertRaises(minicql.OperationTimedOut):
+            minicql.connect('127.0.0.1', port=sock.getsockname()[1], connect_timeout=0.2)
+        self.assertLess(time.monotonic() - start, 1)
+        sock.close()
+
+    def test_lost_connection(self):
+        conn = self.connect(multiplex=True)
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM test")
+        self.server.disconnect()
+        for i in range(100):
+            if not conn.is_connect():
+                break
+            time.sleep(0.01)
+        self.assertFalse(conn.is_connect())
+        self.assertFalse(conn.ping())
+        with self.assertRaises(minicql.OperationalError):
+            conn._request(minicql.OP_OPTIONS)
+        with self.assertRaises(minicql.ProgrammingError):
+            cur.execute("SELECT id FROM test")
+        conn.close()
+
+        async def main():
+            conn = await aiominicql.connect(
+                '127.0.0.1', 'ks', port=self.server.port, user='cassandra', password='cassandra'
+            )
+            self.server.disconnect()
+            await asyncio.wait_for(conn._read_task, 1)
+            self.assertFalse(conn.is_connect())
+            with self.assertRaises(minicql.OperationalError):
+                await asyncio.wait_for(conn._request(minicql.OP_OPTIONS), 1)
+            await conn.close()
+        asyncio.run(main())
+
+    def test_large_blob(self):
+        data = bytes(range(256)) * 1024     # larger than a v5 segment
+        self.server.add_table('blobs', [('id', 'int'), ('b', 'blob')], [[1, data], [2, None]])
+        for protocol_version, compression in ((4, None), (5, None), (5, 'lz4')):
+            conn = self.connect(protocol_version=protocol_version, compression=compression)
+            cur = conn.cursor(blob=memoryview)
+            for i in range(3):
+                cur.execute("INSERT INTO blobs (id, b) VALUES (%s, %s)", (i, memoryview(data)))
+                self.assertEqual(self.server.last_query[1][-1], data)
+            self.assertIsInstance(cur.query, minicql.PreparedStatement)
+            cur.execute("SELECT id, b FROM blobs")
+            row = cur.fetchone()
+            self.assertIsInstance(row[1], memoryview)
+            self.assertEqual(row[1], data)
+
+            f = io.BytesIO()
+            cur.execute("SELECT id, b FROM blobs")
+            self.assertEqual(cur.fetchblob(f, 'b'), len(data))
+            self.assertEqual(f.getvalue(), data)
+            self.assertEqual(cur.fetchblob(f, 'b'), 0)
+            self.assertIsNone(cur.fetchblob(f, 'b'))
+            conn.close()
+
+    def test_bulk_load(self):
+        self.server.add_table('load', [('id', 'int'), ('s', 'text')], 0)
+        conn = self.connect()
+        rows = [(i % 10, 'row%d' % i) for i in range(100)]
+        requests = self.server.requests
+        self.assertEqual(minicql.bulk_load(conn, 'load', ['id', 's'], iter(rows), batch_size=5), 100)
+        self.assertEqual(self.server.modifications, 100)
+        # PREPARE and batches of 5 rows of a partition
+        self.assertEqual(self.server.requests - requests, 1 + 20)
+        self.assertTrue(conn.multiplex)
+        conn.close()
+
+    def test_scan(self):
+        self.server.add_table('big', [('s', 'text'), ('id', 'int')], 1000)
+        ranges = minicql.token_ranges(4, [0, 10])
+        self.assertEqual(len(ranges), 5)
+        self.assertEqual(ranges[0][0], minicql.MIN_TOKEN)
+        self.assertEqual(ranges[-1][1], minicql.MAX_TOKEN)
+        self.assertTrue(all(a[1] == b[0] for a, b in zip(ranges, ranges[1:])))
+
+        conn = self.connect()
+        rows = list(minicql.scan(
+            conn, 'big', ['s', 'id'], partition_key=['s'], splits=16, workers=4, page_size=20
+        ))
+        self.assertEqual(sorted(rows), sorted(('row%d' % i, i % 128) for i in range(1000)))
+        self.assertTrue(conn.multiplex)
+        conn.close()
+
+        cluster = minicql.Cluster(
+            '127.0.0.1', 'ks', port=self.server.port, user='cassandra', password='cassandra',
+            watch_events=False
+        )
+        keys = [row[0] for row in minicql.scan(cluster, 'big', partition_key=['s'])]
+        self.assertEqual(sorted(keys), sorted('row%d' % i for i in range(1000)))
+        cluster.close()
+
+    def test_proxy(self):
+        stats = cqlproxy.Stats()
+        path = tempfile.mktemp()
+        capture = cqlproxy.Capture(path)
+        loop = asyncio.new_event_loop()
+        proxy = loop.run_until_complete(
+            cqlproxy.proxy('127.0.0.1', self.server.port, '127.0.0.1', 0, stats, capture=capture)
+        )
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            for protocol_version, compression in ((4, 'lz4'), (5, 'lz4')):
+                conn = minicql.connect(
+                    '127.0.0.1', 'ks', port=proxy.sockets[0].getsockname()[1],
+                    user='cassandra', password='cassandra',
+                    protocol_version=protocol_version, compression=compression
+                )
+                cur = conn.cursor(page_size=10)
+                cur.execute("SELECT * FROM test")
+                self.assertEqual(len(cur.fetchall()), 25)
+                cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+                cur.execute("SELECT id, s FROM test WHERE id=%s", (1, ))
+                cur.executemany("INSERT INTO test (id, s) VALUES (%s, %s)", [(i, 'a') for i in range(5)])
+                conn.close()
+        finally:
+            async def shutdown():
+                proxy.close()
+                await asyncio.gather(*(asyncio.all_tasks() - {asyncio.current_task()}))
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            capture.close()
+        self.assertEqual(stats.queries["SELECT * FROM test"].count, 6)
+        self.assertEqual(stats.queries["PREPARE SELECT id, s FROM test WHERE id=?"].count, 2)
+        self.assertEqual(
+            stats.queries["SELECT id, s FROM test WHERE id=?"].count, stats.opcodes["EXECUTE"].count
+        )
+        self.assertEqual(stats.opcodes['QUERY'].errors, 0)
+        self.assertIn('SELECT * FROM test', stats.report())
+
+        # replay the capture with new prepared statement ids
+        self.server.prepared.clear()
+        self.server.prepared_epoch += 1
+        self.server.modifications = 0
+        connections = cqlreplay.load_capture(path)
+        os.remove(path)
+        self.assertEqual(len(connections), 2)
+        replay_stats = cqlproxy.Stats()
+        replayer = cqlreplay.Replayer('127.0.0.1', self.server.port, replay_stats, speed=0)
+        asyncio.run(replayer.run(connections))
+        self.assertEqual(self.server.modifications, 10)
+        self.assertEqual(replay_stats.total.count, stats.total.count)
+        self.assertEqual(replay_stats.total.errors, 0)
+
+        # the replay ends with an error if the server closes the connection
+        requests = [r for r in next(iter(connections.values())) if r[1][4] != minicql.OP_PREPARE]
+        self.server.delay = 0.1
+        queries = self.server.queries
+
+        def disconnect():
+            while self.server.queries < queries + 2:
+                time.sleep(0.01)
+            self.server.disconnect()
+        thread = threading.Thread(target=disconnect)
+        thread.start()
+        with self.assertRaises(ConnectionError):
+            asyncio.run(asyncio.wait_for(replayer.replay(requests, 0), 5))
+        thread.join()
+        self.server.delay = 0
+
+
+class TestToken(unittest.TestCase):
+    def test_murmur3(self):
+        self.assertEqual(minicql.murmur3(b'123'), -7468325962851647638)
+        self.assertEqual(minicql.murmur3(b'\x00\xff\x10\xfa\x99' * 10), 5837342703291459765)
+        self.assertEqual(minicql.murmur3(b'\xfe' * 8), -8927430733708461935)
+        self.assertEqual(minicql.murmur3(b'\x10' * 8), 1446172840243228796)
+        self.assertEqual(minicql.murmur3(b'9223372036854775807'), 7162290910810015547)
+
+    def test_routing_key(self):
+        self.assertEqual(minicql.routing_key([b'ab']), b'ab')
+        self.assertEqual(
+            minicql.routing_key([b'ab', b'c']),
+            b'\x00\x02ab\x00\x00\x01c\x00'
+        )
+
+    def test_decode_event(self):
+        self.assertEqual(
+            minicql.decode_event(
+                b'\x00\x0dSTATUS_CHANGE\x00\x02UP\x04\x7f\x00\x00\x01\x00\x00#R'
+            ),
+            {'type': 'STATUS_CHANGE', 'change': 'UP', 'address': ('127.0.0.1', 9042)}
+        )
+        self.assertEqual(
+            minicql.decode_event(
+                b'\x00\x0dSCHEMA_CHANGE\x00\x07CREATED\x00\x05TABLE\x00\x02ks\x00\x01t'
+            ),
+            {'type': 'SCHEMA_CHANGE', 'change': 'CREATED', 'target': 'TABLE', 'keyspace': 'ks', 'name': 't'}
+        )
+
+
+class TestSegment(unittest.TestCase):
+    def test_segment(self):
+        segment = minicql.encode_segment(b'hello')
+        self.assertEqual(segment, bytes.fromhex('05000219999a68656c6c6f74800eb6'))
+        self.assertEqual(minicql.decode_segment_header(segment[:6]), (5, 0))
+        self.assertEqual(bytes(minicql.decode_segment_payload(segment[6:])), b'hello')
+        with self.assertRaises(minicql.OperationalError):
+            minicql.decode_segment_header(b'\x06' + segment[1:6])
+
+        segment = minicql.encode_segment(b'a' * 1000, True, minicql.lz4_compress_block)
+        ln, uncompressed_length = minicql.decode_segment_header(segment[:8])
+        self.assertEqual(uncompressed_length, 1000)
+        self.assertEqual(minicql.decode_segment_payload(
+            segment[8:], uncompressed_length, minicql.lz4_decompress_block
+        ), b'a' * 1000)
+
+    def test_coalesce(self):
+        self.assertEqual(len(minicql.encode_segments([b'a' * 10] * 100)), 1)
+        self.assertEqual(
+            [len(s) for s in minicql.encode_segments([b'a' * 100000, b'b' * 200000])],
+            [100010, 0x1FFFF + 10, 200000 - 0x1FFFF + 10]
+        )
+
 
 if __name__ == "__main__":
     unittest.main()